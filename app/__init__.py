@@ -21,7 +21,7 @@ load_dotenv()
 db = SQLAlchemy()
 login_manager = LoginManager()
 mail = Mail()
-socketio = SocketIO(cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(cors_allowed_origins="*")
 migrate = Migrate()
 csrf = CSRFProtect()
 
@@ -35,6 +35,23 @@ def create_app(config_name='development'):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_ECHO'] = False
     
+    # Socket.IO worker model: 'threading' for the development server, 'eventlet'
+    # or 'gevent' (green threads, one per connection) in production via wsgi.py
+    app.config['SOCKETIO_ASYNC_MODE'] = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+    # Queue shared by all worker processes so emits reach clients connected to
+    # any of them: redis://..., or a Kombu URL such as amqp://... or filesystem://
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    app.config['SOCKETIO_CHANNEL'] = os.getenv('SOCKETIO_CHANNEL', 'flowdeck')
+    app.config['SOCKETIO_QUEUE_FOLDER'] = os.getenv('SOCKETIO_QUEUE_FOLDER', os.path.join(app.instance_path, 'socketio-queue'))
+    if app.config['SOCKETIO_ASYNC_MODE'] != 'threading' and not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # Each green thread checks out its own connection, so the pool is
+        # sized for the concurrency rather than for a handful of OS threads
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('DB_POOL_SIZE', 20)),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 30)),
+            'pool_pre_ping': True,
+        }
+    
     # Mail configuration
     app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
     app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
@@ -48,6 +65,20 @@ def create_app(config_name='development'):
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
     app.config['ALLOWED_EXTENSIONS'] = set(os.getenv('ALLOWED_EXTENSIONS', 'png,jpg,jpeg,gif,pdf,doc,docx').split(','))
     
+    # Attachment storage (outside static, served by authenticated download routes)
+    app.config['STORAGE_FOLDER'] = os.getenv('STORAGE_FOLDER', os.path.join(app.instance_path, 'storage'))
+    app.config['ATTACHMENT_CACHE_MAX_AGE'] = int(os.getenv('ATTACHMENT_CACHE_MAX_AGE', 365 * 24 * 3600))
+    # '', 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx)
+    app.config['SENDFILE_BACKEND'] = os.getenv('SENDFILE_BACKEND', '').lower()
+    app.config['SENDFILE_ACCEL_PREFIX'] = os.getenv('SENDFILE_ACCEL_PREFIX', '/protected-storage/')
+    app.config['USE_X_SENDFILE'] = app.config['SENDFILE_BACKEND'] == 'x-sendfile'
+    # Resumable uploads: chunks stay under MAX_CONTENT_LENGTH, files up to
+    # UPLOAD_MAX_SIZE (or the organisation's own limit) in total
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+    app.config['UPLOAD_MAX_SIZE'] = int(os.getenv('UPLOAD_MAX_SIZE', 1024 * 1024 * 1024))
+    app.config['UPLOAD_EXPIRY_HOURS'] = int(os.getenv('UPLOAD_EXPIRY_HOURS', 24))  # unfinished uploads are dropped after this
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+    
     # Session configuration
     app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
     app.config['SESSION_COOKIE_SECURE'] = False  # Set True in production with HTTPS
@@ -58,6 +89,28 @@ def create_app(config_name='development'):
     app.config['APP_NAME'] = os.getenv('APP_NAME', 'FlowDeck')
     app.config['APP_URL'] = os.getenv('APP_URL', 'http://localhost:5000')
     app.config['ITEMS_PER_PAGE'] = int(os.getenv('ITEMS_PER_PAGE', 20))
+    app.config['BULK_TASK_LIMIT'] = int(os.getenv('BULK_TASK_LIMIT', 1000))
+    app.config['CHAT_PAGE_SIZE'] = int(os.getenv('CHAT_PAGE_SIZE', 50))
+    app.config['CHAT_PERSIST_MODE'] = os.getenv('CHAT_PERSIST_MODE', 'write_behind')  # or sync: commit before emitting
+    app.config['CHAT_PERSIST_BATCH_SIZE'] = int(os.getenv('CHAT_PERSIST_BATCH_SIZE', 100))
+    app.config['CHAT_PERSIST_BATCH_DELAY'] = float(os.getenv('CHAT_PERSIST_BATCH_DELAY', 0.05))  # seconds
+    app.config['CHAT_PERSIST_MAX_RETRIES'] = int(os.getenv('CHAT_PERSIST_MAX_RETRIES', 5))
+    app.config['CHAT_PERSIST_RETRY_BACKOFF'] = float(os.getenv('CHAT_PERSIST_RETRY_BACKOFF', 0.1))  # doubles per retry
+    app.config['CHAT_PERSIST_SHUTDOWN_TIMEOUT'] = float(os.getenv('CHAT_PERSIST_SHUTDOWN_TIMEOUT', 10))  # seconds to drain the queue at exit
+    app.config['CHAT_ACK_MAX_RANGES'] = int(os.getenv('CHAT_ACK_MAX_RANGES', 100))  # id ranges per batched ack
+    app.config['CHAT_ACK_MAX_MESSAGES'] = int(os.getenv('CHAT_ACK_MAX_MESSAGES', 1000))  # messages looked at per batched ack
+    app.config['SYNC_PAGE_SIZE'] = int(os.getenv('SYNC_PAGE_SIZE', 200))  # most messages / notifications per sync page
+    app.config['MESSAGE_ID_BLOCK_SIZE'] = int(os.getenv('MESSAGE_ID_BLOCK_SIZE', 100))
+    app.config['MESSAGE_ARCHIVE_DAYS'] = int(os.getenv('MESSAGE_ARCHIVE_DAYS', 180))  # default horizon; Organisation.message_archive_days overrides
+    app.config['MESSAGE_HOT_MAX_ROWS'] = int(os.getenv('MESSAGE_HOT_MAX_ROWS', 1000000))  # size envelope of the messages table, 0 for none
+    app.config['MESSAGE_ARCHIVE_BATCH_SIZE'] = int(os.getenv('MESSAGE_ARCHIVE_BATCH_SIZE', 1000))  # rows moved per transaction
+    app.config['TYPING_STORE'] = os.getenv('TYPING_STORE', 'app.utils.typing_indicators.MemoryTypingStore')
+    app.config['TYPING_TTL'] = float(os.getenv('TYPING_TTL', 5))  # seconds a start stays valid without a stop
+    app.config['TYPING_THROTTLE'] = float(os.getenv('TYPING_THROTTLE', 2))  # seconds between broadcast starts
+    app.config['PRESENCE_FLUSH_INTERVAL'] = float(os.getenv('PRESENCE_FLUSH_INTERVAL', 1))  # seconds between presence diffs
+    app.config['PRESENCE_PERSIST_INTERVAL'] = float(os.getenv('PRESENCE_PERSIST_INTERVAL', 30))  # seconds between last_seen writes
+    app.config['ASSIGNMENT_STRATEGY'] = os.getenv('ASSIGNMENT_STRATEGY', 'least_loaded')  # or round_robin
+    app.config['ASSIGNMENT_METRIC'] = os.getenv('ASSIGNMENT_METRIC', 'tasks')  # open task count, or estimated hours
     
     # API Keys
     app.config['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
@@ -68,7 +121,12 @@ def create_app(config_name='development'):
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
-    socketio.init_app(app)
+    # Socket.IO events are registered before init_app, which copies them onto
+    # the new server; registered later they only reach the first app's server
+    from app.sockets import chat_events, notification_events
+    from app.utils.socket_queue import create_client_manager
+    socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                      client_manager=create_client_manager(app))
     migrate.init_app(app, db)
     csrf.init_app(app)
     
@@ -89,6 +147,7 @@ def create_app(config_name='development'):
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'), exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'attachments'), exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'logos'), exist_ok=True)
+    os.makedirs(os.path.join(app.config['STORAGE_FOLDER'], 'blobs'), exist_ok=True)
     
     # Register blueprints
     from app.routes import auth, main, admin, user, tasks, chat, dashboard, api, favicon, meetings
@@ -109,9 +168,6 @@ def create_app(config_name='development'):
     main_routes = [r.rule for r in app.url_map.iter_rules() if r.endpoint.startswith('main.')]
     print(f" Main blueprint routes: {main_routes}")
     
-    # Register Socket.IO events
-    from app.sockets import chat_events, notification_events
-    
     # Error handlers
     @app.errorhandler(404)
     def not_found_error(error):
@@ -132,6 +188,9 @@ def create_app(config_name='development'):
     # Add built-in functions to Jinja environment
     app.jinja_env.globals.update(min=min, max=max)
     
+    from app.utils.images import avatar_url, image_url
+    app.jinja_env.globals.update(avatar_url=avatar_url, image_url=image_url)
+    
     # Context processors
     @app.context_processor
     def inject_globals():
@@ -4,7 +4,8 @@ SQLite advanced features implementation
 """
 
 from app import db
-from sqlalchemy import event, text
+from sqlalchemy import event, text, bindparam, inspect
+import json
 from app.models import Task, User, AnalyticsReport, AuditLog
 
 
@@ -15,8 +16,16 @@ def init_database_features(app):
         # Create all tables
         db.create_all()
         
+        # Add columns introduced after the tables were first created
+        upgrade_schema()
+        
         # Create triggers
         create_triggers()
+        create_task_timestamp_strategy()
+        create_blob_ref_triggers()
+        
+        # Create the chat search index
+        create_search_index()
         
         # Create views
         create_views()
@@ -27,21 +36,224 @@ def init_database_features(app):
         print("Database initialized with advanced features")
 
 
-def create_triggers():
-    """Create database triggers"""
+# Columns added to existing tables since their first release
+# (db.create_all() only creates missing tables, not missing columns)
+ADDED_COLUMNS = {
+    'tasks': {
+        'completed_count': 'INTEGER DEFAULT 0',
+        'total_count': 'INTEGER DEFAULT 0',
+    },
+    'task_attachments': {
+        'content_hash': 'VARCHAR(64)',
+    },
+    'meeting_attachments': {
+        'content_hash': 'VARCHAR(64)',
+    },
+    'messages': {
+        'attachment_hash': 'VARCHAR(64)',
+        'attachment_size': 'INTEGER',
+        'commit_seq': 'INTEGER',
+    },
+    'archived_messages': {
+        'commit_seq': 'INTEGER',
+    },
+    'task_history': {
+        'changes': 'TEXT',
+    },
+    'channel_members': {
+        'last_message_id': 'INTEGER REFERENCES messages(id) ON DELETE SET NULL',
+        'last_activity_at': 'DATETIME',
+        'unread_count': 'INTEGER NOT NULL DEFAULT 0',
+        'last_read_message_id': 'INTEGER',
+        'last_delivered_message_id': 'INTEGER',
+        'last_read_at': 'DATETIME',
+        'last_delivered_at': 'DATETIME',
+    },
+    'conversations': {
+        'last_read_message_id': 'INTEGER',
+        'last_delivered_message_id': 'INTEGER',
+        'last_read_at': 'DATETIME',
+        'last_delivered_at': 'DATETIME',
+    },
+    'organisations': {
+        'message_archive_days': 'INTEGER',
+        'max_upload_size': 'INTEGER',
+    },
+}
+
+# Statements filling a column from ADDED_COLUMNS right after it was added
+COLUMN_BACKFILLS = {
+    (table, f'last_{mark}_at'): f"""
+        UPDATE {table} SET last_{mark}_at = (
+            SELECT created_at FROM messages WHERE messages.id = {table}.last_{mark}_message_id
+        )
+        WHERE last_{mark}_message_id IS NOT NULL
+    """
+    for table in ('conversations', 'channel_members') for mark in ('read', 'delivered')
+}
+# Existing messages were committed in no known order; their ids stand in for it
+COLUMN_BACKFILLS.update({
+    (table, 'commit_seq'): f"UPDATE {table} SET commit_seq = id"
+    for table in ('messages', 'archived_messages')
+})
+
+
+def upgrade_schema():
+    """Add any columns from ADDED_COLUMNS missing in an existing database"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    
+    for table, columns in ADDED_COLUMNS.items():
+        if table not in tables:
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table)}
+        for column, ddl in columns.items():
+            if column not in existing:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                if (table, column) in COLUMN_BACKFILLS:
+                    db.session.execute(text(COLUMN_BACKFILLS[table, column]))
     
-    # Trigger 1: Auto-update analytics when task is completed
-    trigger_task_completion = """
-    CREATE TRIGGER IF NOT EXISTS update_analytics_on_task_completion
-    AFTER UPDATE OF status ON tasks
-    WHEN NEW.status = 'done' AND OLD.status != 'done'
+    db.session.commit()
+
+
+# Triggers dropped on startup: superseded versions and the task timestamp
+# triggers whose extra UPDATE doubled every task write
+REPLACED_TRIGGERS = [
+    'update_task_hours_on_time_log',
+    'update_task_hours_on_time_log_update',
+    'update_task_hours_on_time_log_delete',
+    'update_task_timestamp',
+    'update_analytics_on_task_completion',
+]
+
+# PostgreSQL can rewrite NEW in a BEFORE trigger, so stamping costs no extra
+# write. Values the ORM already set (onupdate, Task.status validator) are kept
+POSTGRES_TASK_TIMESTAMP_TRIGGER = [
+    """
+    CREATE OR REPLACE FUNCTION set_task_timestamps() RETURNS trigger AS $$
     BEGIN
-        -- This trigger fires when a task is marked as done
-        UPDATE tasks SET completed_date = CURRENT_TIMESTAMP WHERE id = NEW.id;
+        IF NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+            NEW.updated_at := now();
+        END IF;
+        IF NEW.status = 'done' AND OLD.status IS DISTINCT FROM 'done'
+           AND NEW.completed_date IS NOT DISTINCT FROM OLD.completed_date THEN
+            NEW.completed_date := now();
+        END IF;
+        RETURN NEW;
     END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS set_task_timestamps ON tasks",
+    """
+    CREATE TRIGGER set_task_timestamps
+    BEFORE UPDATE ON tasks
+    FOR EACH ROW EXECUTE FUNCTION set_task_timestamps()
+    """,
+]
+
+
+def create_task_timestamp_strategy():
+    """
+    Keep tasks.updated_at and completed_date current with one row write per update.
+
+    SQLite cannot modify NEW in a BEFORE trigger, and an AFTER trigger has to
+    issue a second UPDATE, so there the ORM does it: Task.updated_at has an
+    onupdate default and the Task.status validator stamps completed_date.
+    PostgreSQL gets a BEFORE UPDATE trigger as well so raw SQL updates are
+    covered.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        for statement in POSTGRES_TASK_TIMESTAMP_TRIGGER:
+            db.session.execute(text(statement))
+        db.session.commit()
+
+
+def blob_ref_triggers(dialect_name):
     """
+    Statements keeping file_blobs.ref_count in step with every row that
+    references a blob (BLOB_REFERENCES): inserts add one, deletes take it back.
+    PostgreSQL runs trigger functions, one per referencing table.
+    """
+    from app.utils.storage import BLOB_REFERENCES
+    statements = []
+    for table, hash_column, _ in BLOB_REFERENCES:
+        if dialect_name == 'postgresql':
+            statements += [
+                f"""
+                CREATE OR REPLACE FUNCTION blob_ref_{table}() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        IF NEW.{hash_column} IS NOT NULL THEN
+                            UPDATE file_blobs SET ref_count = ref_count + 1 WHERE sha256 = NEW.{hash_column};
+                        END IF;
+                        RETURN NEW;
+                    END IF;
+                    IF OLD.{hash_column} IS NOT NULL THEN
+                        UPDATE file_blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.{hash_column};
+                    END IF;
+                    RETURN OLD;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                f"DROP TRIGGER IF EXISTS blob_ref_{table} ON {table}",
+                f"""
+                CREATE TRIGGER blob_ref_{table}
+                AFTER INSERT OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION blob_ref_{table}()
+                """,
+            ]
+            continue
+        statements += [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS blob_ref_add_{table}
+            AFTER INSERT ON {table}
+            WHEN NEW.{hash_column} IS NOT NULL
+            BEGIN
+                UPDATE file_blobs SET ref_count = ref_count + 1 WHERE sha256 = NEW.{hash_column};
+            END;
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS blob_ref_remove_{table}
+            AFTER DELETE ON {table}
+            WHEN OLD.{hash_column} IS NOT NULL
+            BEGIN
+                UPDATE file_blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.{hash_column};
+            END;
+            """,
+        ]
+    return statements
+
+
+def create_blob_ref_triggers():
+    """Create the blob reference count triggers for the current database"""
+    for statement in blob_ref_triggers(db.engine.dialect.name):
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def check_task_timestamp_strategy():
+    """
+    Report task triggers that would write the row a second time.
+
+    Returns:
+        list: Names of SQLite AFTER UPDATE triggers on tasks that UPDATE tasks
+        again, duplicating what the ORM onupdate already does
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return []
+    rows = db.session.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'tasks'"
+    )).fetchall()
+    return [
+        name for name, sql in rows
+        if 'AFTER UPDATE' in sql.upper() and 'UPDATE TASKS SET' in ' '.join(sql.upper().split())
+    ]
+
+
+def create_triggers():
+    """Create database triggers"""
     
-    # Trigger 2: Log audit entry when user is created
+    # Trigger 1: Log audit entry when user is created
     trigger_user_creation = """
     CREATE TRIGGER IF NOT EXISTS log_user_creation
     AFTER INSERT ON users
@@ -56,31 +268,49 @@ def create_triggers():
     END;
     """
     
-    # Trigger 3: Update task updated_at timestamp
-    trigger_task_update = """
-    CREATE TRIGGER IF NOT EXISTS update_task_timestamp
-    AFTER UPDATE ON tasks
+    # Trigger 2: Maintain task actual hours from time logs by delta arithmetic
+    # (insert adds, update applies the difference, delete subtracts). updated_at
+    # is set in the same statement since no tasks trigger stamps it any more
+    trigger_time_log = """
+    CREATE TRIGGER IF NOT EXISTS update_task_hours_on_time_log
+    AFTER INSERT ON time_logs
+    WHEN NEW.duration IS NOT NULL
     BEGIN
-        UPDATE tasks SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+        UPDATE tasks 
+        SET actual_hours = COALESCE(actual_hours, 0) + NEW.duration,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = NEW.task_id;
     END;
     """
     
-    # Trigger 4: Auto-calculate task actual hours from time logs
-    trigger_time_log = """
-    CREATE TRIGGER IF NOT EXISTS update_task_hours_on_time_log
-    AFTER INSERT ON time_logs
+    trigger_time_log_update = """
+    CREATE TRIGGER IF NOT EXISTS update_task_hours_on_time_log_update
+    AFTER UPDATE OF duration, task_id ON time_logs
     BEGIN
         UPDATE tasks 
-        SET actual_hours = (
-            SELECT COALESCE(SUM(duration), 0) 
-            FROM time_logs 
-            WHERE task_id = NEW.task_id
-        )
+        SET actual_hours = COALESCE(actual_hours, 0) - COALESCE(OLD.duration, 0),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = OLD.task_id;
+        UPDATE tasks 
+        SET actual_hours = COALESCE(actual_hours, 0) + COALESCE(NEW.duration, 0),
+            updated_at = CURRENT_TIMESTAMP
         WHERE id = NEW.task_id;
     END;
     """
     
-    # Trigger 5: Create notification when task is assigned
+    trigger_time_log_delete = """
+    CREATE TRIGGER IF NOT EXISTS update_task_hours_on_time_log_delete
+    AFTER DELETE ON time_logs
+    WHEN OLD.duration IS NOT NULL
+    BEGIN
+        UPDATE tasks 
+        SET actual_hours = COALESCE(actual_hours, 0) - OLD.duration,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = OLD.task_id;
+    END;
+    """
+    
+    # Trigger 3: Create notification when task is assigned
     trigger_task_assignment = """
     CREATE TRIGGER IF NOT EXISTS notify_task_assignment
     AFTER INSERT ON task_assignees
@@ -102,10 +332,13 @@ def create_triggers():
     """
     
     try:
-        db.session.execute(text(trigger_task_completion))
+        # Replaced triggers are dropped so older databases pick up the new versions
+        for trigger_name in REPLACED_TRIGGERS:
+            db.session.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name}"))
         db.session.execute(text(trigger_user_creation))
-        db.session.execute(text(trigger_task_update))
         db.session.execute(text(trigger_time_log))
+        db.session.execute(text(trigger_time_log_update))
+        db.session.execute(text(trigger_time_log_delete))
         db.session.execute(text(trigger_task_assignment))
         db.session.commit()
         print("✓ Database triggers created successfully")
@@ -114,6 +347,127 @@ def create_triggers():
         db.session.rollback()
 
 
+# FTS5 index over message content. External content: the text lives only in
+# messages and snippet() reads it back by rowid. channel_id, sender_id and
+# recipient_id are UNINDEXED columns, there to filter matches by conversation
+MESSAGE_SEARCH_TABLE = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    content,
+    channel_id UNINDEXED,
+    sender_id UNINDEXED,
+    recipient_id UNINDEXED,
+    content='messages',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+)
+"""
+
+# Keep messages_fts in step with every write to messages, ORM or raw SQL.
+# Soft-deleted messages are left out, so an external-content 'delete' is
+# only issued for rows that were indexed
+MESSAGE_SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+    AFTER INSERT ON messages
+    WHEN COALESCE(NEW.is_deleted, 0) = 0
+    BEGIN
+        INSERT INTO messages_fts (rowid, content, channel_id, sender_id, recipient_id)
+        VALUES (NEW.id, NEW.content, NEW.channel_id, NEW.sender_id, NEW.recipient_id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update
+    AFTER UPDATE OF content, is_deleted, channel_id, sender_id, recipient_id ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, channel_id, sender_id, recipient_id)
+        SELECT 'delete', OLD.id, OLD.content, OLD.channel_id, OLD.sender_id, OLD.recipient_id
+        WHERE COALESCE(OLD.is_deleted, 0) = 0;
+        INSERT INTO messages_fts (rowid, content, channel_id, sender_id, recipient_id)
+        SELECT NEW.id, NEW.content, NEW.channel_id, NEW.sender_id, NEW.recipient_id
+        WHERE COALESCE(NEW.is_deleted, 0) = 0;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete
+    AFTER DELETE ON messages
+    WHEN COALESCE(OLD.is_deleted, 0) = 0
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, channel_id, sender_id, recipient_id)
+        VALUES ('delete', OLD.id, OLD.content, OLD.channel_id, OLD.sender_id, OLD.recipient_id);
+    END;
+    """,
+]
+
+# Same index over the archive. Archived rows are only ever inserted by the
+# archival job and deleted with their user or channel, so no update trigger
+ARCHIVE_SEARCH_TABLE = MESSAGE_SEARCH_TABLE.replace(
+    'messages_fts', 'archived_messages_fts'
+).replace("content='messages'", "content='archived_messages'")
+
+ARCHIVE_SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS archived_messages_fts_insert
+    AFTER INSERT ON archived_messages
+    WHEN COALESCE(NEW.is_deleted, 0) = 0
+    BEGIN
+        INSERT INTO archived_messages_fts (rowid, content, channel_id, sender_id, recipient_id)
+        VALUES (NEW.id, NEW.content, NEW.channel_id, NEW.sender_id, NEW.recipient_id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archived_messages_fts_delete
+    AFTER DELETE ON archived_messages
+    WHEN COALESCE(OLD.is_deleted, 0) = 0
+    BEGIN
+        INSERT INTO archived_messages_fts (archived_messages_fts, rowid, content, channel_id, sender_id, recipient_id)
+        VALUES ('delete', OLD.id, OLD.content, OLD.channel_id, OLD.sender_id, OLD.recipient_id);
+    END;
+    """,
+]
+
+# (index, indexed table, CREATE statement, triggers)
+SEARCH_INDEXES = [
+    ('messages_fts', 'messages', MESSAGE_SEARCH_TABLE, MESSAGE_SEARCH_TRIGGERS),
+    ('archived_messages_fts', 'archived_messages', ARCHIVE_SEARCH_TABLE, ARCHIVE_SEARCH_TRIGGERS),
+]
+
+
+def create_search_index():
+    """
+    Create the messages_fts and archived_messages_fts full-text indexes and
+    the triggers that maintain them.
+
+    SQLite only (and only when built with FTS5); elsewhere chat search falls
+    back to a LIKE scan. A new index is filled from the existing messages
+    once; afterwards the triggers update it incrementally.
+    """
+    from flask import current_app
+    
+    if db.engine.dialect.name != 'sqlite':
+        return
+    
+    try:
+        for index, table, create_sql, triggers in SEARCH_INDEXES:
+            exists = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+            ), {'name': index}).first() is not None
+            if not exists:
+                db.session.execute(text(create_sql))
+                db.session.execute(text(f"""
+                    INSERT INTO {index} (rowid, content, channel_id, sender_id, recipient_id)
+                    SELECT id, content, channel_id, sender_id, recipient_id
+                    FROM {table} WHERE COALESCE(is_deleted, 0) = 0
+                """))
+            for trigger_sql in triggers:
+                db.session.execute(text(trigger_sql))
+        db.session.commit()
+        current_app.extensions['message_search_fts'] = True
+    except Exception as e:
+        print(f"Error creating search index: {e}")
+        db.session.rollback()
+
+
 def create_views():
     """Create database views"""
     
@@ -247,10 +601,19 @@ def create_indexes():
         "CREATE INDEX IF NOT EXISTS idx_tasks_priority ON tasks(priority);",
         "CREATE INDEX IF NOT EXISTS idx_tasks_due_date ON tasks(due_date);",
         "CREATE INDEX IF NOT EXISTS idx_tasks_department ON tasks(department_id);",
+        "CREATE INDEX IF NOT EXISTS idx_task_history_task_created ON task_history(task_id, created_at);",
         "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);",
         "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);",
         "CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages(recipient_id);",
+        "CREATE INDEX IF NOT EXISTS idx_messages_commit_seq ON messages(commit_seq);",
+        "CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at, id);",
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair_created ON messages(sender_id, recipient_id, created_at, id);",
+        "CREATE INDEX IF NOT EXISTS idx_archived_messages_channel_created ON archived_messages(channel_id, created_at, id);",
+        "CREATE INDEX IF NOT EXISTS idx_archived_messages_pair_created ON archived_messages(sender_id, recipient_id, created_at, id);",
+        "CREATE INDEX IF NOT EXISTS idx_channel_members_user_activity ON channel_members(user_id, last_activity_at);",
         "CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, is_read);",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_user_id ON notifications(user_id, id);",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_partner ON conversations(partner_id);",
         "CREATE INDEX IF NOT EXISTS idx_audit_logs_created ON audit_logs(created_at);",
         "CREATE INDEX IF NOT EXISTS idx_users_organisation ON users(organisation_id);",
         "CREATE INDEX IF NOT EXISTS idx_users_department ON users(department_id);",
@@ -266,6 +629,122 @@ def create_indexes():
         db.session.rollback()
 
 
+def migrate_deliverables_to_table():
+    """Move legacy JSON deliverables from tasks.deliverables into task_deliverables rows.
+    
+    Adds the count columns to existing task tables, inserts all items with one
+    executemany and clears the JSON so the migration can be re-run safely.
+    Returns the number of tasks migrated.
+    """
+    from app.models import TaskDeliverable
+    from datetime import datetime
+    
+    upgrade_schema()
+    TaskDeliverable.__table__.create(db.session.connection(), checkfirst=True)
+    
+    rows = db.session.execute(
+        text("SELECT id, deliverables FROM tasks WHERE deliverables IS NOT NULL")
+    ).fetchall()
+    
+    now = datetime.utcnow()
+    items = []
+    counts = []
+    for task_id, raw in rows:
+        try:
+            deliverables = json.loads(raw) if raw else []
+        except ValueError:
+            deliverables = []
+        
+        total = completed = 0
+        for item in deliverables if isinstance(deliverables, list) else []:
+            item_text = str(item.get('text', '')).strip() if isinstance(item, dict) else ''
+            if not item_text:
+                continue
+            is_completed = bool(item.get('completed', False))
+            items.append({
+                'task_id': task_id,
+                'text': item_text,
+                'is_completed': is_completed,
+                'position': total,
+                'completed_at': now if is_completed else None,
+                'created_at': now
+            })
+            total += 1
+            completed += int(is_completed)
+        counts.append({'task_id': task_id, 'total': total, 'completed': completed})
+    
+    if items:
+        db.session.execute(TaskDeliverable.__table__.insert(), items)
+    if counts:
+        db.session.execute(
+            text("""
+                UPDATE tasks
+                SET total_count = :total, completed_count = :completed, deliverables = NULL
+                WHERE id = :task_id
+            """),
+            counts
+        )
+    db.session.commit()
+    
+    return len(counts)
+
+
+def backfill_conversations():
+    """Rebuild conversation summaries from existing messages.
+    
+    Fills conversations for every direct message pair and the last message /
+    activity of every channel membership. Read and delivery marks and unread
+    counts come from the legacy per-message flags for direct messages;
+    channel members start fully read.
+    Safe to re-run. Returns the number of conversation rows written.
+    """
+    from app.models import Conversation
+    
+    upgrade_schema()
+    Conversation.__table__.create(db.session.connection(), checkfirst=True)
+    
+    db.session.execute(text("DELETE FROM conversations"))
+    result = db.session.execute(text("""
+        INSERT INTO conversations (user_id, partner_id, last_message_id, last_activity_at, unread_count,
+                                   last_read_message_id, last_delivered_message_id,
+                                   last_read_at, last_delivered_at)
+        SELECT owner_id, partner_id, MAX(id), MAX(created_at),
+               SUM(CASE WHEN recipient_id = owner_id AND sender_id != owner_id AND is_read = 0 THEN 1 ELSE 0 END),
+               MAX(CASE WHEN recipient_id = owner_id AND is_read = 1 THEN id END),
+               MAX(CASE WHEN recipient_id = owner_id AND (is_delivered = 1 OR is_read = 1) THEN id END),
+               MAX(CASE WHEN recipient_id = owner_id AND is_read = 1 THEN created_at END),
+               MAX(CASE WHEN recipient_id = owner_id AND (is_delivered = 1 OR is_read = 1) THEN created_at END)
+        FROM (
+            SELECT id, created_at, sender_id, recipient_id, is_read, is_delivered,
+                   sender_id AS owner_id, recipient_id AS partner_id
+            FROM messages WHERE channel_id IS NULL AND recipient_id IS NOT NULL
+            UNION ALL
+            SELECT id, created_at, sender_id, recipient_id, is_read, is_delivered,
+                   recipient_id AS owner_id, sender_id AS partner_id
+            FROM messages WHERE channel_id IS NULL AND recipient_id IS NOT NULL AND recipient_id != sender_id
+        ) AS pairs
+        GROUP BY owner_id, partner_id
+    """))
+    db.session.execute(text("""
+        UPDATE channel_members
+        SET last_message_id = (
+                SELECT MAX(id) FROM messages WHERE messages.channel_id = channel_members.channel_id
+            ),
+            last_activity_at = (
+                SELECT MAX(created_at) FROM messages WHERE messages.channel_id = channel_members.channel_id
+            ),
+            unread_count = 0
+    """))
+    db.session.execute(text("""
+        UPDATE channel_members
+        SET last_read_message_id = last_message_id, last_delivered_message_id = last_message_id,
+            last_read_at = last_activity_at, last_delivered_at = last_activity_at
+    """))
+    db.session.commit()
+    
+    return result.rowcount
+
+
 # SQL Functions (implemented as Python functions due to SQLite limitations)
 def calculate_department_completion_percentage(department_id):
     """Calculate completion percentage for a department"""
@@ -286,33 +765,58 @@ def calculate_department_completion_percentage(department_id):
     return result[0] if result else 0.0
 
 
-def assign_task_to_least_loaded_user(department_id, task_id):
-    """Assign task to user with least number of active tasks in department"""
-    result = db.session.execute(
+def check_task_hours_consistency(fix=False):
+    """Compare stored task actual hours against the sum of their time logs.
+    
+    Returns a list of (task_id, stored_hours, derived_hours) for every task
+    whose stored value has drifted. With fix=True the drifted rows are
+    re-derived in a single UPDATE.
+    """
+    rows = db.session.execute(
         text("""
-            SELECT u.id, COUNT(ta.task_id) as task_count
-            FROM users u
-            LEFT JOIN task_assignees ta ON u.id = ta.user_id
-            LEFT JOIN tasks t ON ta.task_id = t.id AND t.status != 'done'
-            WHERE u.department_id = :dept_id AND u.is_active = 1
-            GROUP BY u.id
-            ORDER BY task_count ASC
-            LIMIT 1
-        """),
-        {'dept_id': department_id}
-    ).fetchone()
+            SELECT t.id, COALESCE(t.actual_hours, 0), COALESCE(tl.total, 0)
+            FROM tasks t
+            LEFT JOIN (
+                SELECT task_id, SUM(duration) as total
+                FROM time_logs
+                GROUP BY task_id
+            ) tl ON tl.task_id = t.id
+            WHERE ABS(COALESCE(t.actual_hours, 0) - COALESCE(tl.total, 0)) > 1e-6
+        """)
+    ).fetchall()
     
-    if result:
-        user_id = result[0]
-        # Assign the task
+    drifted = [(row[0], row[1], row[2]) for row in rows]
+    
+    if fix and drifted:
         db.session.execute(
-            text("INSERT INTO task_assignees (task_id, user_id) VALUES (:task_id, :user_id)"),
-            {'task_id': task_id, 'user_id': user_id}
+            text("""
+                UPDATE tasks
+                SET actual_hours = (
+                    SELECT COALESCE(SUM(duration), 0)
+                    FROM time_logs
+                    WHERE task_id = tasks.id
+                )
+                WHERE id IN :task_ids
+            """).bindparams(bindparam('task_ids', expanding=True)),
+            {'task_ids': [task_id for task_id, _, _ in drifted]}
         )
         db.session.commit()
-        return user_id
     
-    return None
+    return drifted
+
+
+def assign_task_to_least_loaded_user(department_id, task_id):
+    """Assign task to user with least open workload in department"""
+    from app.models import Task
+    from app.utils.assignment import assign_tasks
+    
+    task = db.session.get(Task, task_id)
+    if task is None:
+        return None
+    
+    user_id = assign_tasks([task], strategy='least_loaded', department_id=department_id).get(task_id)
+    db.session.commit()
+    return user_id
 
 
 def get_user_productivity_stats(user_id, start_date=None, end_date=None):
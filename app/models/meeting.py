@@ -2,6 +2,7 @@
 Meeting Management Models
 """
 
+from flask import url_for
 from app import db
 from datetime import datetime
 
@@ -176,6 +177,7 @@ class MeetingAttachment(db.Model):
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.Integer)
     mime_type = db.Column(db.String(100))
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the stored blob
     
     uploaded_by_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -196,5 +198,9 @@ class MeetingAttachment(db.Model):
             size /= 1024.0
         return f"{size:.1f} TB"
     
+    def get_url(self):
+        """Return the URL the attachment is downloaded from"""
+        return url_for('meetings.download_attachment', attachment_id=self.id)
+    
     def __repr__(self):
         return f'<MeetingAttachment {self.filename}>'
@@ -6,9 +6,8 @@ from app import db
 from datetime import datetime
 
 
-class Message(db.Model):
-    """Direct and group messages"""
-    __tablename__ = 'messages'
+class MessageMixin:
+    """Columns and helpers shared by hot messages and their archived copies"""
     
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -22,11 +21,14 @@ class Message(db.Model):
     # File/image attachment
     attachment_path = db.Column(db.String(500))
     attachment_filename = db.Column(db.String(255))
+    attachment_hash = db.Column(db.String(64), index=True)  # SHA-256 of the stored blob
+    attachment_size = db.Column(db.Integer)  # Size in bytes
     
     # Task card reference (if message_type is task_card)
     task_card_id = db.Column(db.Integer, db.ForeignKey('tasks.id', ondelete='SET NULL'))
     
-    # Status
+    # Status (legacy per-message flags; ticks now come from the recipient's
+    # read/delivery marks on conversations and channel_members)
     is_delivered = db.Column(db.Boolean, default=False)  # Single tick
     delivered_at = db.Column(db.DateTime)
     is_read = db.Column(db.Boolean, default=False)  # Double tick
@@ -38,11 +40,8 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Relationships
-    sender = db.relationship('User', foreign_keys=[sender_id], back_populates='sent_messages')
-    recipient = db.relationship('User', foreign_keys=[recipient_id], back_populates='received_messages')
-    channel = db.relationship('ChatChannel', back_populates='messages')
-    task_card = db.relationship('Task')
+    # Position in commit order, taken in the inserting transaction (reconnect sync cursor)
+    commit_seq = db.Column(db.Integer, index=True)
     
     def mark_as_read(self):
         """Mark message as read"""
@@ -59,10 +58,60 @@ class Message(db.Model):
             self.is_delivered = True
             self.delivered_at = datetime.utcnow()
     
+    def get_thumbnail_url(self):
+        """Return the URL of the resized chat image, falling back to the original"""
+        if self.attachment_hash:
+            return f'{self.attachment_path}?variant=thumb'
+        return self.attachment_path
+
+
+class Message(MessageMixin, db.Model):
+    """Direct and group messages"""
+    __tablename__ = 'messages'
+    
+    is_archived = False
+    
+    # Relationships
+    sender = db.relationship('User', foreign_keys='Message.sender_id', back_populates='sent_messages')
+    recipient = db.relationship('User', foreign_keys='Message.recipient_id', back_populates='received_messages')
+    channel = db.relationship('ChatChannel', back_populates='messages')
+    task_card = db.relationship('Task')
+    
     def __repr__(self):
         return f'<Message {self.id}>'
 
 
+class ArchivedMessage(MessageMixin, db.Model):
+    """
+    Message moved out of the hot messages table by the archival job
+    (app/utils/archive.py); same columns and ids, read back by history
+    paging, search and attachment downloads
+    """
+    __tablename__ = 'archived_messages'
+    
+    is_archived = True
+    
+    # Relationships
+    sender = db.relationship('User', foreign_keys='ArchivedMessage.sender_id', viewonly=True)
+    recipient = db.relationship('User', foreign_keys='ArchivedMessage.recipient_id', viewonly=True)
+    channel = db.relationship('ChatChannel', viewonly=True)
+    task_card = db.relationship('Task', viewonly=True)
+    
+    def __repr__(self):
+        return f'<ArchivedMessage {self.id}>'
+
+
+class IdSequence(db.Model):
+    """Next free id of a table whose ids are handed out before its rows are written"""
+    __tablename__ = 'id_sequences'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<IdSequence {self.name}={self.next_id}>'
+
+
 class ChatChannel(db.Model):
     """Group chat channels (department-based or project-based)"""
     __tablename__ = 'chat_channels'
@@ -94,13 +143,52 @@ class ChatChannel(db.Model):
 
 
 # Association table for channel members
+# The last_* and unread columns summarise the channel for that member (see Conversation)
 channel_members = db.Table('channel_members',
     db.Column('channel_id', db.Integer, db.ForeignKey('chat_channels.id', ondelete='CASCADE'), primary_key=True),
     db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('joined_at', db.DateTime, default=datetime.utcnow)
+    db.Column('joined_at', db.DateTime, default=datetime.utcnow),
+    db.Column('last_message_id', db.Integer, db.ForeignKey('messages.id', ondelete='SET NULL')),
+    db.Column('last_activity_at', db.DateTime),
+    db.Column('unread_count', db.Integer, default=0, nullable=False, server_default='0'),
+    db.Column('last_read_message_id', db.Integer),
+    db.Column('last_delivered_message_id', db.Integer),
+    db.Column('last_read_at', db.DateTime),  # created_at of the marked messages, see Conversation
+    db.Column('last_delivered_at', db.DateTime)
 )
 
 
+class Conversation(db.Model):
+    """Per-user summary of a direct message conversation, kept current on send"""
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'partner_id', name='uq_conversations_user_partner'),
+        db.Index('idx_conversations_user_activity', 'user_id', 'last_activity_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    partner_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='SET NULL'))
+    last_activity_at = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    
+    # High-water marks of what user_id has received and read from partner_id.
+    # Messages are ordered by (created_at, id), so each mark keeps both
+    last_read_message_id = db.Column(db.Integer)
+    last_delivered_message_id = db.Column(db.Integer)
+    last_read_at = db.Column(db.DateTime)
+    last_delivered_at = db.Column(db.DateTime)
+    
+    # Relationships
+    user = db.relationship('User', foreign_keys=[user_id])
+    partner = db.relationship('User', foreign_keys=[partner_id])
+    last_message = db.relationship('Message')
+    
+    def __repr__(self):
+        return f'<Conversation user_id={self.user_id} partner_id={self.partner_id}>'
+
+
 class Notification(db.Model):
     """User notifications"""
     __tablename__ = 'notifications'
@@ -139,7 +227,11 @@ class Notification(db.Model):
 
 
 class OnlineStatus(db.Model):
-    """Track user online/offline status"""
+    """Track user online/offline status.
+    
+    Live presence is counted in memory by app.utils.presence; this table
+    gets last_seen in batches and is not updated on every connect.
+    """
     __tablename__ = 'online_status'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -163,7 +255,11 @@ class OnlineStatus(db.Model):
 
 
 class TypingIndicator(db.Model):
-    """Temporary typing indicators for real-time chat"""
+    """Temporary typing indicators for real-time chat.
+    
+    No longer written: typing state lives in the TTL store of
+    app.utils.typing_indicators. The table is kept for existing databases.
+    """
     __tablename__ = 'typing_indicators'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,45 @@
+"""
+File Storage Models
+"""
+
+from app import db
+from datetime import datetime
+
+
+class FileBlob(db.Model):
+    """Content-addressed file stored once and shared by every attachment with the same bytes"""
+    __tablename__ = 'file_blobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, unique=True)
+    size = db.Column(db.Integer, nullable=False)  # Size in bytes
+    storage_path = db.Column(db.String(500), nullable=False)  # Relative to STORAGE_FOLDER
+    mime_type = db.Column(db.String(100))
+    
+    # Number of attachment rows pointing at this blob (maintained by triggers)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FileBlob {self.sha256[:12]}>'
+
+
+class UploadSession(db.Model):
+    """Resumable chunked upload; the bytes received so far live in STORAGE_FOLDER/uploads/<id>"""
+    __tablename__ = 'upload_sessions'
+    
+    id = db.Column(db.String(32), primary_key=True)  # Random hex token handed to the client
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    original_filename = db.Column(db.String(255), nullable=False)
+    mime_type = db.Column(db.String(100))
+    size = db.Column(db.Integer, nullable=False)  # Declared total size in bytes
+    received = db.Column(db.Integer, default=0, nullable=False)  # Bytes stored so far: the next chunk's offset
+    content_hash = db.Column(db.String(64))  # SHA-256 of the blob, set when finalized
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id}>'
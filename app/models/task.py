@@ -2,7 +2,11 @@
 Task and Project Management Models
 """
 
+from flask import url_for, has_request_context
+from flask_login import current_user
 from app import db
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import validates
 from datetime import datetime
 import json
 
@@ -42,8 +46,10 @@ class Task(db.Model):
     is_ai_generated = db.Column(db.Boolean, default=False)
     ai_metadata = db.Column(db.Text)  # JSON metadata from AI
     
-    # Deliverables (stored as JSON)
-    deliverables = db.Column(db.Text)  # JSON array of deliverable items
+    # Deliverables (rows in task_deliverables, counts denormalized for quick access)
+    deliverables = db.Column(db.Text)  # Legacy JSON array, moved to task_deliverables by migrate-deliverables
+    completed_count = db.Column(db.Integer, default=0)
+    total_count = db.Column(db.Integer, default=0)
     
     # Relationships
     creator = db.relationship('User', foreign_keys=[created_by_id], back_populates='created_tasks')
@@ -54,28 +60,47 @@ class Task(db.Model):
     comments = db.relationship('TaskComment', back_populates='task', cascade='all, delete-orphan', lazy='dynamic', order_by='TaskComment.created_at.desc()')
     attachments = db.relationship('TaskAttachment', back_populates='task', cascade='all, delete-orphan', lazy='dynamic')
     time_logs = db.relationship('TimeLog', back_populates='task', cascade='all, delete-orphan', lazy='dynamic')
+    deliverable_items = db.relationship('TaskDeliverable', back_populates='task', cascade='all, delete-orphan', lazy='dynamic', order_by='TaskDeliverable.position')
+    
+    @validates('status')
+    def validate_status(self, key, status):
+        """Stamp completed_date in the same UPDATE when a task moves to done"""
+        if status == 'done' and self.status is not None and self.status != 'done':
+            self.completed_date = datetime.utcnow()
+        return status
     
     def get_deliverables(self):
-        """Parse and return deliverables list"""
-        if self.deliverables:
-            try:
-                return json.loads(self.deliverables)
-            except:
-                return []
-        return []
+        """Return deliverables as a list of dicts"""
+        return [item.to_dict() for item in self.deliverable_items]
     
     def set_deliverables(self, items):
-        """Set deliverables from list"""
-        self.deliverables = json.dumps(items)
+        """Replace deliverables with the given list of {'text', 'completed'} items"""
+        if self.id:
+            TaskDeliverable.query.filter_by(task_id=self.id).delete(synchronize_session=False)
+        
+        total = completed = 0
+        for item in items:
+            text = str(item.get('text', '')).strip()
+            if not text:
+                continue
+            is_completed = bool(item.get('completed', False))
+            self.deliverable_items.append(TaskDeliverable(
+                text=text,
+                is_completed=is_completed,
+                position=total
+            ))
+            total += 1
+            completed += int(is_completed)
+        
+        self.total_count = total
+        self.completed_count = completed
     
     def get_completion_percentage(self):
-        """Calculate task completion percentage based on deliverables"""
-        deliverables = self.get_deliverables()
-        if not deliverables:
+        """Calculate task completion percentage from stored deliverable counts"""
+        if not self.total_count:
             return 100 if self.status == 'done' else 0
         
-        completed = sum(1 for item in deliverables if item.get('completed', False))
-        return int((completed / len(deliverables)) * 100)
+        return int(((self.completed_count or 0) / self.total_count) * 100)
     
     def is_overdue(self):
         """Check if task is overdue"""
@@ -84,14 +109,40 @@ class Task(db.Model):
         return False
     
     def get_time_spent(self):
-        """Get total time spent on task from time logs"""
-        total = sum(log.duration for log in self.time_logs if log.duration)
-        return total
+        """Get total time spent on task (maintained from time logs by triggers)"""
+        return self.actual_hours or 0.0
     
     def __repr__(self):
         return f'<Task {self.title}>'
 
 
+class TaskDeliverable(db.Model):
+    """Checklist item (deliverable) of a task"""
+    __tablename__ = 'task_deliverables'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('tasks.id', ondelete='CASCADE'), nullable=False, index=True)
+    text = db.Column(db.String(500), nullable=False)
+    is_completed = db.Column(db.Boolean, default=False)
+    position = db.Column(db.Integer, default=0)
+    completed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    task = db.relationship('Task', back_populates='deliverable_items')
+    
+    def to_dict(self):
+        """Serialize in the shape of the legacy JSON deliverables"""
+        return {
+            'id': self.id,
+            'text': self.text,
+            'completed': bool(self.is_completed)
+        }
+    
+    def __repr__(self):
+        return f'<TaskDeliverable {self.id}>'
+
+
 class TaskComment(db.Model):
     """Comments on tasks"""
     __tablename__ = 'task_comments'
@@ -124,6 +175,7 @@ class TaskAttachment(db.Model):
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.Integer)  # Size in bytes
     mime_type = db.Column(db.String(100))
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the stored blob
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id', ondelete='CASCADE'), nullable=False)
     uploaded_by_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -137,11 +189,16 @@ class TaskAttachment(db.Model):
         if not self.file_size:
             return "Unknown"
         
+        size = self.file_size
         for unit in ['B', 'KB', 'MB', 'GB']:
-            if self.file_size < 1024.0:
-                return f"{self.file_size:.1f} {unit}"
-            self.file_size /= 1024.0
-        return f"{self.file_size:.1f} TB"
+            if size < 1024.0:
+                return f"{size:.1f} {unit}"
+            size /= 1024.0
+        return f"{size:.1f} TB"
+    
+    def get_url(self):
+        """Return the URL the attachment is downloaded from"""
+        return url_for('tasks.download_attachment', attachment_id=self.id)
     
     def __repr__(self):
         return f'<TaskAttachment {self.filename}>'
@@ -186,11 +243,171 @@ class TaskHistory(db.Model):
     old_value = db.Column(db.Text)
     new_value = db.Column(db.Text)
     field_changed = db.Column(db.String(50))
+    changes = db.Column(db.Text)  # Compact JSON diff: {"status": [old, new], "tags": {"+": [ids], "-": [ids]}}
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     task = db.relationship('Task')
     user = db.relationship('User')
     
+    # Task columns and collections whose changes are captured at flush time
+    TRACKED_COLUMNS = ('title', 'status', 'priority', 'due_date')
+    TRACKED_COLLECTIONS = ('assignees', 'tags')
+    
+    @staticmethod
+    def make_row(task_id, user_id, changes, created_at, action=None):
+        """
+        Build a task_history row (a dict for executemany) from a diff.
+        
+        Single scalar changes also fill old_value/new_value/field_changed so
+        older readers keep working.
+        """
+        if action is None:
+            single = {'status': 'status_changed', 'assignees': 'assigned', 'tags': 'tagged'}
+            action = single.get(next(iter(changes)), 'updated') if len(changes) == 1 else 'updated'
+        row = {
+            'task_id': task_id,
+            'user_id': user_id,
+            'action': action,
+            'field_changed': ','.join(sorted(changes))[:50] or None,
+            'old_value': None,
+            'new_value': None,
+            'changes': json.dumps(changes, separators=(',', ':'), default=str) if changes else None,
+            'created_at': created_at
+        }
+        if len(changes) == 1:
+            value = next(iter(changes.values()))
+            if isinstance(value, list):
+                row['old_value'], row['new_value'] = (None if v is None else str(v) for v in value)
+        return row
+    
+    @staticmethod
+    def scalar_diff(old, new):
+        """Diff entry for a column: [old, new] with datetimes as ISO strings"""
+        return [value.isoformat() if isinstance(value, datetime) else value for value in (old, new)]
+    
+    @staticmethod
+    def collection_diff(old_ids, new_ids):
+        """Diff entry for a collection: ids added under '+', removed under '-'"""
+        added, removed = set(new_ids) - set(old_ids), set(old_ids) - set(new_ids)
+        return {sign: sorted(ids) for sign, ids in (('+', added), ('-', removed)) if ids}
+    
+    def get_changes(self):
+        """Return the diff as a dict"""
+        return json.loads(self.changes) if self.changes else {}
+    
+    def get_summary(self):
+        """Return a short human readable description of the diff"""
+        parts = []
+        for field, change in self.get_changes().items():
+            label = field.replace('_', ' ')
+            if isinstance(change, dict):
+                counts = [f'+{len(change[sign])}' if sign == '+' else f'\u2212{len(change[sign])}'
+                          for sign in ('+', '-') if change.get(sign)]
+                parts.append(f"{label} {' '.join(counts)}")
+            else:
+                old, new = change
+                parts.append(f'{label}: {old or "none"} \u2192 {new or "none"}')
+        return ', '.join(parts)
+    
     def __repr__(self):
         return f'<TaskHistory {self.action}>'
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# active_history loads the previous value on assignment, so the flush-time
+# diff has an old value even when the attribute was expired by a commit
+for _column in TaskHistory.TRACKED_COLUMNS:
+    event.listen(getattr(Task, _column), 'set', _load_old_value, active_history=True, retval=True)
+
+
+def _history_user_id(session):
+    """Acting user: explicit session.info override, else the logged in user"""
+    if 'history_user_id' in session.info:
+        return session.info['history_user_id']
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+
+def _merge_changes(pending, changes):
+    """Fold the diff of a later flush into the diff collected so far"""
+    for key, change in changes.items():
+        previous = pending.get(key)
+        if previous is None:
+            pending[key] = change
+        elif isinstance(change, dict):
+            added = (set(previous.get('+', [])) - set(change.get('-', []))) | (set(change.get('+', [])) - set(previous.get('-', [])))
+            removed = (set(previous.get('-', [])) - set(change.get('+', []))) | (set(change.get('-', [])) - set(previous.get('+', [])))
+            pending[key] = {sign: sorted(ids) for sign, ids in (('+', added), ('-', removed)) if ids}
+            if not pending[key]:
+                del pending[key]
+        elif previous[0] == change[1]:
+            del pending[key]
+        else:
+            pending[key] = [previous[0], change[1]]
+
+
+@event.listens_for(db.session, 'after_flush')
+def capture_task_history(session, flush_context):
+    """Diff tracked Task attributes of every flushed task"""
+    pending = session.info.setdefault('task_history', {})
+    
+    for obj in session.new:
+        if isinstance(obj, Task):
+            pending[obj.id] = None  # created: the row itself is the initial state
+    
+    for obj in session.dirty:
+        if not isinstance(obj, Task) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        changes = {}
+        for key in TaskHistory.TRACKED_COLUMNS:
+            history = state.attrs[key].history
+            if history.added:
+                old = history.deleted[0] if history.deleted else None
+                new = history.added[0]
+                if old != new:
+                    changes[key] = TaskHistory.scalar_diff(old, new)
+        for key in TaskHistory.TRACKED_COLLECTIONS:
+            history = state.attrs[key].history
+            diff = TaskHistory.collection_diff(
+                [item.id for item in history.deleted], [item.id for item in history.added]
+            )
+            if diff:
+                changes[key] = diff
+        if changes and pending.get(obj.id, {}) is not None:
+            _merge_changes(pending.setdefault(obj.id, {}), changes)
+
+
+@event.listens_for(db.session, 'before_commit')
+def write_task_history(session):
+    """
+    Write the history collected by capture_task_history in one executemany.
+    
+    Autoflush can split one logical edit over several flushes (loading a
+    collection flushes the columns set before it), so diffs are merged per
+    task for the whole transaction and written once, in the final flush.
+    """
+    session.flush()
+    pending = session.info.pop('task_history', None)
+    if not pending:
+        return
+    
+    now = datetime.utcnow()
+    user_id = _history_user_id(session)
+    rows = [
+        TaskHistory.make_row(task_id, user_id, {}, now, action='created') if changes is None
+        else TaskHistory.make_row(task_id, user_id, changes, now)
+        for task_id, changes in pending.items() if changes != {}
+    ]
+    if rows:
+        session.connection().execute(TaskHistory.__table__.insert(), rows)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_task_history(session):
+    session.info.pop('task_history', None)
@@ -46,6 +46,8 @@ class Organisation(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    max_upload_size = db.Column(db.Integer)  # Largest chunked upload in bytes; None uses UPLOAD_MAX_SIZE
+    message_archive_days = db.Column(db.Integer)  # Chat messages older than this move to the archive; None uses MESSAGE_ARCHIVE_DAYS
     
     # Relationships
     users = db.relationship('User', back_populates='organisation', cascade='all, delete-orphan', lazy='dynamic')
@@ -198,6 +200,25 @@ class User(UserMixin, db.Model):
         """Check if user is manager"""
         return self.has_role('Manager') or self.has_role('Admin')
     
+    def can_access_task(self, task, assignee_ids=None):
+        """
+        Check if user can view a task and change its status. task may be a
+        plain row with department_id and created_by_id; assignee_ids then
+        replaces task.assignees
+        """
+        if assignee_ids is None:
+            assignee_ids = {user.id for user in task.assignees}
+        return (
+            self.is_admin()
+            or (self.is_manager() and task.department_id == self.department_id)
+            or self.id in assignee_ids
+            or task.created_by_id == self.id
+        )
+    
+    def can_edit_task(self, task):
+        """Check if user can edit a task"""
+        return self.is_manager() or task.created_by_id == self.id
+    
     @staticmethod
     def generate_random_password(length=12):
         """Generate a random password"""
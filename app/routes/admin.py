@@ -7,6 +7,7 @@ from flask_login import login_required, current_user
 from app import db
 from app.models import Organisation, Department, User, Role, Tag, AuditLog, Task
 from app.routes.auth import admin_required
+from app.utils.images import schedule_variants
 from werkzeug.utils import secure_filename
 import os
 from datetime import datetime
@@ -60,6 +61,7 @@ def organisation():
                 filename = f"org_{org.id}_{timestamp}_{filename}"
                 logo_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'logos', filename)
                 file.save(logo_path)
+                schedule_variants(logo_path, 'logo')
                 org.logo = f"/static/uploads/logos/{filename}"
         
         db.session.commit()
@@ -181,6 +183,7 @@ def create_user():
                 filename = f"user_{timestamp}_{filename}"
                 profile_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'profiles', filename)
                 file.save(profile_path)
+                schedule_variants(profile_path, 'avatar')
                 user.profile_picture = filename
         
         db.session.add(user)
@@ -286,6 +289,7 @@ def edit_user(user_id):
                 filename = f"user_{user.id}_{timestamp}_{filename}"
                 profile_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'profiles', filename)
                 file.save(profile_path)
+                schedule_variants(profile_path, 'avatar')
                 user.profile_picture = filename
         
         db.session.commit()
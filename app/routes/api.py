@@ -2,10 +2,15 @@
 API Blueprint - REST API endpoints
 """
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, current_app, abort
 from flask_login import login_required, current_user
 from app import db
-from app.models import Task, User, Department, Notification, Message
+from app.models import Task, User, Department, Notification, Message, UploadSession
+from app.utils.bulk_tasks import bulk_create_tasks, bulk_update_tasks
+from app.utils.assignment import suggest_assignees, STRATEGIES
+from app.utils.conversations import get_unread_counts, get_unread_total
+from app.utils.sync import sync_since
+from app.utils.storage import start_upload, write_upload_chunk, finalize_upload
 from datetime import datetime
 
 bp = Blueprint('api', __name__, url_prefix='/api/v1')
@@ -84,6 +89,87 @@ def update_task_api(task_id):
     return jsonify({'success': True, 'task_id': task.id})
 
 
+@bp.route('/tasks/bulk', methods=['POST'])
+@login_required
+def bulk_create_tasks_api():
+    """Create many tasks in one transaction (API)"""
+    if not current_user.is_manager():
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    items, atomic, error = _get_bulk_items()
+    if error:
+        return error
+    
+    results = bulk_create_tasks(items, current_user, atomic=atomic)
+    db.session.commit()
+    
+    return _bulk_response(results)
+
+
+@bp.route('/tasks/bulk', methods=['PATCH'])
+@login_required
+def bulk_update_tasks_api():
+    """Update status, fields, assignees and tags of many tasks in one transaction (API)"""
+    items, atomic, error = _get_bulk_items()
+    if error:
+        return error
+    
+    results = bulk_update_tasks(items, current_user, atomic=atomic)
+    db.session.commit()
+    
+    return _bulk_response(results)
+
+
+def _get_bulk_items():
+    """Read {"tasks": [...], "atomic": bool} from the request body"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('tasks') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list) or not items:
+        return None, False, (jsonify({'error': 'Expected a non-empty "tasks" array'}), 400)
+    
+    limit = current_app.config['BULK_TASK_LIMIT']
+    if len(items) > limit:
+        return None, False, (jsonify({'error': f'At most {limit} tasks per request'}), 413)
+    
+    return items, bool(data.get('atomic')), None
+
+
+def _bulk_response(results):
+    """Per-item results; 207 when only part of the batch was applied"""
+    failed = sum(1 for result in results if not result['success'])
+    status = 200 if not failed else (400 if failed == len(results) else 207)
+    return jsonify({
+        'results': results,
+        'succeeded': len(results) - failed,
+        'failed': failed
+    }), status
+
+
+@bp.route('/departments/<int:department_id>/suggested-assignees', methods=['GET'])
+@login_required
+def suggested_assignees(department_id):
+    """Suggest assignees for a new task by department workload (API)"""
+    department = Department.query.get_or_404(department_id)
+    if department.organisation_id != current_user.organisation_id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    strategy = request.args.get('strategy')
+    if strategy and strategy not in STRATEGIES:
+        return jsonify({'error': f'strategy must be one of {", ".join(STRATEGIES)}'}), 400
+    count = min(max(request.args.get('count', 3, type=int), 1), 20)
+    
+    users = suggest_assignees(department_id, count, strategy)
+    return jsonify({
+        'users': [{
+            'id': u.id,
+            'name': u.name,
+            'email': u.email,
+            'designation': u.designation
+        } for u in users]
+    })
+
+
 @bp.route('/notifications', methods=['GET'])
 @login_required
 def get_notifications():
@@ -130,13 +216,126 @@ def mark_notification_read_api(notif_id):
 @bp.route('/messages/unread-count', methods=['GET'])
 @login_required
 def unread_messages_count():
-    """Get unread messages count (API)"""
-    count = Message.query.filter_by(
-        recipient_id=current_user.id,
-        is_read=False
-    ).count()
+    """Get unread messages count, direct and channel, per conversation (API)"""
+    conversations = get_unread_counts(current_user.id)
     
-    return jsonify({'unread_count': count})
+    return jsonify({
+        'unread_count': sum(c['unread_count'] for c in conversations),
+        'conversations': conversations
+    })
+
+
+@bp.route('/sync', methods=['GET'])
+@login_required
+def sync():
+    """Messages, read state and notifications missed since a cursor (API)"""
+    limit = min(request.args.get('limit', current_app.config['SYNC_PAGE_SIZE'], type=int),
+                current_app.config['SYNC_PAGE_SIZE'])
+    
+    return jsonify(sync_since(
+        current_user.id,
+        message_seq=request.args.get('message_seq', type=int),
+        notification_id=request.args.get('notification_id', type=int),
+        limit=max(limit, 1)
+    ))
+
+
+@bp.route('/uploads', methods=['POST'])
+@login_required
+def start_upload_api():
+    """Open a resumable upload: {"filename", "size", "mime_type"} (API)"""
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or not data.get('filename'):
+        return jsonify({'error': 'Expected "filename" and an integer "size"'}), 400
+    
+    try:
+        upload = start_upload(current_user, data['filename'], size, data.get('mime_type'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    db.session.commit()
+    
+    return jsonify(_upload_data(upload)), 201
+
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload_api(upload_id):
+    """Offset to resume a resumable upload from (API)"""
+    return jsonify(_upload_data(_get_upload(upload_id)))
+
+
+@bp.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def put_upload_chunk_api(upload_id):
+    """
+    Store one chunk of a resumable upload (API).
+
+    The raw request body is the chunk; its offset comes in the Upload-Offset
+    header (or ?offset=) and must equal the bytes received so far, otherwise
+    409 with the expected offset.
+    """
+    upload = _get_upload(upload_id)
+    if upload.content_hash:
+        return jsonify({'error': 'Upload already finalized'}), 409
+    
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Expected an Upload-Offset header'}), 400
+    if request.content_length and request.content_length > current_app.config['UPLOAD_CHUNK_SIZE']:
+        return jsonify({'error': f"Chunks are at most {current_app.config['UPLOAD_CHUNK_SIZE']} bytes"}), 413
+    
+    try:
+        write_upload_chunk(upload, offset, request.stream)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), **_upload_data(upload)}), 409
+    db.session.commit()
+    
+    return jsonify(_upload_data(upload))
+
+
+@bp.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload_api(upload_id):
+    """
+    Store a completely received upload as a blob (API). The returned
+    upload_id is then passed to /chat/send or a task's upload form in place
+    of a file.
+    """
+    upload = _get_upload(upload_id)
+    try:
+        stored = finalize_upload(upload)
+    except ValueError as e:
+        return jsonify({'error': str(e), **_upload_data(upload)}), 409
+    db.session.commit()
+    
+    return jsonify({
+        **_upload_data(upload),
+        'sha256': stored['sha256'],
+        'filename': stored['original_filename'],
+        'mime_type': stored['mime_type']
+    })
+
+
+def _get_upload(upload_id):
+    """The current user's upload session, or 404"""
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+
+def _upload_data(upload):
+    return {
+        'upload_id': upload.id,
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE'],
+        'finalized': upload.content_hash is not None
+    }
 
 
 @bp.route('/users/search', methods=['GET'])
@@ -181,9 +380,7 @@ def get_stats():
             db.and_(Task.due_date < datetime.utcnow(), Task.status != 'done')
         ).count(),
         'unread_notifications': current_user.notifications.filter_by(is_read=False).count(),
-        'unread_messages': Message.query.filter_by(
-            recipient_id=current_user.id, is_read=False
-        ).count()
+        'unread_messages': get_unread_total(current_user.id)
     }
     
     if stats['total_tasks'] > 0:
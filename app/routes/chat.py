@@ -2,10 +2,18 @@
 Chat Blueprint - Messaging and communication
 """
 
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, abort, current_app
 from flask_login import login_required, current_user
 from app import db
-from app.models import Message, ChatChannel, User, Task
+from app.models import Message, ArchivedMessage, ChatChannel, User, Task
+from app.utils.storage import send_attachment
+from app.utils.search import search_messages
+from app.utils.message_persister import prepare_message, persist_message
+from app.utils.memberships import is_channel_member
+from app.utils.conversations import (
+    get_recent_conversations, get_channel_summaries, get_history,
+    advance_read, get_marks, emit_read_up_to, EPOCH
+)
 from datetime import datetime
 
 bp = Blueprint('chat', __name__, url_prefix='/chat')
@@ -15,37 +23,9 @@ bp = Blueprint('chat', __name__, url_prefix='/chat')
 @login_required
 def index():
     """Chat interface"""
-    # Get user's channels
-    channels = current_user.channels
-    
-    # Get recent direct messages (get the latest message for each conversation)
-    from sqlalchemy import func, case
-    
-    # Get all messages where current user is involved
-    all_messages = Message.query.filter(
-        db.or_(
-            Message.sender_id == current_user.id,
-            Message.recipient_id == current_user.id
-        ),
-        Message.channel_id.is_(None)  # Only direct messages, not channel messages
-    ).order_by(Message.created_at.desc()).all()
-    
-    # Group by conversation partner and keep only the latest message per person
-    seen_users = set()
-    recent_dms = []
-    
-    for msg in all_messages:
-        # Determine the other user in the conversation
-        other_user_id = msg.recipient_id if msg.sender_id == current_user.id else msg.sender_id
-        
-        # Only add if we haven't seen this user yet
-        if other_user_id not in seen_users:
-            seen_users.add(other_user_id)
-            recent_dms.append(msg)
-            
-            # Limit to 10 most recent conversations
-            if len(recent_dms) >= 10:
-                break
+    # Both lists read the per-user summaries kept current by the send path
+    channels = get_channel_summaries(current_user.id)
+    recent_dms = get_recent_conversations(current_user.id, limit=10)
     
     # Get all users in organisation for new message modal
     all_users = User.query.filter_by(
@@ -63,21 +43,22 @@ def channel(channel_id):
     channel = ChatChannel.query.get_or_404(channel_id)
     
     # Check if user is member
-    if current_user not in channel.members:
+    if not is_channel_member(current_user.id, channel.id):
         flash('You are not a member of this channel.', 'danger')
         return redirect(url_for('chat.index'))
     
-    # Get messages
-    messages = channel.messages.order_by(Message.created_at.asc()).limit(100).all()
-    
-    # Mark messages as read
-    for msg in messages:
-        if msg.recipient_id == current_user.id and not msg.is_read:
-            msg.mark_as_read()
+    # Latest page; older pages come from chat.history
+    messages, next_cursor = get_history(
+        current_user.id, channel_id=channel_id, limit=current_app.config['CHAT_PAGE_SIZE']
+    )
     
+    # One UPDATE moves the read mark to the newest message shown
+    advanced = messages and advance_read(current_user.id, messages[-1].id, channel_id=channel_id)
     db.session.commit()
+    if advanced:
+        emit_read_up_to(current_user.id, messages[-1].id, channel_id=channel_id)
     
-    return render_template('chat/channel.html', channel=channel, messages=messages)
+    return render_template('chat/channel.html', channel=channel, messages=messages, next_cursor=next_cursor)
 
 
 @bp.route('/direct/<int:user_id>')
@@ -91,31 +72,75 @@ def direct(user_id):
         flash('User not found.', 'danger')
         return redirect(url_for('chat.index'))
     
-    # Get messages between users
-    messages = Message.query.filter(
-        db.or_(
-            db.and_(Message.sender_id == current_user.id, Message.recipient_id == user_id),
-            db.and_(Message.sender_id == user_id, Message.recipient_id == current_user.id)
-        )
-    ).order_by(Message.created_at.asc()).limit(100).all()
-    
-    # Mark messages as read
-    for msg in messages:
-        if msg.recipient_id == current_user.id and not msg.is_read:
-            msg.mark_as_read()
+    # Latest page; older pages come from chat.history
+    messages, next_cursor = get_history(
+        current_user.id, partner_id=user_id, limit=current_app.config['CHAT_PAGE_SIZE']
+    )
     
+    # One UPDATE moves the read mark to the newest message shown
+    advanced = messages and advance_read(current_user.id, messages[-1].id, partner_id=user_id)
     db.session.commit()
+    if advanced:
+        emit_read_up_to(current_user.id, messages[-1].id, partner_id=user_id)
+    
+    # Ticks on own messages come from the recipient's marks
+    read_mark, delivered_mark = get_marks(user_id, partner_id=current_user.id)
+    
+    return render_template('chat/direct.html', recipient=user, messages=messages, next_cursor=next_cursor,
+                           read_mark=read_mark, delivered_mark=delivered_mark)
+
+
+@bp.route('/history')
+@login_required
+def history():
+    """Page of older messages of a channel or direct conversation (AJAX)"""
+    channel_id = request.args.get('channel_id', type=int)
+    user_id = request.args.get('user_id', type=int)
+    page_size = current_app.config['CHAT_PAGE_SIZE']
+    limit = min(request.args.get('limit', page_size, type=int), page_size * 2)
+    
+    if channel_id:
+        if not is_channel_member(current_user.id, channel_id):
+            return jsonify({'error': 'Unauthorized'}), 403
+    elif user_id:
+        user = User.query.get_or_404(user_id)
+        if user.organisation_id != current_user.organisation_id:
+            return jsonify({'error': 'User not found'}), 404
+    else:
+        return jsonify({'error': 'channel_id or user_id is required'}), 400
     
-    return render_template('chat/direct.html', recipient=user, messages=messages)
+    try:
+        messages, next_cursor = get_history(
+            current_user.id, partner_id=user_id, channel_id=channel_id,
+            before=request.args.get('before'), limit=max(limit, 1)
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    read_mark, delivered_mark = ((EPOCH, 0), (EPOCH, 0)) if channel_id else \
+        get_marks(user_id, partner_id=current_user.id)
+    
+    return jsonify({
+        'messages': [{
+            'id': msg.id,
+            'content': msg.content,
+            'sender_id': msg.sender_id,
+            'created_at': msg.created_at.isoformat(),
+            'message_type': msg.message_type,
+            'attachment_url': msg.attachment_path,
+            'thumbnail_url': msg.get_thumbnail_url()
+        } for msg in messages],
+        'html': ''.join(render_template('chat/_message.html', msg=msg, read_mark=read_mark,
+                                        delivered_mark=delivered_mark) for msg in messages),
+        'next_cursor': next_cursor
+    })
 
 
 @bp.route('/send', methods=['POST'])
 @login_required
 def send_message():
     """Send a message (AJAX)"""
-    import os
-    from werkzeug.utils import secure_filename
-    from flask import current_app
+    from app.utils.storage import save_upload, take_upload
+    from app.utils.images import schedule_variants
     
     # Check if it's JSON or FormData
     if request.is_json:
@@ -125,8 +150,8 @@ def send_message():
         channel_id = data.get('channel_id')
         message_type = data.get('message_type', 'text')
         task_card_id = data.get('task_card_id')
-        attachment_path = None
-        attachment_filename = None
+        upload_id = data.get('upload_id')
+        attachment = None
     else:
         # FormData (for image uploads)
         content = request.form.get('content', '').strip()
@@ -134,34 +159,35 @@ def send_message():
         channel_id = request.form.get('channel_id')
         message_type = request.form.get('message_type', 'text')
         task_card_id = request.form.get('task_card_id')
-        attachment_path = None
-        attachment_filename = None
+        upload_id = request.form.get('upload_id')
+        attachment = None
         
         # Handle image upload
         if 'image' in request.files:
             image_file = request.files['image']
             if image_file and image_file.filename:
-                # Secure filename
-                original_filename = secure_filename(image_file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"{current_user.id}_{timestamp}_{original_filename}"
-                
-                # Create upload directory if not exists
-                upload_dir = os.path.join(current_app.static_folder, 'uploads', 'chat')
-                os.makedirs(upload_dir, exist_ok=True)
-                
-                # Save file
-                file_path = os.path.join(upload_dir, filename)
-                image_file.save(file_path)
-                
-                # Set attachment path
-                attachment_path = f'/static/uploads/chat/{filename}'
-                attachment_filename = original_filename
+                # Stream into content-addressed storage
+                attachment = save_upload(image_file)
                 message_type = 'image'
     
-    if not content and not attachment_path:
+    if upload_id and not attachment:
+        # File sent beforehand through the resumable upload API
+        attachment = take_upload(upload_id, current_user.id)
+        if attachment is None:
+            return jsonify({'error': 'Unknown or unfinished upload'}), 400
+        message_type = 'image' if (attachment['mime_type'] or '').startswith('image/') else 'file'
+    
+    attachment_path = None
+    
+    if not content and not attachment:
         return jsonify({'error': 'Message cannot be empty'}), 400
     
+    if attachment:
+        # Commit the blob row (and a consumed upload) first: reserving an id
+        # block writes id_sequences on a connection of its own, which on
+        # SQLite would wait for this session's write lock
+        db.session.commit()
+    
     # Convert recipient_id and channel_id to int if present
     if recipient_id:
         recipient_id = int(recipient_id)
@@ -170,20 +196,28 @@ def send_message():
     if task_card_id:
         task_card_id = int(task_card_id)
     
-    # Create message
-    message = Message(
-        content=content or 'Sent an image',
+    # Create message; its id is assigned up front so it can be emitted
+    # before the write-behind persister has committed it
+    message = prepare_message(Message(
+        content=content or ('Sent an image' if message_type == 'image' else f"Sent {attachment['original_filename']}"),
         sender_id=current_user.id,
         recipient_id=recipient_id,
         channel_id=channel_id,
         message_type=message_type,
         task_card_id=task_card_id,
-        attachment_path=attachment_path,
-        attachment_filename=attachment_filename
-    )
+        attachment_filename=attachment['original_filename'] if attachment else None,
+        attachment_hash=attachment['sha256'] if attachment else None,
+        attachment_size=attachment['size'] if attachment else None
+    ))
+    if attachment:
+        # Images are served through the authenticated download route
+        attachment_path = url_for('chat.download_attachment', message_id=message.id)
+        message.attachment_path = attachment_path
+    persist_message(message)
     
-    db.session.add(message)
-    db.session.commit()
+    if attachment and message_type == 'image':
+        # Thumbnails are produced off the request path; the original is served until then
+        schedule_variants(attachment['path'], 'chat')
     
     # Emit Socket.IO event (handled by socket events)
     from app import socketio
@@ -194,7 +228,8 @@ def send_message():
         'sender_id': current_user.id,
         'created_at': message.created_at.isoformat(),
         'message_type': message_type,
-        'attachment_url': attachment_path
+        'attachment_url': attachment_path,
+        'thumbnail_url': message.get_thumbnail_url()
     }
     
     if channel_id:
@@ -210,11 +245,37 @@ def send_message():
             'sender': current_user.name,
             'created_at': message.created_at.isoformat(),
             'message_type': message_type,
-            'attachment_url': attachment_path
+            'attachment_url': attachment_path,
+            'thumbnail_url': message.get_thumbnail_url()
         }
     })
 
 
+@bp.route('/attachments/<int:message_id>')
+@login_required
+def download_attachment(message_id):
+    """Serve a message attachment to its sender, recipient or channel members"""
+    message = db.session.get(Message, message_id) or ArchivedMessage.query.get_or_404(message_id)
+    
+    if not message.attachment_path or message.is_deleted:
+        abort(404)
+    
+    if message.channel_id:
+        if not is_channel_member(current_user.id, message.channel_id):
+            abort(403)
+    elif current_user.id not in (message.sender_id, message.recipient_id):
+        abort(403)
+    
+    return send_attachment(
+        message.attachment_hash,
+        message.attachment_path,
+        None,
+        message.attachment_filename,
+        as_attachment=request.args.get('download') == '1',
+        variant=request.args.get('variant')
+    )
+
+
 @bp.route('/channels/create', methods=['GET', 'POST'])
 @login_required
 def create_channel():
@@ -266,25 +327,18 @@ def search():
     query = request.args.get('q', '').strip()
     
     if not query:
-        return render_template('chat/search.html', messages=[])
-    
-    # Search in messages where user is involved
-    messages = Message.query.filter(
-        db.and_(
-            Message.content.ilike(f'%{query}%'),
-            db.or_(
-                Message.sender_id == current_user.id,
-                Message.recipient_id == current_user.id,
-                Message.channel_id.in_(
-                    db.session.query(ChatChannel.id).join(
-                        ChatChannel.members
-                    ).filter(User.id == current_user.id)
-                )
-            )
-        )
-    ).order_by(Message.created_at.desc()).limit(50).all()
+        return render_template('chat/search.html', results=[])
+    
+    # Ranked full-text search over the user's conversations, optionally
+    # narrowed to one channel or direct conversation
+    results = search_messages(
+        current_user.id, query,
+        channel_id=request.args.get('channel_id', type=int),
+        partner_id=request.args.get('user_id', type=int),
+        limit=50
+    )
     
-    return render_template('chat/search.html', messages=messages, query=query)
+    return render_template('chat/search.html', results=results, query=query)
 
 
 @bp.route('/leave-request', methods=['POST'])
@@ -7,6 +7,7 @@ from flask_login import login_required, current_user
 from app import db
 from app.models import Task, Notification, Message, Department, User
 from app.utils.quotes import get_daily_quote, get_birthday_message
+from app.utils.conversations import get_unread_total
 from sqlalchemy import text, or_, and_, extract
 from datetime import datetime, timedelta
 
@@ -52,9 +53,7 @@ def index():
             and_(Task.due_date < datetime.utcnow(), Task.status != 'done')
         ).count(),
         'unread_notifications': current_user.notifications.filter_by(is_read=False).count(),
-        'unread_messages': Message.query.filter_by(
-            recipient_id=current_user.id, is_read=False
-        ).count()
+        'unread_messages': get_unread_total(current_user.id)
     }
     
     # Get upcoming tasks (next 7 days)
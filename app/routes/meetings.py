@@ -2,15 +2,14 @@
 Meetings Blueprint - Meeting scheduling and management
 """
 
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app, abort
 from flask_login import login_required, current_user
 from app import db
 from app.models import Meeting, MeetingAgendaItem, MeetingNote, MeetingAttachment, User, Department, Notification, Task
 from app.models.meeting import meeting_attendees
 from app.routes.auth import manager_required
-from werkzeug.utils import secure_filename
+from app.utils.storage import save_upload, send_attachment
 from datetime import datetime, timedelta
-import os
 import json
 
 bp = Blueprint('meetings', __name__, url_prefix='/meetings')
@@ -218,23 +217,17 @@ def create_meeting():
         # Handle file attachments
         uploaded_files = request.files.getlist('attachments')
         if uploaded_files:
-            upload_folder = os.path.join(current_app.config.get('UPLOAD_FOLDER', 'app/static/uploads'), 'meetings')
-            os.makedirs(upload_folder, exist_ok=True)
-            
             for file in uploaded_files:
                 if file and file.filename:
-                    original_filename = secure_filename(file.filename)
-                    filename = f"{meeting.id}_{datetime.utcnow().timestamp()}_{original_filename}"
-                    file_path = os.path.join(upload_folder, filename)
-                    
-                    file.save(file_path)
+                    stored = save_upload(file)
                     
                     attachment = MeetingAttachment(
-                        filename=filename,
-                        original_filename=original_filename,
-                        file_path=file_path,
-                        file_size=os.path.getsize(file_path),
-                        mime_type=file.content_type,
+                        filename=stored['filename'],
+                        original_filename=stored['original_filename'],
+                        file_path=stored['storage_path'],
+                        file_size=stored['size'],
+                        mime_type=stored['mime_type'],
+                        content_hash=stored['sha256'],
                         meeting_id=meeting.id,
                         uploaded_by_id=current_user.id
                     )
@@ -347,23 +340,17 @@ def edit_meeting(meeting_id):
         # Handle new file attachments
         uploaded_files = request.files.getlist('attachments')
         if uploaded_files:
-            upload_folder = os.path.join(current_app.config.get('UPLOAD_FOLDER', 'app/static/uploads'), 'meetings')
-            os.makedirs(upload_folder, exist_ok=True)
-            
             for file in uploaded_files:
                 if file and file.filename:
-                    original_filename = secure_filename(file.filename)
-                    filename = f"{meeting.id}_{datetime.utcnow().timestamp()}_{original_filename}"
-                    file_path = os.path.join(upload_folder, filename)
-                    
-                    file.save(file_path)
+                    stored = save_upload(file)
                     
                     attachment = MeetingAttachment(
-                        filename=filename,
-                        original_filename=original_filename,
-                        file_path=file_path,
-                        file_size=os.path.getsize(file_path),
-                        mime_type=file.content_type,
+                        filename=stored['filename'],
+                        original_filename=stored['original_filename'],
+                        file_path=stored['storage_path'],
+                        file_size=stored['size'],
+                        mime_type=stored['mime_type'],
+                        content_hash=stored['sha256'],
                         meeting_id=meeting.id,
                         uploaded_by_id=current_user.id
                     )
@@ -409,6 +396,24 @@ def respond_to_meeting(meeting_id):
     return jsonify({'success': True, 'response': response})
 
 
+@bp.route('/attachments/<int:attachment_id>')
+@login_required
+def download_attachment(attachment_id):
+    """Serve a meeting attachment to the organizer and attendees"""
+    attachment = MeetingAttachment.query.get_or_404(attachment_id)
+    
+    if not can_access_meeting(attachment.meeting):
+        abort(403)
+    
+    return send_attachment(
+        attachment.content_hash,
+        attachment.file_path,
+        attachment.mime_type,
+        attachment.original_filename,
+        as_attachment=request.args.get('download') == '1'
+    )
+
+
 @bp.route('/<int:meeting_id>/delete', methods=['POST'])
 @login_required
 def delete_meeting(meeting_id):
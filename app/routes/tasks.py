@@ -2,14 +2,16 @@
 Tasks Blueprint - Task and project management
 """
 
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app, abort
 from flask_login import login_required, current_user
 from app import db
-from app.models import Task, TaskComment, TaskAttachment, TimeLog, User, Department, Tag, Notification
+from app.models import Task, TaskDeliverable, TaskComment, TaskAttachment, TimeLog, User, Department, Tag
+from app.models.user import task_assignees
 from app.routes.auth import manager_required
-from werkzeug.utils import secure_filename
+from app.utils.notifications import notify_users
+from app.utils.assignment import assign_tasks
+from app.utils.storage import save_upload, send_attachment, take_upload
 from datetime import datetime
-import os
 import json
 
 bp = Blueprint('tasks', __name__, url_prefix='/tasks')
@@ -216,6 +218,9 @@ def create_task():
             assignee_ids = [int(aid) for aid in assignee_ids if aid]
             assignees = User.query.filter(User.id.in_(assignee_ids)).all()
             task.assignees.extend(assignees)
+        elif request.form.get('auto_assign'):
+            # Pick from the department's workload index
+            assignee_ids = list(assign_tasks([task]).values())
         
         # Assign tags
         if tag_ids:
@@ -224,32 +229,29 @@ def create_task():
             tags = Tag.query.filter(Tag.id.in_(tag_ids)).all()
             task.tags.extend(tags)
         
-        # Commit task and relationships first
+        # Notify assignees (rows the assignment trigger already wrote are skipped)
+        if assignee_ids:
+            notify_users(assignee_ids, 'task_assigned', {'task_id': task.id, 'task_title': task.title})
+        
+        # Commit task, relationships and notifications first
         db.session.commit()
         
         # Handle file attachments
         uploaded_files = request.files.getlist('attachments')
         if uploaded_files:
-            upload_folder = os.path.join(current_app.config.get('UPLOAD_FOLDER', 'app/static/uploads'), 'attachments')
-            os.makedirs(upload_folder, exist_ok=True)
-            
             for file in uploaded_files:
                 if file and file.filename:
-                    # Secure the filename
-                    original_filename = secure_filename(file.filename)
-                    filename = f"{task.id}_{datetime.utcnow().timestamp()}_{original_filename}"
-                    file_path = os.path.join(upload_folder, filename)
-                    
-                    # Save the file
-                    file.save(file_path)
+                    # Stream into content-addressed storage
+                    stored = save_upload(file)
                     
                     # Create attachment record
                     attachment = TaskAttachment(
-                        filename=filename,
-                        original_filename=original_filename,
-                        file_path=file_path,
-                        file_size=os.path.getsize(file_path),
-                        mime_type=file.content_type,
+                        filename=stored['filename'],
+                        original_filename=stored['original_filename'],
+                        file_path=stored['storage_path'],
+                        file_size=stored['size'],
+                        mime_type=stored['mime_type'],
+                        content_hash=stored['sha256'],
                         task_id=task.id,
                         uploaded_by_id=current_user.id
                     )
@@ -257,20 +259,6 @@ def create_task():
             
             db.session.commit()
         
-        # Now create notifications for assignees (after commit)
-        if assignee_ids:
-            for assignee_id in assignee_ids:
-                notif = Notification(
-                    user_id=assignee_id,
-                    title='New Task Assigned',
-                    message=f'You have been assigned to: {task.title}',
-                    notification_type='task_assigned',
-                    task_id=task.id,
-                    action_url=f'/tasks/{task.id}'
-                )
-                db.session.add(notif)
-            db.session.commit()
-        
         flash(f'Task "{task.title}" created successfully!', 'success')
         return redirect(url_for('tasks.view_task', task_id=task.id))
     
@@ -297,8 +285,8 @@ def view_task(task_id):
     # Get attachments
     attachments = task.attachments.all()
     
-    # Get time logs
-    time_logs = task.time_logs.order_by(TimeLog.start_time.desc()).all()
+    # Get recent time logs (the total comes from task.actual_hours)
+    time_logs = task.time_logs.order_by(TimeLog.start_time.desc()).limit(5).all()
     
     # Get task history
     from app.models import TaskHistory
@@ -387,30 +375,14 @@ def edit_task(task_id):
         if tag_ids:
             task.tags = Tag.query.filter(Tag.id.in_(tag_ids)).all()
         
-        # Log history if status changed
+        # History rows are written at flush time (see capture_task_history)
         if old_status != task.status:
-            from app.models import TaskHistory
-            history = TaskHistory(
-                task_id=task.id,
-                user_id=current_user.id,
-                action='status_changed',
-                field_changed='status',
-                old_value=old_status,
-                new_value=task.status
-            )
-            db.session.add(history)
-            
             # Notify assignees about status change
-            for assignee in task.assignees:
-                notif = Notification(
-                    user_id=assignee.id,
-                    title='Task Status Updated',
-                    message=f'Task "{task.title}" status changed to {task.status}',
-                    notification_type='task_updated',
-                    task_id=task.id,
-                    action_url=f'/tasks/{task.id}'
-                )
-                db.session.add(notif)
+            notify_users(
+                [assignee.id for assignee in task.assignees],
+                'task_updated',
+                {'task_id': task.id, 'task_title': task.title, 'status': task.status}
+            )
         
         db.session.commit()
         flash('Task updated successfully!', 'success')
@@ -456,23 +428,8 @@ def update_status(task_id):
     if new_status not in ['todo', 'in_progress', 'done', 'archived']:
         return jsonify({'error': 'Invalid status'}), 400
     
-    old_status = task.status
+    # Task.validate_status stamps completed_date, the flush records history
     task.status = new_status
-    
-    if new_status == 'done' and not task.completed_date:
-        task.completed_date = datetime.utcnow()
-    
-    # Log history
-    from app.models import TaskHistory
-    history = TaskHistory(
-        task_id=task.id,
-        user_id=current_user.id,
-        action='status_changed',
-        field_changed='status',
-        old_value=old_status,
-        new_value=new_status
-    )
-    db.session.add(history)
     db.session.commit()
     
     return jsonify({'success': True, 'status': new_status})
@@ -499,23 +456,17 @@ def add_comment(task_id):
         user_id=current_user.id
     )
     db.session.add(comment)
-    db.session.commit()
     
-    # Notify task creator and assignees
-    notify_users = set([task.creator] + task.assignees.all())
-    notify_users.discard(current_user)  # Don't notify self
-    
-    for user in notify_users:
-        if user:
-            notif = Notification(
-                user_id=user.id,
-                title='New Comment on Task',
-                message=f'{current_user.name} commented on: {task.title}',
-                notification_type='comment_added',
-                task_id=task.id,
-                action_url=f'/tasks/{task.id}'
-            )
-            db.session.add(notif)
+    # Notify task creator and assignees (ids only, no user objects loaded)
+    assignee_ids = db.session.scalars(
+        db.select(task_assignees.c.user_id).where(task_assignees.c.task_id == task.id)
+    ).all()
+    notify_users(
+        [task.created_by_id] + assignee_ids,
+        'comment_added',
+        {'task_id': task.id, 'task_title': task.title, 'actor_name': current_user.name},
+        exclude_user_id=current_user.id  # Don't notify self
+    )
     
     db.session.commit()
     
@@ -532,43 +483,61 @@ def upload_attachment(task_id):
     if not can_access_task(task):
         return jsonify({'error': 'Unauthorized'}), 403
     
-    if 'file' not in request.files:
+    upload_id = request.form.get('upload_id')
+    if 'file' not in request.files and not upload_id:
         flash('No file selected.', 'warning')
         return redirect(url_for('tasks.view_task', task_id=task_id))
     
-    file = request.files['file']
+    file = request.files.get('file')
     
-    if file.filename == '':
+    if upload_id:
+        # File sent beforehand through the resumable upload API
+        stored = take_upload(upload_id, current_user.id)
+        if stored is None:
+            flash('Upload not found or not finished.', 'warning')
+            return redirect(url_for('tasks.view_task', task_id=task_id))
+    elif file.filename == '':
         flash('No file selected.', 'warning')
         return redirect(url_for('tasks.view_task', task_id=task_id))
+    else:
+        stored = save_upload(file)
+    
+    attachment = TaskAttachment(
+        filename=stored['filename'],
+        original_filename=stored['original_filename'],
+        file_path=stored['storage_path'],
+        file_size=stored['size'],
+        mime_type=stored['mime_type'],
+        content_hash=stored['sha256'],
+        task_id=task_id,
+        uploaded_by_id=current_user.id
+    )
+    db.session.add(attachment)
+    db.session.commit()
     
-    if file:
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"task_{task_id}_{timestamp}_{filename}"
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', unique_filename)
-        file.save(file_path)
-        
-        # Get file size
-        file_size = os.path.getsize(file_path)
-        
-        attachment = TaskAttachment(
-            filename=unique_filename,
-            original_filename=filename,
-            file_path=f"/static/uploads/attachments/{unique_filename}",
-            file_size=file_size,
-            mime_type=file.content_type,
-            task_id=task_id,
-            uploaded_by_id=current_user.id
-        )
-        db.session.add(attachment)
-        db.session.commit()
-        
-        flash('File uploaded successfully!', 'success')
+    flash('File uploaded successfully!', 'success')
     
     return redirect(url_for('tasks.view_task', task_id=task_id))
 
 
+@bp.route('/attachments/<int:attachment_id>')
+@login_required
+def download_attachment(attachment_id):
+    """Serve a task attachment to users who can see the task"""
+    attachment = TaskAttachment.query.get_or_404(attachment_id)
+    
+    if not can_access_task(attachment.task):
+        abort(403)
+    
+    return send_attachment(
+        attachment.content_hash,
+        attachment.file_path,
+        attachment.mime_type,
+        attachment.original_filename,
+        as_attachment=request.args.get('download') == '1'
+    )
+
+
 @bp.route('/<int:task_id>/checklist/update', methods=['POST'])
 @login_required
 def update_checklist_item(task_id):
@@ -580,31 +549,40 @@ def update_checklist_item(task_id):
     
     try:
         data = request.get_json()
-        item_id = data.get('item_id')
-        completed = data.get('completed', False)
-        
-        # Get current deliverables
-        deliverables = task.get_deliverables()
-        
-        # Update the specific item
-        updated = False
-        for item in deliverables:
-            if str(item.get('id')) == str(item_id):
-                item['completed'] = completed
-                updated = True
-                break
+        item_id = int(data.get('item_id'))
+        completed = bool(data.get('completed', False))
+        
+        # Flip the single row; the guard makes repeated clicks a no-op
+        result = db.session.execute(
+            db.update(TaskDeliverable).where(
+                TaskDeliverable.id == item_id,
+                TaskDeliverable.task_id == task.id,
+                TaskDeliverable.is_completed != completed
+            ).values(
+                is_completed=completed,
+                completed_at=datetime.utcnow() if completed else None
+            )
+        )
         
-        if not updated:
+        if result.rowcount:
+            # Relative update so concurrent toggles never overwrite each other
+            db.session.execute(
+                db.update(Task).where(Task.id == task.id).values(
+                    completed_count=Task.completed_count + (1 if completed else -1)
+                )
+            )
+        elif not db.session.query(
+            TaskDeliverable.query.filter_by(id=item_id, task_id=task.id).exists()
+        ).scalar():
             return jsonify({'error': 'Item not found', 'success': False}), 404
         
-        # Save updated deliverables
-        task.set_deliverables(deliverables)
         db.session.commit()
         
-        # Calculate completion stats
-        total_count = len(deliverables)
-        completed_count = sum(1 for item in deliverables if item.get('completed', False))
-        completion_percentage = int((completed_count / total_count) * 100) if total_count > 0 else 0
+        # Read back the stored counts
+        completed_count, total_count = db.session.execute(
+            db.select(Task.completed_count, Task.total_count).where(Task.id == task.id)
+        ).one()
+        completion_percentage = int((completed_count / total_count) * 100) if total_count else 0
         
         return jsonify({
             'success': True,
@@ -613,6 +591,8 @@ def update_checklist_item(task_id):
             'total_count': total_count
         })
     
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid item', 'success': False}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e), 'success': False}), 500
@@ -650,24 +630,12 @@ def add_time_log(task_id):
 # Helper functions
 def can_access_task(task):
     """Check if user can access task"""
-    if current_user.is_admin():
-        return True
-    if current_user.is_manager() and task.department_id == current_user.department_id:
-        return True
-    if current_user in task.assignees:
-        return True
-    if task.created_by_id == current_user.id:
-        return True
-    return False
+    return current_user.can_access_task(task)
 
 
 def can_edit_task(task):
     """Check if user can edit task"""
-    if current_user.is_manager():
-        return True
-    if task.created_by_id == current_user.id:
-        return True
-    return False
+    return current_user.can_edit_task(task)
 
 
 def get_departments():
@@ -6,6 +6,7 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request,
 from flask_login import login_required, current_user
 from app import db
 from app.models import User, LeaveRequest
+from app.utils.images import schedule_variants
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import os
@@ -63,6 +64,7 @@ def edit_profile():
                 filename = f"user_{current_user.id}_{timestamp}_{filename}"
                 profile_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'profiles', filename)
                 file.save(profile_path)
+                schedule_variants(profile_path, 'avatar')
                 current_user.profile_picture = filename
         
         db.session.commit()
@@ -3,38 +3,37 @@ Chat Socket.IO Events
 Real-time messaging functionality
 """
 
-from flask import request
+from flask import request, current_app
 from flask_login import current_user
 from flask_socketio import emit, join_room, leave_room
 from app import socketio, db
-from app.models import Message, OnlineStatus, TypingIndicator, ChatChannel
+from app.models import Message
+from app.utils.conversations import (
+    advance_read, advance_delivered, emit_read_up_to, message_created_at,
+    parse_ack_ranges, acknowledge_messages, emit_message_acks
+)
+from app.utils.message_persister import persist_message, wait_until_persisted
+from app.utils.typing_indicators import get_typing_store, conversation_key, parse_conversation_key
+from app.utils.presence import get_presence, organisation_room
+from app.utils.memberships import channel_ids_of, is_channel_member, channel_member_count
+from app.utils.sync import sync_since
 
 
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
     if current_user.is_authenticated:
-        # Update online status
-        online_status = OnlineStatus.query.filter_by(user_id=current_user.id).first()
-        if not online_status:
-            online_status = OnlineStatus(user_id=current_user.id)
-            db.session.add(online_status)
+        # Count the connection; presence diffs go out to the organisation
+        # room in coalesced batches, last_seen is saved lazily
+        get_presence().connect(current_user.id, current_user.organisation_id)
         
-        online_status.update_status(True, request.sid)
-        db.session.commit()
-        
-        # Join user's personal room
+        # Join user's personal and organisation rooms
         join_room(f'user_{current_user.id}')
+        join_room(organisation_room(current_user.organisation_id))
         
-        # Join all channel rooms
-        for channel in current_user.channels:
-            join_room(f'channel_{channel.id}')
-        
-        # Broadcast user online status
-        emit('user_online', {
-            'user_id': current_user.id,
-            'user_name': current_user.name
-        }, broadcast=True)
+        # Join all channel rooms (ids from the membership cache)
+        for channel_id in channel_ids_of(current_user.id):
+            join_room(f'channel_{channel_id}')
         
         print(f'User {current_user.name} connected')
 
@@ -43,21 +42,46 @@ def handle_connect():
 def handle_disconnect():
     """Handle client disconnection"""
     if current_user.is_authenticated:
-        # Update online status
-        online_status = OnlineStatus.query.filter_by(user_id=current_user.id).first()
-        if online_status:
-            online_status.update_status(False)
-            db.session.commit()
+        # Other tabs may still be open; only the last one takes the user offline
+        get_presence().disconnect(current_user.id)
         
-        # Broadcast user offline status
-        emit('user_offline', {
-            'user_id': current_user.id,
-            'user_name': current_user.name
-        }, broadcast=True)
+        # Whatever they were typing is abandoned
+        for key in get_typing_store().stop_all(current_user.id):
+            partner_id, channel_id = parse_conversation_key(key, current_user.id)
+            _emit_typing(partner_id, channel_id, False)
         
         print(f'User {current_user.name} disconnected')
 
 
+@socketio.on('request_online_users')
+def handle_request_online_users():
+    """List the online members of the user's organisation"""
+    if not current_user.is_authenticated:
+        return
+    
+    user_ids = get_presence().online_user_ids(current_user.organisation_id)
+    emit('online_users_list', {'users': [{'user_id': user_id} for user_id in user_ids]})
+
+
+@socketio.on('sync')
+def handle_sync(data=None):
+    """Catch up after a reconnect: {message_seq, notification_id, limit}; answered with 'sync_result'"""
+    if not current_user.is_authenticated:
+        return
+    
+    data = data or {}
+    limit = current_app.config['SYNC_PAGE_SIZE']
+    try:
+        message_seq, notification_id = (
+            None if data.get(key) is None else int(data[key]) for key in ('message_seq', 'notification_id')
+        )
+        limit = max(1, min(int(data.get('limit') or limit), limit))
+    except (TypeError, ValueError):
+        return
+    
+    emit('sync_result', sync_since(current_user.id, message_seq, notification_id, limit))
+
+
 @socketio.on('join_channel')
 def handle_join_channel(data):
     """Join a channel room"""
@@ -69,12 +93,12 @@ def handle_join_channel(data):
         return
     
     # Verify user is member of channel
-    channel = ChatChannel.query.get(channel_id)
-    if channel and current_user in channel.members:
+    if is_channel_member(current_user.id, channel_id):
         join_room(f'channel_{channel_id}')
         emit('joined_channel', {
             'channel_id': channel_id,
-            'user_name': current_user.name
+            'user_name': current_user.name,
+            'member_count': channel_member_count(channel_id)
         }, room=f'channel_{channel_id}')
 
 
@@ -109,8 +133,9 @@ def handle_send_message(data):
     if not content:
         return
     
-    # Create message
-    message = Message(
+    # Create message; it is emitted with its final id while the
+    # write-behind persister commits it with the next batch
+    message = persist_message(Message(
         content=content,
         sender_id=current_user.id,
         recipient_id=recipient_id,
@@ -118,10 +143,7 @@ def handle_send_message(data):
         message_type=message_type,
         is_delivered=False,
         is_read=False
-    )
-    
-    db.session.add(message)
-    db.session.commit()
+    ))
     
     message_data = {
         'id': message.id,
@@ -145,49 +167,175 @@ def handle_send_message(data):
         emit('message_sent', message_data, room=f'user_{current_user.id}')
 
 
-@socketio.on('message_delivered')
-def handle_message_delivered(data):
-    """Mark message as delivered (single tick)"""
+def _conversation_of(data):
+    """(partner_id, channel_id) named by an ack event, or None if not allowed"""
+    channel_id = data.get('channel_id')
+    partner_id = data.get('user_id')
+    if channel_id:
+        return (None, channel_id) if is_channel_member(current_user.id, channel_id) else None
+    if partner_id:
+        return partner_id, None
+    return None
+
+
+def _advance_mark(advance, message_id, partner_id, channel_id):
+    """Move a mark; acks can outrun the write-behind batch of their message, so wait for it once"""
+    user_id = current_user.id
+    if advance(user_id, message_id, partner_id=partner_id, channel_id=channel_id):
+        return True
+    # End the transaction first: it would block the batch commit on SQLite
+    db.session.rollback()
+    return wait_until_persisted(message_id) and \
+        advance(user_id, message_id, partner_id=partner_id, channel_id=channel_id)
+
+
+@socketio.on('read_up_to')
+def handle_read_up_to(data):
+    """Advance the read mark of a conversation (double ticks up to message_id)"""
     if not current_user.is_authenticated:
         return
     
     message_id = data.get('message_id')
-    if not message_id:
+    conversation = _conversation_of(data)
+    if not message_id or conversation is None:
         return
     
-    message = Message.query.get(message_id)
-    if message and message.recipient_id == current_user.id:
-        message.mark_as_delivered()
+    partner_id, channel_id = conversation
+    if _advance_mark(advance_read, message_id, partner_id, channel_id):
         db.session.commit()
-        
-        # Notify sender that message was delivered (single tick)
-        emit('message_delivered_ack', {
-            'message_id': message_id,
-            'delivered_at': message.delivered_at.isoformat() if message.delivered_at else None
-        }, room=f'user_{message.sender_id}')
+        emit_read_up_to(current_user.id, message_id, partner_id=partner_id, channel_id=channel_id)
 
 
-@socketio.on('mark_message_read')
-def handle_mark_message_read(data):
-    """Mark message as read (double tick)"""
+@socketio.on('delivered_up_to')
+def handle_delivered_up_to(data):
+    """Advance the delivery mark of a conversation (single ticks up to message_id)"""
     if not current_user.is_authenticated:
         return
     
     message_id = data.get('message_id')
-    if not message_id:
+    conversation = _conversation_of(data)
+    if not message_id or conversation is None:
         return
     
-    message = Message.query.get(message_id)
-    if message and message.recipient_id == current_user.id:
-        message.mark_as_read()
+    partner_id, channel_id = conversation
+    if _advance_mark(advance_delivered, message_id, partner_id, channel_id):
         db.session.commit()
-        
-        # Notify sender that message was read (double tick)
-        emit('message_read_ack', {
+        room = f'channel_{channel_id}' if channel_id else f'user_{partner_id}'
+        emit('delivered_up_to', {
+            'user_id': current_user.id,
+            'channel_id': channel_id,
             'message_id': message_id,
-            'read_by': current_user.id,
-            'read_at': message.read_at.isoformat() if message.read_at else None
-        }, room=f'user_{message.sender_id}')
+            'created_at': message_created_at(message_id).isoformat()
+        }, room=room)
+
+
+def _acknowledge(data, read):
+    """Apply a batched ack and answer each sender with one 'messages_ack'"""
+    try:
+        ranges = parse_ack_ranges(data, current_app.config['CHAT_ACK_MAX_RANGES'])
+    except (ValueError, TypeError):
+        return
+    if not ranges:
+        return
+    
+    # The newest message may still be queued for write-behind; wait for it
+    # outside a transaction, which would block the batch commit on SQLite
+    db.session.rollback()
+    wait_until_persisted(ranges[-1][1])
+    acknowledged = acknowledge_messages(current_user.id, ranges, read=read,
+                                        limit=current_app.config['CHAT_ACK_MAX_MESSAGES'])
+    if acknowledged:
+        db.session.commit()
+        emit_message_acks(current_user.id, acknowledged, 'read' if read else 'delivered')
+
+
+@socketio.on('messages_delivered')
+def handle_messages_delivered(data):
+    """Delivery receipts for a batch of messages: {'ids': [...]} and/or {'ranges': [[first, last], ...]}"""
+    if current_user.is_authenticated:
+        _acknowledge(data, read=False)
+
+
+@socketio.on('messages_read')
+def handle_messages_read(data):
+    """Read receipts for a batch of messages, same payload as messages_delivered"""
+    if current_user.is_authenticated:
+        _acknowledge(data, read=True)
+
+
+def _emit_typing(partner_id, channel_id, is_typing):
+    """Tell the conversation, and only the conversation, about a typing change"""
+    data = {
+        'user_id': current_user.id,
+        'user_name': current_user.name,
+        'channel_id': channel_id,
+        'is_typing': is_typing,
+        'ttl': get_typing_store().ttl
+    }
+    if channel_id:
+        emit('user_typing', data, room=f'channel_{channel_id}', include_self=False)
+    else:
+        emit('user_typing', data, room=f'user_{partner_id}')
+
+
+@socketio.on('typing_start')
+def handle_typing_start(data):
+    """User is typing; repeats within TYPING_THROTTLE only extend the TTL"""
+    if not current_user.is_authenticated:
+        return
+    
+    conversation = _conversation_of(data)
+    if conversation is None:
+        return
+    
+    partner_id, channel_id = conversation
+    key = conversation_key(partner_id, channel_id, current_user.id)
+    if get_typing_store().start(key, current_user.id):
+        _emit_typing(partner_id, channel_id, True)
+
+
+@socketio.on('typing_stop')
+def handle_typing_stop(data):
+    """User stopped typing (or sent the message)"""
+    if not current_user.is_authenticated:
+        return
+    
+    conversation = _conversation_of(data)
+    if conversation is None:
+        return
+    
+    partner_id, channel_id = conversation
+    key = conversation_key(partner_id, channel_id, current_user.id)
+    if get_typing_store().stop(key, current_user.id):
+        _emit_typing(partner_id, channel_id, False)
+
+
+@socketio.on('typing')
+def handle_typing(data):
+    """Typing event of older clients ({recipient_id, is_typing}); mapped onto typing_start/typing_stop"""
+    conversation = {'user_id': data.get('recipient_id'), 'channel_id': data.get('channel_id')}
+    if data.get('is_typing', True):
+        handle_typing_start(conversation)
+    else:
+        handle_typing_stop(conversation)
+
+
+@socketio.on('message_delivered')
+def handle_message_delivered(data):
+    """Per-message delivery receipt from older clients; a batch of one"""
+    if not current_user.is_authenticated or not data.get('message_id'):
+        return
+    
+    handle_messages_delivered({'ids': [data['message_id']]})
+
+
+@socketio.on('mark_message_read')
+def handle_mark_message_read(data):
+    """Per-message read receipt from older clients; a batch of one"""
+    if not current_user.is_authenticated or not data.get('message_id'):
+        return
+    
+    handle_messages_read({'ids': [data['message_id']]})
 
 
 @socketio.on('leave_request_sent')
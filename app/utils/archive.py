@@ -0,0 +1,109 @@
+"""
+Chat message archival
+Messages older than their organisation's horizon move from the hot messages
+table into archived_messages, a table with the same columns and ids. Chat
+queries plan against the hot table and its indexes only; history paging,
+search and attachment downloads continue into the archive when the hot rows
+run out (see get_history, search_messages and download_attachment).
+
+Besides the horizon, MESSAGE_HOT_MAX_ROWS caps the hot table: when it holds
+more rows than that, its oldest messages are archived regardless of age.
+Messages that rows elsewhere still point at stay hot: the last message of
+each conversation and channel, and messages with notifications.
+"""
+
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import text
+from app import db
+from app.models import Message, ArchivedMessage, Organisation, User, Conversation, Notification
+from app.models.messaging import channel_members
+
+
+def _archivable():
+    """Filter on messages no conversation summary or notification refers to"""
+    return db.and_(
+        Message.id.not_in(db.select(Conversation.last_message_id)
+                          .where(Conversation.last_message_id.isnot(None))),
+        Message.id.not_in(db.select(channel_members.c.last_message_id)
+                          .where(channel_members.c.last_message_id.isnot(None))),
+        Message.id.not_in(db.select(Notification.message_id)
+                          .where(Notification.message_id.isnot(None)))
+    )
+
+
+def _raise_id_sequence():
+    """
+    Keep the message id sequence past every archived id: the allocator only
+    looks at MAX(messages.id), which drops once the newest rows are moved
+    """
+    greatest = 'GREATEST' if db.engine.dialect.name == 'postgresql' else 'MAX'
+    db.session.execute(text(
+        "INSERT INTO id_sequences (name, next_id) VALUES ('messages', 1) ON CONFLICT (name) DO NOTHING"
+    ))
+    db.session.execute(text(f"""
+        UPDATE id_sequences
+        SET next_id = {greatest}(next_id, (SELECT COALESCE(MAX(id), 0) + 1 FROM messages))
+        WHERE name = 'messages'
+    """))
+    db.session.commit()
+
+
+def _move(ids):
+    """Copy the messages with these ids into the archive and delete them, in one transaction"""
+    columns = [column.name for column in Message.__table__.columns]
+    db.session.execute(ArchivedMessage.__table__.insert().from_select(
+        columns,
+        db.select(*[Message.__table__.c[name] for name in columns]).where(Message.id.in_(ids))
+    ))
+    db.session.execute(Message.__table__.delete().where(Message.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
+
+
+def _move_batches(condition, batch_size, limit=None):
+    """Archive matching messages oldest first, batch_size rows per transaction"""
+    moved = 0
+    while limit is None or moved < limit:
+        size = batch_size if limit is None else min(batch_size, limit - moved)
+        ids = db.session.scalars(
+            db.select(Message.id).where(condition, _archivable()).order_by(Message.created_at, Message.id).limit(size)
+        ).all()
+        if not ids:
+            break
+        moved += _move(ids)
+    return moved
+
+
+def archive_messages(now=None):
+    """
+    Move messages past their organisation's horizon, then trim the hot table
+    to MESSAGE_HOT_MAX_ROWS.
+
+    A message belongs to its sender's organisation. Each batch is its own
+    transaction, so the job can be stopped and run again at any point.
+
+    Returns:
+        dict: messages archived by age, by the size envelope, and the hot rows left
+    """
+    config = current_app.config
+    now = now or datetime.utcnow()
+    batch_size = config['MESSAGE_ARCHIVE_BATCH_SIZE']
+    _raise_id_sequence()
+
+    by_age = 0
+    for org_id, days in db.session.execute(db.select(Organisation.id, Organisation.message_archive_days)).all():
+        cutoff = now - timedelta(days=days or config['MESSAGE_ARCHIVE_DAYS'])
+        senders = db.select(User.id).where(User.organisation_id == org_id)
+        by_age += _move_batches(
+            db.and_(Message.created_at < cutoff, Message.sender_id.in_(senders)), batch_size
+        )
+
+    by_size = 0
+    hot_rows = db.session.scalar(db.select(db.func.count()).select_from(Message))
+    max_rows = config['MESSAGE_HOT_MAX_ROWS']
+    if max_rows and hot_rows > max_rows:
+        by_size = _move_batches(db.true(), batch_size, limit=hot_rows - max_rows)
+        hot_rows -= by_size
+
+    return {'archived_by_age': by_age, 'archived_by_size': by_size, 'hot_rows': hot_rows}
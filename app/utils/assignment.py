@@ -0,0 +1,370 @@
+"""
+Auto-assignment engine
+Keeps, per department, a min-heap of each active member's open workload so
+suggesting or picking assignees is a heap lookup instead of a GROUP BY over
+the department's tasks. The index is built lazily from the database and then
+kept current from task assignment and status changes as they commit; with a
+message queue, other processes rebuild the departments a commit touched (see
+app/utils/socket_queue.py).
+"""
+
+from flask import current_app
+from app import db
+from app.models import Task, User
+from app.models.user import task_assignees
+from app.utils.socket_queue import cache_change_handler, publish_cache_change, uses_message_queue
+from sqlalchemy import event, inspect, text
+import heapq
+import threading
+
+STRATEGIES = ('least_loaded', 'round_robin')
+
+# Tasks in these states no longer count towards a user's workload
+CLOSED_STATUSES = ('done', 'archived')
+
+# Weight of a task without an estimate when the metric is 'hours'
+DEFAULT_TASK_HOURS = 1.0
+
+PENDING_DELTAS_KEY = 'workload_deltas'
+PENDING_INVALIDATE_KEY = 'workload_invalidate'
+RESERVED_KEY = 'workload_reserved'
+
+
+class _DepartmentWorkload:
+    """Heap of (load, user_id, version) with lazy deletion of stale entries"""
+
+    def __init__(self, loads):
+        self.loads = dict(loads)
+        self.versions = dict.fromkeys(self.loads, 0)
+        self.heap = [(load, user_id, 0) for user_id, load in self.loads.items()]
+        heapq.heapify(self.heap)
+        self.rotation = sorted(self.loads)
+        self.next_index = 0
+
+    def add(self, user_id, delta):
+        """Change a member's load; the old heap entry is left to go stale"""
+        self.loads[user_id] += delta
+        self.versions[user_id] += 1
+        heapq.heappush(self.heap, (self.loads[user_id], user_id, self.versions[user_id]))
+        if len(self.heap) > 2 * len(self.loads) + 32:
+            self.heap = [(load, uid, self.versions[uid]) for uid, load in self.loads.items()]
+            heapq.heapify(self.heap)
+
+    def _is_current(self, entry):
+        return self.versions[entry[1]] == entry[2]
+
+    def least_loaded(self):
+        while not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][1]
+
+    def smallest(self, count):
+        """Return up to count members ordered by load, leaving the heap intact"""
+        taken = []
+        while self.heap and len(taken) < count:
+            entry = heapq.heappop(self.heap)
+            if self._is_current(entry):
+                taken.append(entry)
+        for entry in taken:
+            heapq.heappush(self.heap, entry)
+        return [user_id for _, user_id, _ in taken]
+
+    def rotate(self, count):
+        """Return the next count members in round-robin order"""
+        picked = []
+        for _ in range(min(count, len(self.rotation))):
+            picked.append(self.rotation[self.next_index % len(self.rotation)])
+            self.next_index = (self.next_index + 1) % len(self.rotation)
+        return picked
+
+
+class WorkloadIndex:
+    """Per-department workload heaps for one application"""
+
+    def __init__(self, metric='tasks'):
+        if metric not in ('tasks', 'hours'):
+            raise ValueError(f'Unknown workload metric: {metric}')
+        self.metric = metric
+        self.lock = threading.RLock()
+        self.departments = {}
+        self.user_departments = {}
+
+    def task_weight(self, estimated_hours):
+        if self.metric == 'hours':
+            return estimated_hours if estimated_hours is not None else DEFAULT_TASK_HOURS
+        return 1
+
+    def _load(self, department_id):
+        """Build one department's heap from the database"""
+        # Open tasks are filtered inside the joined pair, so assignments of
+        # done tasks no longer count (the old query counted ta.task_id)
+        rows = db.session.execute(
+            text("""
+                SELECT u.id,
+                       COUNT(t.id) AS task_count,
+                       COALESCE(SUM(COALESCE(t.estimated_hours, :default_hours)), 0) AS hours
+                FROM users u
+                LEFT JOIN (
+                    task_assignees ta
+                    JOIN tasks t ON t.id = ta.task_id AND t.status NOT IN ('done', 'archived')
+                ) ON ta.user_id = u.id
+                WHERE u.department_id = :dept_id AND u.is_active = 1
+                GROUP BY u.id
+            """),
+            {'dept_id': department_id, 'default_hours': DEFAULT_TASK_HOURS}
+        ).all()
+        workload = _DepartmentWorkload({
+            user_id: hours if self.metric == 'hours' else task_count
+            for user_id, task_count, hours in rows
+        })
+        self.departments[department_id] = workload
+        for user_id in workload.loads:
+            self.user_departments[user_id] = department_id
+        return workload
+
+    def get(self, department_id):
+        workload = self.departments.get(department_id)
+        return workload if workload is not None else self._load(department_id)
+
+    def suggest(self, department_id, count=3, strategy='least_loaded'):
+        """Return up to count user ids of the department, best candidate first"""
+        with self.lock:
+            workload = self.get(department_id)
+            if strategy == 'round_robin':
+                # Suggesting does not advance the rotation
+                start = workload.next_index
+                picked = workload.rotate(count)
+                workload.next_index = start
+                return picked
+            return workload.smallest(count)
+
+    def pick(self, department_id, weight, strategy='least_loaded'):
+        """Choose one assignee and charge them weight; None for an empty department"""
+        with self.lock:
+            workload = self.get(department_id)
+            if not workload.loads:
+                return None
+            if strategy == 'round_robin':
+                user_id = workload.rotate(1)[0]
+            else:
+                user_id = workload.least_loaded()
+            workload.add(user_id, weight)
+            return user_id
+
+    def apply(self, deltas):
+        """Apply committed {user_id: load change} to the departments held in memory"""
+        with self.lock:
+            for user_id, delta in deltas.items():
+                workload = self.departments.get(self.user_departments.get(user_id))
+                if workload is not None and user_id in workload.loads and delta:
+                    workload.add(user_id, delta)
+
+    def departments_of(self, user_ids):
+        """Ids of the departments held in memory that contain these users"""
+        with self.lock:
+            return {self.user_departments[user_id] for user_id in user_ids if user_id in self.user_departments}
+
+    def invalidate(self, department_ids=None):
+        """Drop departments (all when None) so they are rebuilt on next use"""
+        with self.lock:
+            if department_ids is None:
+                self.departments.clear()
+                self.user_departments.clear()
+                return
+            for department_id in department_ids:
+                workload = self.departments.pop(department_id, None)
+                for user_id in (workload.loads if workload else ()):
+                    self.user_departments.pop(user_id, None)
+
+
+def get_workload_index():
+    """Return the current application's workload index, creating it on first use"""
+    index = current_app.extensions.get('workload_index')
+    if index is None:
+        index = current_app.extensions.setdefault(
+            'workload_index', WorkloadIndex(current_app.config['ASSIGNMENT_METRIC'])
+        )
+    return index
+
+
+def _strategy(strategy):
+    strategy = strategy or current_app.config['ASSIGNMENT_STRATEGY']
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Unknown assignment strategy: {strategy}')
+    return strategy
+
+
+def suggest_assignees(department_id, count=3, strategy=None):
+    """
+    Suggest assignees for a new task in a department.
+
+    Returns:
+        list: Up to count active User objects, best candidate first
+    """
+    user_ids = get_workload_index().suggest(department_id, count, _strategy(strategy))
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
+def assign_tasks(tasks, strategy=None, department_id=None):
+    """
+    Assign each task to one member of its department.
+
+    Each pick is a heap operation, so n tasks over m members cost
+    O(n log m). The assignment rows are added to the current transaction;
+    the caller commits.
+
+    Args:
+        tasks: Task objects (flushed, so they have ids)
+        strategy: 'least_loaded' or 'round_robin' (default ASSIGNMENT_STRATEGY)
+        department_id: Pick from this department instead of each task's own
+
+    Returns:
+        dict: task id -> assigned user id, for tasks that could be assigned
+    """
+    strategy = _strategy(strategy)
+    index = get_workload_index()
+    assigned = {}
+    departments = set()
+    for task in tasks:
+        task_department_id = department_id or task.department_id
+        if task_department_id is None or task.status in CLOSED_STATUSES:
+            continue
+        user_id = index.pick(task_department_id, index.task_weight(task.estimated_hours), strategy)
+        if user_id is not None:
+            assigned[task.id] = user_id
+            departments.add(task_department_id)
+
+    if assigned:
+        # Core insert: the in-memory charge above is the only accounting,
+        # the flush listener never sees these rows
+        db.session.execute(
+            task_assignees.insert(),
+            [{'task_id': task_id, 'user_id': user_id} for task_id, user_id in assigned.items()]
+        )
+        # Picks are charged up front; a rollback must not leave them behind
+        db.session.info.setdefault(RESERVED_KEY, set()).update(departments)
+    return assigned
+
+
+def invalidate_workload(department_ids=(), user_ids=()):
+    """
+    Rebuild departments after the transaction commits.
+
+    For writes the flush listener cannot see (Core bulk statements); user_ids
+    are mapped to the departments held in memory when it commits.
+    """
+    if current_app.extensions.get('workload_index') is None and not uses_message_queue():
+        return
+    pending = db.session.info.setdefault(PENDING_INVALIDATE_KEY, {'departments': set(), 'users': set()})
+    pending['departments'].update(department_ids)
+    pending['users'].update(user_ids)
+
+
+def _values(state, key):
+    """(before, after) of a column for this flush"""
+    history = state.attrs[key].history
+    if history.has_changes():
+        return (history.deleted[0] if history.deleted else None,
+                history.added[0] if history.added else None)
+    value = getattr(state.obj(), key)
+    return value, value
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_workload_deltas(session, flush_context):
+    """Turn assignment, status, estimate changes and deletions into per-user load deltas"""
+    if not current_app:
+        return
+    if uses_message_queue():
+        # Other processes may hold the departments this one has not loaded
+        index = get_workload_index()
+    else:
+        index = current_app.extensions.get('workload_index')
+        if index is None or not index.departments:
+            return
+
+    deltas = session.info.setdefault(PENDING_DELTAS_KEY, {})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, User):
+            state = inspect(obj)
+            for key in ('department_id', 'is_active'):
+                before, after = _values(state, key)
+                if obj in session.new or before != after:
+                    invalidate_workload({before if key == 'department_id' else obj.department_id,
+                                         after if key == 'department_id' else obj.department_id} - {None})
+            continue
+        if not isinstance(obj, Task) or obj in session.deleted:
+            continue
+
+        state = inspect(obj)
+        old_status, new_status = (None, obj.status) if obj in session.new else _values(state, 'status')
+        old_hours, new_hours = _values(state, 'estimated_hours')
+        old_weight = index.task_weight(old_hours) if old_status is not None and old_status not in CLOSED_STATUSES else 0
+        new_weight = index.task_weight(new_hours) if new_status not in CLOSED_STATUSES else 0
+
+        if old_weight != new_weight:
+            # Every assignee is affected, so the full collection is needed
+            history = state.attrs['assignees'].load_history()
+            before = list(history.unchanged) + list(history.deleted)
+            after = list(history.unchanged) + list(history.added)
+        else:
+            history = state.attrs['assignees'].history
+            before, after = history.deleted, history.added
+        for user in before:
+            deltas[user.id] = deltas.get(user.id, 0) - old_weight
+        for user in after:
+            deltas[user.id] = deltas.get(user.id, 0) + new_weight
+
+    for obj in session.deleted:
+        if not isinstance(obj, Task):
+            continue
+        # A deleted open task no longer loads the members it was assigned to
+        state = inspect(obj)
+        old_status = _values(state, 'status')[0]
+        if old_status is None or old_status in CLOSED_STATUSES:
+            continue
+        weight = index.task_weight(_values(state, 'estimated_hours')[0])
+        history = state.attrs['assignees'].load_history()
+        for user in list(history.unchanged) + list(history.deleted):
+            deltas[user.id] = deltas.get(user.id, 0) - weight
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_workload_deltas(session):
+    deltas = session.info.pop(PENDING_DELTAS_KEY, None)
+    stale = session.info.pop(PENDING_INVALIDATE_KEY, None)
+    reserved = session.info.pop(RESERVED_KEY, None)
+    if not (deltas or stale or reserved):
+        return
+    stale = stale or {'departments': set(), 'users': set()}
+    index = current_app.extensions.get('workload_index')
+    if index is not None:
+        departments = stale['departments'] | index.departments_of(stale['users'])
+        if departments:
+            index.invalidate(departments)
+        if deltas:
+            index.apply(deltas)
+    # Picks were charged here only, so other processes rebuild those departments too
+    publish_cache_change('workload', {
+        'department_ids': sorted(stale['departments'] | (reserved or set())),
+        'user_ids': sorted(stale['users'] | set(deltas or ())),
+    })
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_workload_deltas(session):
+    session.info.pop(PENDING_DELTAS_KEY, None)
+    session.info.pop(PENDING_INVALIDATE_KEY, None)
+    reserved = session.info.pop(RESERVED_KEY, None)
+    index = current_app.extensions.get('workload_index') if current_app else None
+    if reserved and index is not None:
+        index.invalidate(reserved)
+
+
+@cache_change_handler('workload')
+def _rebuild_changed_workloads(data):
+    """Workload changes committed by another process: rebuild the departments they touched"""
+    index = current_app.extensions.get('workload_index')
+    if index is not None:
+        index.invalidate(set(data['department_ids']) | index.departments_of(data['user_ids']))
@@ -0,0 +1,357 @@
+"""
+Bulk task operations
+A batch is validated up front with one lookup query per referenced table,
+then tasks, assignees, tags and history rows are written with executemany
+statements and notifications are fanned out once, in a single transaction
+"""
+
+from app import db
+from app.models import Task, TaskHistory, User, Department, Tag
+from app.models.user import task_assignees, task_tags
+from app.utils.notifications import notify_users_batch
+from app.utils.assignment import invalidate_workload
+from sqlalchemy import bindparam
+from datetime import datetime
+
+TASK_STATUSES = ('todo', 'in_progress', 'done', 'archived')
+TASK_PRIORITIES = ('low', 'medium', 'high', 'urgent')
+
+# Scalar columns a bulk update may change and whose changes are logged
+HISTORY_FIELDS = ('title', 'description', 'status', 'priority', 'start_date',
+                  'due_date', 'estimated_hours', 'department_id')
+
+
+def bulk_create_tasks(items, actor, atomic=False):
+    """
+    Create many tasks in the current transaction.
+
+    Args:
+        items: List of task dicts (title, description, status, priority,
+            department_id, start_date, due_date, estimated_hours,
+            assignee_ids, tag_ids)
+        actor: User performing the import
+        atomic: Write nothing if any item is invalid
+
+    Returns:
+        list: One result dict per item, in order
+    """
+    lookups = _lookup_references(items, actor)
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        values, errors = _clean_item(item, lookups, creating=True)
+        if not errors and values.get('start_date') and values.get('due_date') \
+                and values['start_date'] > values['due_date']:
+            errors.append('start_date cannot be after due_date')
+        if errors:
+            results.append({'index': index, 'success': False, 'errors': errors})
+        else:
+            results.append(None)
+            valid.append((index, values))
+
+    if not valid or (atomic and len(valid) != len(items)):
+        return _mark_skipped(results)
+
+    now = datetime.utcnow()
+    mappings = []
+    for _, values in valid:
+        status = values.get('status', 'todo')
+        mappings.append({
+            'title': values['title'],
+            'description': values.get('description', ''),
+            'status': status,
+            'priority': values.get('priority', 'medium'),
+            'department_id': values.get('department_id', actor.department_id),
+            'start_date': values.get('start_date'),
+            'due_date': values.get('due_date'),
+            'estimated_hours': values.get('estimated_hours'),
+            'completed_date': now if status == 'done' else None,
+            'created_by_id': actor.id,
+            'created_at': now,
+            'updated_at': now
+        })
+
+    task_ids = db.session.scalars(
+        db.insert(Task).returning(Task.id, sort_by_parameter_order=True),
+        mappings
+    ).all()
+
+    assignee_rows = []
+    tag_rows = []
+    history_rows = []
+    assigned = []
+    for task_id, (index, values) in zip(task_ids, valid):
+        assignee_rows += [{'task_id': task_id, 'user_id': uid} for uid in values.get('assignee_ids', [])]
+        tag_rows += [{'task_id': task_id, 'tag_id': tid} for tid in values.get('tag_ids', [])]
+        history_rows.append(TaskHistory.make_row(task_id, actor.id, {}, now, action='created'))
+        if values.get('assignee_ids'):
+            assigned.append((values['assignee_ids'], {'task_id': task_id, 'task_title': values['title']}))
+        results[index] = {'index': index, 'success': True, 'id': task_id}
+
+    _write_links(assignee_rows, tag_rows, [], [], history_rows)
+    invalidate_workload(user_ids={row['user_id'] for row in assignee_rows})
+
+    # The assignment trigger already wrote these rows; this queues the live events
+    notify_users_batch('task_assigned', assigned)
+
+    return results
+
+
+def bulk_update_tasks(items, actor, atomic=False):
+    """
+    Update many tasks in the current transaction.
+
+    Each item needs an id plus any of the fields accepted by
+    bulk_create_tasks. assignee_ids and tag_ids replace the current sets.
+    Only tasks of the actor's organisation (that of their department, or
+    of their creator when they have none) are found. Status-only changes
+    need access to the task, anything else edit rights (User.can_access_task
+    and User.can_edit_task, as in the task routes).
+
+    Returns:
+        list: One result dict per item, in order
+    """
+    lookups = _lookup_references(items, actor)
+    task_ids = {item.get('id') for item in items if isinstance(item, dict) and isinstance(item.get('id'), int)}
+
+    creator = db.aliased(User)
+    tasks = {
+        row.id: row for row in db.session.execute(
+            db.select(Task.id, Task.created_by_id, Task.completed_date,
+                      *[getattr(Task, field) for field in HISTORY_FIELDS])
+            .outerjoin(Department, Department.id == Task.department_id)
+            .outerjoin(creator, creator.id == Task.created_by_id)
+            .where(Task.id.in_(list(task_ids)),
+                   db.func.coalesce(Department.organisation_id, creator.organisation_id) == actor.organisation_id)
+        )
+    }
+    assignees = _current_links(task_assignees, 'user_id', tasks)
+    tags = _current_links(task_tags, 'tag_id', tasks)
+
+    results = []
+    valid = []
+    seen = set()
+    for index, item in enumerate(items):
+        values, errors = _clean_item(item, lookups, creating=False)
+        task = tasks.get(item.get('id')) if isinstance(item, dict) else None
+        if task is None:
+            errors.insert(0, 'task not found')
+        elif task.id in seen:
+            errors.insert(0, 'task appears more than once in the batch')
+        elif not errors:
+            if set(values) - {'status'}:
+                permitted = actor.can_edit_task(task)
+            else:
+                permitted = actor.can_access_task(task, assignees.get(task.id, set()))
+            if not permitted:
+                errors.append('not permitted')
+            start = values.get('start_date', task.start_date)
+            due = values.get('due_date', task.due_date)
+            if start and due and start > due:
+                errors.append('start_date cannot be after due_date')
+
+        if task is not None:
+            seen.add(task.id)
+        if errors:
+            results.append({'index': index, 'success': False, 'errors': errors})
+        else:
+            results.append({'index': index, 'success': True, 'id': task.id})
+            valid.append((task, values))
+
+    if not valid or (atomic and len(valid) != len(items)):
+        return _mark_skipped(results) if atomic else results
+
+    now = datetime.utcnow()
+    task_rows = []
+    history_rows = []
+    added_assignees, removed_assignees, added_tags, removed_tags = [], [], [], []
+    status_changes = []
+    newly_assigned = []
+    workload_users = set()
+    for task, values in valid:
+        row = {'id': task.id, 'updated_at': now}
+        # Core bulk UPDATEs bypass the flush hook, so the diff is built here in
+        # the same one-row-per-task format as capture_task_history
+        changes = {}
+        for field in HISTORY_FIELDS:
+            if field in values and values[field] != getattr(task, field):
+                row[field] = values[field]
+                changes[field] = TaskHistory.scalar_diff(getattr(task, field), values[field])
+        if row.get('status') == 'done' and not task.completed_date:
+            row['completed_date'] = now
+        task_rows.append(row)
+
+        title = values.get('title', task.title)
+        current_assignees = assignees.get(task.id, set())
+        workload_users |= current_assignees | set(values.get('assignee_ids', ()))
+        if 'assignee_ids' in values:
+            new_assignees = set(values['assignee_ids'])
+            added = new_assignees - current_assignees
+            added_assignees += [{'task_id': task.id, 'user_id': uid} for uid in added]
+            removed_assignees += [{'task_id': task.id, 'user_id': uid} for uid in current_assignees - new_assignees]
+            if new_assignees != current_assignees:
+                changes['assignees'] = TaskHistory.collection_diff(current_assignees, new_assignees)
+            if added:
+                newly_assigned.append((added, {'task_id': task.id, 'task_title': title}))
+            current_assignees = new_assignees
+        if 'tag_ids' in values:
+            new_tags = set(values['tag_ids'])
+            current_tags = tags.get(task.id, set())
+            added_tags += [{'task_id': task.id, 'tag_id': tid} for tid in new_tags - current_tags]
+            removed_tags += [{'task_id': task.id, 'tag_id': tid} for tid in current_tags - new_tags]
+            if new_tags != current_tags:
+                changes['tags'] = TaskHistory.collection_diff(current_tags, new_tags)
+        if changes:
+            history_rows.append(TaskHistory.make_row(task.id, actor.id, changes, now))
+        if 'status' in row:
+            status_changes.append((current_assignees, {
+                'task_id': task.id, 'task_title': title, 'status': row['status']
+            }))
+
+    # ORM bulk UPDATE by primary key, batched per distinct set of columns
+    db.session.execute(db.update(Task), task_rows)
+    _write_links(added_assignees, added_tags, removed_assignees, removed_tags, history_rows)
+    invalidate_workload(user_ids=workload_users)
+
+    notify_users_batch('task_assigned', newly_assigned)
+    notify_users_batch('task_updated', status_changes, exclude_user_id=actor.id)
+
+    return results
+
+
+def _lookup_references(items, actor):
+    """Load the ids every item may refer to, one query per table"""
+    def collect(key):
+        ids = set()
+        for item in items:
+            value = item.get(key) if isinstance(item, dict) else None
+            if isinstance(value, list):
+                ids.update(v for v in value if isinstance(v, int))
+            elif isinstance(value, int):
+                ids.add(value)
+        return ids
+
+    return {
+        'assignee_ids': set(db.session.scalars(
+            db.select(User.id).where(User.id.in_(list(collect('assignee_ids'))),
+                                     User.organisation_id == actor.organisation_id)
+        )),
+        'tag_ids': set(db.session.scalars(db.select(Tag.id).where(Tag.id.in_(list(collect('tag_ids')))))),
+        'department_id': set(db.session.scalars(
+            db.select(Department.id).where(Department.id.in_(list(collect('department_id'))),
+                                           Department.organisation_id == actor.organisation_id)
+        ))
+    }
+
+
+def _clean_item(item, lookups, creating):
+    """Validate one item; returns (values, errors)"""
+    if not isinstance(item, dict):
+        return {}, ['item must be an object']
+
+    values = {}
+    errors = []
+
+    if creating or 'title' in item:
+        title = item.get('title')
+        title = title.strip() if isinstance(title, str) else ''
+        if not title:
+            errors.append('title is required')
+        elif len(title) > 200:
+            errors.append('title must be at most 200 characters')
+        values['title'] = title
+
+    if 'description' in item:
+        values['description'] = str(item['description'] or '')
+
+    for field, allowed in (('status', TASK_STATUSES), ('priority', TASK_PRIORITIES)):
+        if field in item:
+            if item[field] in allowed:
+                values[field] = item[field]
+            else:
+                errors.append(f'{field} must be one of {", ".join(allowed)}')
+
+    for field in ('start_date', 'due_date'):
+        if field in item:
+            try:
+                values[field] = datetime.fromisoformat(item[field]) if item[field] else None
+            except (TypeError, ValueError):
+                errors.append(f'{field} must be an ISO 8601 date')
+
+    if 'estimated_hours' in item:
+        hours = item['estimated_hours']
+        if hours is not None and (isinstance(hours, bool) or not isinstance(hours, (int, float)) or hours < 0):
+            errors.append('estimated_hours must be a non-negative number')
+        else:
+            values['estimated_hours'] = float(hours) if hours is not None else None
+
+    if 'department_id' in item:
+        if item['department_id'] in lookups['department_id']:
+            values['department_id'] = item['department_id']
+        else:
+            errors.append('unknown department_id')
+
+    for field in ('assignee_ids', 'tag_ids'):
+        if field in item:
+            ids = item[field]
+            if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                errors.append(f'{field} must be a list of ids')
+                continue
+            unknown = set(ids) - lookups[field]
+            if unknown:
+                errors.append(f'unknown {field}: {_id_list(unknown)}')
+            else:
+                values[field] = sorted(set(ids))
+
+    return values, errors
+
+
+def _current_links(table, column, tasks):
+    """Map task id -> set of linked ids for the tasks in the batch"""
+    links = {}
+    if tasks:
+        rows = db.session.execute(
+            db.select(table.c.task_id, table.c[column]).where(table.c.task_id.in_(list(tasks)))
+        )
+        for task_id, linked_id in rows:
+            links.setdefault(task_id, set()).add(linked_id)
+    return links
+
+
+def _write_links(added_assignees, added_tags, removed_assignees, removed_tags, history_rows):
+    """executemany the association and history changes of a batch"""
+    if removed_assignees:
+        db.session.execute(
+            task_assignees.delete().where(
+                task_assignees.c.task_id == bindparam('b_task_id'),
+                task_assignees.c.user_id == bindparam('b_user_id')
+            ),
+            [{'b_task_id': r['task_id'], 'b_user_id': r['user_id']} for r in removed_assignees]
+        )
+    if removed_tags:
+        db.session.execute(
+            task_tags.delete().where(
+                task_tags.c.task_id == bindparam('b_task_id'),
+                task_tags.c.tag_id == bindparam('b_tag_id')
+            ),
+            [{'b_task_id': r['task_id'], 'b_tag_id': r['tag_id']} for r in removed_tags]
+        )
+    if added_assignees:
+        db.session.execute(task_assignees.insert(), added_assignees)
+    if added_tags:
+        db.session.execute(task_tags.insert(), added_tags)
+    if history_rows:
+        db.session.execute(db.insert(TaskHistory), history_rows)
+
+
+def _id_list(ids):
+    return ','.join(str(i) for i in sorted(ids))
+
+
+def _mark_skipped(results):
+    """Fill in items that were valid but not written because the batch was rejected"""
+    return [
+        result if result is not None and not result['success'] else
+        {'index': index, 'success': False, 'errors': ['not applied: batch rejected']}
+        for index, result in enumerate(results)
+    ]
@@ -0,0 +1,465 @@
+"""
+Conversation summaries
+Keeps one row per (user, partner) in conversations and the matching columns
+on channel_members current as messages are sent, so the chat index reads the
+latest conversations from an index instead of scanning message history.
+Unread counters changed on send and on read are pushed as 'unread_delta'
+events once the transaction commits.
+"""
+
+from app import db
+from app.models import ChatChannel, Conversation, Message, ArchivedMessage
+from app.models.messaging import channel_members
+from sqlalchemy import text, case, bindparam, tuple_, literal, event
+from datetime import datetime
+import base64
+
+PENDING_UNREAD_KEY = 'pending_unread_deltas'
+
+# Messages are ordered by (created_at, id), never by id alone: ids are handed
+# out in per-process blocks before commit (see MessageIdAllocator), so a
+# lower id can be sent, and committed, after a higher one. EPOCH stands in
+# for the created_at of an unset mark
+EPOCH = datetime(1970, 1, 1)
+
+# Upsert of one side of a direct conversation. SQLite (3.24+) and PostgreSQL
+# share the ON CONFLICT syntax.
+_UPSERT_DIRECT = text("""
+    INSERT INTO conversations (user_id, partner_id, last_message_id, last_activity_at, unread_count)
+    VALUES (:user_id, :partner_id, :message_id, :created_at, :unread)
+    ON CONFLICT (user_id, partner_id) DO UPDATE SET
+        last_message_id = CASE WHEN (excluded.last_activity_at, excluded.last_message_id) >
+                                    (COALESCE(conversations.last_activity_at, :epoch),
+                                     COALESCE(conversations.last_message_id, 0))
+                               THEN excluded.last_message_id ELSE conversations.last_message_id END,
+        last_activity_at = CASE WHEN (excluded.last_activity_at, excluded.last_message_id) >
+                                     (COALESCE(conversations.last_activity_at, :epoch),
+                                      COALESCE(conversations.last_message_id, 0))
+                                THEN excluded.last_activity_at ELSE conversations.last_activity_at END,
+        unread_count = conversations.unread_count + excluded.unread_count
+""").bindparams(bindparam('created_at', type_=db.DateTime), bindparam('epoch', EPOCH, type_=db.DateTime))
+
+
+def record_messages(messages):
+    """
+    Update the summaries touched by newly sent messages.
+
+    Messages must be flushed (they need ids). The last message of a
+    conversation only ever moves forward in (created_at, id) order, so a
+    message committed after a newer one does not replace it. Runs in the
+    caller's transaction: one executemany for direct messages and one for
+    channels.
+    """
+    direct_rows = []
+    channel_rows = []
+    # (room, partner_id, channel_id, sender_id) -> messages added to the unread counters
+    deltas = {}
+    for message in sorted(messages, key=lambda m: (m.created_at, m.id)):
+        if message.channel_id:
+            channel_rows.append({
+                'b_channel_id': message.channel_id,
+                'b_sender_id': message.sender_id,
+                'b_message_id': message.id,
+                'b_created_at': message.created_at
+            })
+            key = (f'channel_{message.channel_id}', None, message.channel_id, message.sender_id)
+            deltas[key] = deltas.get(key, 0) + 1
+        elif message.recipient_id:
+            direct_rows.append({
+                'user_id': message.sender_id, 'partner_id': message.recipient_id,
+                'message_id': message.id, 'created_at': message.created_at, 'unread': 0
+            })
+            if message.recipient_id != message.sender_id:
+                direct_rows.append({
+                    'user_id': message.recipient_id, 'partner_id': message.sender_id,
+                    'message_id': message.id, 'created_at': message.created_at, 'unread': 1
+                })
+                key = (f'user_{message.recipient_id}', message.sender_id, None, message.sender_id)
+                deltas[key] = deltas.get(key, 0) + 1
+
+    if direct_rows:
+        db.session.execute(_UPSERT_DIRECT, direct_rows)
+    if channel_rows:
+        newer = tuple_(bindparam('b_created_at', type_=db.DateTime), bindparam('b_message_id')) > \
+            _key(channel_members.c.last_activity_at, channel_members.c.last_message_id)
+        db.session.execute(
+            channel_members.update()
+            .where(channel_members.c.channel_id == bindparam('b_channel_id'))
+            .values(
+                last_message_id=case((newer, bindparam('b_message_id')), else_=channel_members.c.last_message_id),
+                last_activity_at=case((newer, bindparam('b_created_at', type_=db.DateTime)),
+                                      else_=channel_members.c.last_activity_at),
+                unread_count=channel_members.c.unread_count + case(
+                    (channel_members.c.user_id == bindparam('b_sender_id'), 0), else_=1
+                )
+            ),
+            channel_rows
+        )
+
+    # A channel delta goes to the channel room once; every member but the
+    # sender applies it
+    for (room, partner_id, channel_id, sender_id), delta in deltas.items():
+        _queue_unread_delta(room, {'user_id': partner_id, 'channel_id': channel_id,
+                                   'sender_id': sender_id, 'delta': delta})
+
+
+def _queue_unread_delta(room, data):
+    """Hold an 'unread_delta' event until the transaction commits"""
+    db.session.info.setdefault(PENDING_UNREAD_KEY, []).append((room, data))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _emit_unread_deltas(session):
+    pending = session.info.pop(PENDING_UNREAD_KEY, None)
+    if not pending:
+        return
+
+    from app import socketio
+    for room, data in pending:
+        socketio.emit('unread_delta', data, room=room)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_unread_deltas(session):
+    session.info.pop(PENDING_UNREAD_KEY, None)
+
+
+def _conversation_target(user_id, partner_id=None, channel_id=None):
+    """(table, row filter, filter on messages counted as unread) of one conversation"""
+    if channel_id:
+        return (
+            channel_members,
+            db.and_(channel_members.c.channel_id == channel_id, channel_members.c.user_id == user_id),
+            db.and_(Message.channel_id == channel_id, Message.sender_id != user_id)
+        )
+    table = Conversation.__table__
+    return (
+        table,
+        db.and_(table.c.user_id == user_id, table.c.partner_id == partner_id),
+        db.and_(Message.sender_id == partner_id, Message.recipient_id == user_id, Message.channel_id.is_(None))
+    )
+
+
+def _key(created_at_column, id_column):
+    """(created_at, id) ordering key of the message a mark or summary points at"""
+    return tuple_(db.func.coalesce(created_at_column, literal(EPOCH, db.DateTime)),
+                  db.func.coalesce(id_column, 0))
+
+
+def message_created_at(message_id):
+    """created_at of a committed message, None while it is not written yet"""
+    return db.session.scalar(db.select(Message.created_at).where(Message.id == message_id))
+
+
+def advance_read(user_id, up_to_id, partner_id=None, channel_id=None):
+    """
+    Move user_id's read mark in a conversation up to message up_to_id.
+
+    One UPDATE raises the read and delivery marks and re-derives the unread
+    count from the messages after the mark (a range on the keyset index).
+    Marks are compared in (created_at, id) order: they never move backwards,
+    nor past the conversation's last message. The change of the unread
+    counter is pushed to user_id's other sessions as an 'unread_delta'
+    after commit.
+
+    Returns:
+        bool: True when the mark advanced
+    """
+    created_at = message_created_at(up_to_id)
+    if created_at is None:
+        return False
+    table, row, unread_filter = _conversation_target(user_id, partner_id, channel_id)
+    unread_before = db.session.scalar(db.select(table.c.unread_count).where(row))
+    mark = tuple_(literal(created_at, db.DateTime), literal(up_to_id))
+    unread = db.select(db.func.count(Message.id)).where(
+        unread_filter, tuple_(Message.created_at, Message.id) > mark
+    ).scalar_subquery()
+    delivered_behind = _key(table.c.last_delivered_at, table.c.last_delivered_message_id) < mark
+
+    result = db.session.execute(
+        table.update()
+        .where(row, _key(table.c.last_read_at, table.c.last_read_message_id) < mark,
+               tuple_(table.c.last_activity_at, table.c.last_message_id) >= mark)
+        .values(
+            last_read_message_id=up_to_id,
+            last_read_at=created_at,
+            last_delivered_message_id=case((delivered_behind, up_to_id),
+                                           else_=table.c.last_delivered_message_id),
+            last_delivered_at=case((delivered_behind, literal(created_at, db.DateTime)),
+                                   else_=table.c.last_delivered_at),
+            unread_count=unread
+        )
+        .returning(table.c.unread_count)
+    )
+    unread_after = result.scalar()
+    if unread_after is None:
+        return False
+    if unread_after != unread_before:
+        _queue_unread_delta(f'user_{user_id}', {'user_id': partner_id, 'channel_id': channel_id,
+                                                 'delta': unread_after - unread_before,
+                                                 'unread_count': unread_after})
+    return True
+
+
+def advance_delivered(user_id, up_to_id, partner_id=None, channel_id=None):
+    """Move user_id's delivery mark up to message up_to_id; True when it advanced"""
+    created_at = message_created_at(up_to_id)
+    if created_at is None:
+        return False
+    table, row, _ = _conversation_target(user_id, partner_id, channel_id)
+    mark = tuple_(literal(created_at, db.DateTime), literal(up_to_id))
+    result = db.session.execute(
+        table.update()
+        .where(row, _key(table.c.last_delivered_at, table.c.last_delivered_message_id) < mark,
+               tuple_(table.c.last_activity_at, table.c.last_message_id) >= mark)
+        .values(last_delivered_message_id=up_to_id, last_delivered_at=created_at)
+    )
+    return result.rowcount > 0
+
+
+def get_marks(user_id, partner_id=None, channel_id=None):
+    """
+    Return user_id's read and delivery marks as (created_at, id) keys,
+    (EPOCH, 0) when unset; a message is read or delivered when its own
+    (created_at, id) is at or below the mark
+    """
+    table, row, _ = _conversation_target(user_id, partner_id, channel_id)
+    marks = db.session.execute(
+        db.select(table.c.last_read_at, table.c.last_read_message_id,
+                  table.c.last_delivered_at, table.c.last_delivered_message_id).where(row)
+    ).first()
+    if not marks:
+        return (EPOCH, 0), (EPOCH, 0)
+    return (marks[0] or EPOCH, marks[1] or 0), (marks[2] or EPOCH, marks[3] or 0)
+
+
+def emit_read_up_to(reader_id, up_to_id, partner_id=None, channel_id=None):
+    """Tell the other side of a conversation how far reader_id has read, in one event"""
+    from app import socketio
+    created_at = message_created_at(up_to_id)
+    data = {'user_id': reader_id, 'message_id': up_to_id,
+            'created_at': created_at.isoformat() if created_at else None}
+    if channel_id:
+        data['channel_id'] = channel_id
+        socketio.emit('read_up_to', data, room=f'channel_{channel_id}')
+    else:
+        socketio.emit('read_up_to', data, room=f'user_{partner_id}')
+
+
+def id_ranges(ids):
+    """Collapse message ids into sorted, disjoint [first, last] ranges"""
+    ranges = []
+    for message_id in sorted(set(ids)):
+        if ranges and message_id == ranges[-1][1] + 1:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ranges
+
+
+def parse_ack_ranges(data, max_ranges):
+    """
+    Message ids of a batched ack, as merged [first, last] ranges.
+
+    The payload lists ids ({'ids': [...]}), ranges ({'ranges': [[first, last], ...]})
+    or both.
+
+    Raises:
+        ValueError: malformed ids, or more than max_ranges ranges after merging
+    """
+    ranges = [[message_id, message_id] for message_id in data.get('ids') or []]
+    ranges += [list(pair) for pair in data.get('ranges') or []]
+    merged = []
+    for first, last in sorted(ranges):
+        if type(first) is not int or type(last) is not int or not 0 < first <= last:
+            raise ValueError('message ids must be positive integers')
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    if len(merged) > max_ranges:
+        raise ValueError(f'more than {max_ranges} id ranges')
+    return merged
+
+
+def acknowledge_messages(user_id, ranges, read=False, limit=1000):
+    """
+    Apply a batched delivery (or read) ack of user_id.
+
+    One SELECT finds the acknowledged messages user_id received; each
+    conversation they belong to then moves its mark to its newest one, in
+    (created_at, id) order, with a single UPDATE (advance_delivered / advance_read), so a channel opened with
+    100 unread messages costs one statement rather than 100.
+
+    Args:
+        user_id: Acknowledging user
+        ranges: [first, last] id ranges (see parse_ack_ranges)
+        read: Move read marks instead of delivery marks
+        limit: Most messages looked at
+
+    Returns:
+        dict: sender_id -> [first, last] ranges of their messages now acknowledged
+    """
+    channel_ids = db.select(channel_members.c.channel_id).where(channel_members.c.user_id == user_id)
+    rows = db.session.execute(
+        db.select(Message.id, Message.sender_id, Message.channel_id)
+        .where(
+            db.or_(*[Message.id.between(first, last) for first, last in ranges]),
+            Message.sender_id != user_id,
+            db.or_(
+                db.and_(Message.recipient_id == user_id, Message.channel_id.is_(None)),
+                Message.channel_id.in_(channel_ids)
+            )
+        )
+        .order_by(Message.created_at, Message.id).limit(limit)
+    ).all()
+
+    conversations = {}
+    for message_id, sender_id, channel_id in rows:
+        key = (None, channel_id) if channel_id else (sender_id, None)
+        conversations.setdefault(key, []).append((message_id, sender_id))
+
+    advance = advance_read if read else advance_delivered
+    acknowledged = {}
+    for (partner_id, channel_id), messages in conversations.items():
+        if advance(user_id, messages[-1][0], partner_id=partner_id, channel_id=channel_id):
+            for message_id, sender_id in messages:
+                acknowledged.setdefault(sender_id, []).append(message_id)
+    return {sender_id: id_ranges(ids) for sender_id, ids in acknowledged.items()}
+
+
+def emit_message_acks(reader_id, acknowledged, status):
+    """Send each sender one compact 'messages_ack' with the id ranges of theirs that reader_id delivered/read"""
+    from app import socketio
+    for sender_id, ranges in acknowledged.items():
+        socketio.emit('messages_ack', {'user_id': reader_id, 'status': status, 'ranges': ranges},
+                      room=f'user_{sender_id}')
+
+
+def get_unread_direct_total(user_id):
+    """Total unread direct messages of user_id, summed from the conversation counters"""
+    return db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(Conversation.unread_count), 0))
+        .where(Conversation.user_id == user_id)
+    )
+
+
+def get_unread_counts(user_id):
+    """
+    Non-zero unread counters of user_id, read from the conversation rows.
+
+    Returns:
+        list: [{'user_id': partner_id or None, 'channel_id': channel_id or None, 'unread_count': n}]
+    """
+    counts = [
+        {'user_id': partner_id, 'channel_id': None, 'unread_count': count}
+        for partner_id, count in db.session.execute(
+            db.select(Conversation.partner_id, Conversation.unread_count)
+            .where(Conversation.user_id == user_id, Conversation.unread_count > 0)
+        )
+    ]
+    counts += [
+        {'user_id': None, 'channel_id': channel_id, 'unread_count': count}
+        for channel_id, count in db.session.execute(
+            db.select(channel_members.c.channel_id, channel_members.c.unread_count)
+            .where(channel_members.c.user_id == user_id, channel_members.c.unread_count > 0)
+        )
+    ]
+    return counts
+
+
+def get_unread_total(user_id):
+    """Unread direct and channel messages of user_id, summed from the counters"""
+    channel_total = db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(channel_members.c.unread_count), 0))
+        .where(channel_members.c.user_id == user_id)
+    )
+    return get_unread_direct_total(user_id) + channel_total
+
+
+def get_recent_conversations(user_id, limit=10):
+    """Return the user's latest direct conversations, newest first"""
+    return Conversation.query.options(
+        db.joinedload(Conversation.partner), db.joinedload(Conversation.last_message)
+    ).filter(
+        Conversation.user_id == user_id
+    ).order_by(Conversation.last_activity_at.desc()).limit(limit).all()
+
+
+def get_channel_summaries(user_id):
+    """Return (channel, unread_count) for the user's channels, most recently active first"""
+    return db.session.query(ChatChannel, channel_members.c.unread_count).join(
+        channel_members, channel_members.c.channel_id == ChatChannel.id
+    ).filter(
+        channel_members.c.user_id == user_id
+    ).order_by(channel_members.c.last_activity_at.desc(), ChatChannel.name).all()
+
+
+def encode_cursor(message):
+    """Opaque keyset cursor pointing at message: its (created_at, id)"""
+    raw = f'{message.created_at.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at, id) of a cursor; ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+
+
+def _history_query(model, user_id, partner_id, channel_id, before):
+    """Messages of one conversation in model's table, newest first, older than the cursor"""
+    if channel_id:
+        query = model.query.filter(model.channel_id == channel_id)
+    else:
+        query = model.query.filter(
+            db.or_(
+                db.and_(model.sender_id == user_id, model.recipient_id == partner_id),
+                db.and_(model.sender_id == partner_id, model.recipient_id == user_id)
+            ),
+            model.channel_id.is_(None)
+        )
+    if before:
+        created_at, message_id = decode_cursor(before)
+        query = query.filter(
+            tuple_(model.created_at, model.id) < tuple_(literal(created_at, db.DateTime), literal(message_id))
+        )
+    return query.order_by(model.created_at.desc(), model.id.desc())
+
+
+def get_history(user_id, partner_id=None, channel_id=None, before=None, limit=50):
+    """
+    Return one page of a conversation, newest page first.
+
+    Keyset paging on (created_at, id): the query walks
+    idx_messages_channel_created or idx_messages_pair_created backwards from
+    the cursor and never counts or skips rows. Paging continues into
+    archived_messages: archived rows are older than the hot ones except
+    around messages kept hot by the archival job, so the archive is read
+    only when the hot page runs short or its newest row falls inside it.
+
+    Args:
+        user_id: Viewing user (one side of a direct conversation)
+        partner_id / channel_id: The conversation
+        before: Cursor from a previous page; None for the latest messages
+        limit: Page size
+
+    Returns:
+        tuple: (messages oldest first, cursor for the next older page or None)
+    """
+    page = _history_query(Message, user_id, partner_id, channel_id, before).limit(limit + 1).all()
+    archived = _history_query(ArchivedMessage, user_id, partner_id, channel_id, before)
+    if len(page) > limit:
+        newest = archived.with_entities(ArchivedMessage.created_at, ArchivedMessage.id).first()
+        if newest is not None and tuple(newest) > (page[-1].created_at, page[-1].id):
+            page += archived.limit(limit + 1).all()
+    else:
+        page += archived.limit(limit + 1 - len(page)).all()
+    page = sorted(page, key=lambda message: (message.created_at, message.id), reverse=True)[:limit + 1]
+
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit][::-1], next_cursor
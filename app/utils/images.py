@@ -0,0 +1,180 @@
+"""
+Image variant pipeline
+Profile pictures, organisation logos and chat images are resized into a few
+fixed sizes (plus a WebP copy of each) by a background worker pool, so the
+upload request only pays for saving the original
+"""
+
+from flask import current_app, request, url_for, has_request_context
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+import os
+import threading
+import uuid
+
+# kind -> [(variant name, longest side in px, crop to square)], smallest first
+IMAGE_VARIANTS = {
+    'avatar': [('sm', 48, True), ('md', 128, True), ('lg', 256, True)],
+    'logo': [('sm', 64, False), ('md', 200, False)],
+    'chat': [('thumb', 480, False)],
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(app):
+    """
+    Return the shared worker pool, creating it on first use.
+
+    Under gevent the pool is gevent's, whose workers are real OS threads;
+    monkey patching would otherwise turn them into green threads and a
+    resize would stall every connection of the process. Under eventlet the
+    jobs themselves hop onto eventlet's native thread pool (see _run_job).
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            executor_class = ThreadPoolExecutor
+            if app.config.get('SOCKETIO_ASYNC_MODE') == 'gevent':
+                from gevent.threadpool import ThreadPoolExecutor as executor_class
+            _executor = executor_class(
+                max_workers=app.config['IMAGE_WORKERS'],
+                thread_name_prefix='image-variants'
+            )
+        return _executor
+
+
+def variant_path(path, name, webp=False):
+    """Return where a variant of the image at path is stored (next to it)"""
+    stem, extension = os.path.splitext(path)
+    if webp:
+        extension = '.webp'
+    elif extension.lower() not in ('.jpg', '.jpeg', '.png'):
+        extension = '.png'
+    return f'{stem}_{name}{extension}'
+
+
+def _save_atomic(image, path, **options):
+    """Write via a temporary file so a half-written variant is never served"""
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        image.save(tmp_path, **options)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generate_variants(path, kind):
+    """
+    Create every variant of kind for the image at path.
+
+    Returns:
+        list: Paths written
+    """
+    written = []
+    with Image.open(path) as source:
+        source = ImageOps.exif_transpose(source)
+        has_alpha = source.mode in ('RGBA', 'LA') or 'transparency' in source.info
+        source = source.convert('RGBA' if has_alpha else 'RGB')
+
+        for name, size, crop in IMAGE_VARIANTS[kind]:
+            fallback_path = variant_path(path, name)
+            webp_path = variant_path(path, name, webp=True)
+            if os.path.exists(fallback_path) and os.path.exists(webp_path):
+                # Shared blobs are immutable, so existing variants are current
+                continue
+
+            if crop:
+                image = ImageOps.fit(source, (size, size), Image.LANCZOS)
+            else:
+                image = source.copy()
+                image.thumbnail((size, size), Image.LANCZOS)
+
+            if fallback_path.lower().endswith(('.jpg', '.jpeg')):
+                if has_alpha:
+                    image_rgb = Image.new('RGB', image.size, 'white')
+                    image_rgb.paste(image, mask=image.getchannel('A'))
+                else:
+                    image_rgb = image
+                _save_atomic(image_rgb, fallback_path, format='JPEG', quality=85, optimize=True)
+            else:
+                _save_atomic(image, fallback_path, format='PNG', optimize=True)
+
+            _save_atomic(image, webp_path, format='WEBP', quality=80, method=4)
+            written += [fallback_path, webp_path]
+
+    return written
+
+
+def _run_job(app, path, kind):
+    """Worker entry point; failures are logged, the original stays usable"""
+    try:
+        if app.config.get('SOCKETIO_ASYNC_MODE') == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(generate_variants, path, kind)
+        return generate_variants(path, kind)
+    except Exception as e:
+        app.logger.error(f"Image variant generation failed for {path}: {e}")
+        return []
+
+
+def schedule_variants(path, kind):
+    """
+    Queue variant generation for an uploaded image.
+
+    Args:
+        path: Absolute path of the saved original
+        kind: Key of IMAGE_VARIANTS
+
+    Returns:
+        Future resolving to the list of paths written
+    """
+    app = current_app._get_current_object()
+    return _get_executor(app).submit(_run_job, app, path, kind)
+
+
+def pick_variant(kind, size):
+    """Return the smallest variant name covering size px, or the largest one"""
+    variants = IMAGE_VARIANTS[kind]
+    for name, max_side, _ in variants:
+        if max_side >= size:
+            return name
+    return variants[-1][0]
+
+
+def accepts_webp():
+    """True when the client explicitly lists image/webp in its Accept header"""
+    if not has_request_context():
+        return False
+    return any(mimetype == 'image/webp' and quality for mimetype, quality in request.accept_mimetypes)
+
+
+def image_url(url, kind, size):
+    """
+    Return the URL of the best variant of a static image for size px.
+
+    Falls back to the original while variants are still being generated.
+    """
+    if not url or not url.startswith('/static/'):
+        return url
+
+    static_path = os.path.join(current_app.static_folder, url[len('/static/'):])
+    name = pick_variant(kind, size)
+    candidates = [variant_path(static_path, name)]
+    if accepts_webp():
+        candidates.insert(0, variant_path(static_path, name, webp=True))
+
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return '/static/' + os.path.relpath(candidate, current_app.static_folder).replace(os.sep, '/')
+    return url
+
+
+def avatar_url(user, size=48):
+    """Return the profile picture URL of user displayed at size CSS px (2x density)"""
+    if not user or not user.profile_picture:
+        return url_for('static', filename='uploads/profiles/default.png')
+    filename = os.path.basename(user.profile_picture)
+    return image_url(url_for('static', filename=f'uploads/profiles/{filename}'), 'avatar', size * 2)
@@ -0,0 +1,190 @@
+"""
+Channel membership cache
+Keeps, per application, the channel ids of each user and the member count
+of each channel, so joining rooms on connect and checking membership are set
+lookups instead of loading ChatChannel.members. Entries are loaded lazily
+and kept current from membership changes as they commit; with a message
+queue, other processes drop the entries a commit touched (see
+app/utils/socket_queue.py).
+"""
+
+from flask import current_app
+from app import db
+from app.models import ChatChannel, User
+from app.models.messaging import channel_members
+from app.utils.socket_queue import cache_change_handler, publish_cache_change, uses_message_queue
+from sqlalchemy import event, inspect
+import threading
+
+PENDING_KEY = 'membership_changes'
+
+
+class MembershipCache:
+    """user_id -> set of channel ids, channel_id -> member count"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.user_channels = {}
+        self.member_counts = {}
+
+    def _channel_ids(self, user_id):
+        channel_ids = self.user_channels.get(user_id)
+        if channel_ids is None:
+            channel_ids = set(db.session.scalars(
+                db.select(channel_members.c.channel_id).where(channel_members.c.user_id == user_id)
+            ))
+            self.user_channels[user_id] = channel_ids
+        return channel_ids
+
+    def channel_ids(self, user_id):
+        """Channel ids user_id belongs to"""
+        with self.lock:
+            return frozenset(self._channel_ids(user_id))
+
+    def is_member(self, user_id, channel_id):
+        with self.lock:
+            return channel_id in self._channel_ids(user_id)
+
+    def member_count(self, channel_id):
+        with self.lock:
+            count = self.member_counts.get(channel_id)
+            if count is None:
+                count = db.session.scalar(
+                    db.select(db.func.count()).select_from(channel_members)
+                    .where(channel_members.c.channel_id == channel_id)
+                )
+                self.member_counts[channel_id] = count
+            return count
+
+    def apply(self, added=(), removed=(), deleted_channels=(), deleted_users=()):
+        """Apply committed (user_id, channel_id) membership changes to the entries held"""
+        with self.lock:
+            # Counts of changed channels are dropped rather than adjusted: one
+            # loaded inside the committing transaction already includes its changes
+            for user_id, channel_id in added:
+                if user_id in self.user_channels:
+                    self.user_channels[user_id].add(channel_id)
+                self.member_counts.pop(channel_id, None)
+            for user_id, channel_id in removed:
+                if user_id in self.user_channels:
+                    self.user_channels[user_id].discard(channel_id)
+                self.member_counts.pop(channel_id, None)
+            for channel_id in deleted_channels:
+                self.member_counts.pop(channel_id, None)
+                for channel_ids in self.user_channels.values():
+                    channel_ids.discard(channel_id)
+            for user_id in deleted_users:
+                self.user_channels.pop(user_id, None)
+            if deleted_users:
+                # Cascaded rows left the counts of their channels behind
+                self.member_counts.clear()
+
+    def invalidate(self, user_ids=(), channel_ids=()):
+        """Drop entries so they are reloaded on next use"""
+        with self.lock:
+            for user_id in user_ids:
+                self.user_channels.pop(user_id, None)
+            for channel_id in channel_ids:
+                self.member_counts.pop(channel_id, None)
+
+
+def get_membership_cache():
+    """Return the current application's membership cache, creating it on first use"""
+    cache = current_app.extensions.get('membership_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('membership_cache', MembershipCache())
+    return cache
+
+
+def channel_ids_of(user_id):
+    """Channel ids of user_id"""
+    return get_membership_cache().channel_ids(user_id)
+
+
+def is_channel_member(user_id, channel_id):
+    """True if user_id belongs to channel_id"""
+    return get_membership_cache().is_member(user_id, channel_id)
+
+
+def channel_member_count(channel_id):
+    """Number of members of channel_id"""
+    return get_membership_cache().member_count(channel_id)
+
+
+def invalidate_memberships(user_ids=(), channel_ids=()):
+    """
+    Reload entries after the transaction commits.
+
+    For channel_members writes the flush listener cannot see (Core or raw
+    SQL inserts and deletes).
+    """
+    pending = db.session.info.setdefault(PENDING_KEY, _empty_changes())
+    pending['stale_users'].update(user_ids)
+    pending['stale_channels'].update(channel_ids)
+
+
+def _empty_changes():
+    return {'added': set(), 'removed': set(), 'deleted_channels': set(), 'deleted_users': set(),
+            'stale_users': set(), 'stale_channels': set()}
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_membership_changes(session, flush_context):
+    """Record membership changes made through ChatChannel.members or User.channels"""
+    if not current_app or (current_app.extensions.get('membership_cache') is None and not uses_message_queue()):
+        return
+
+    pending = session.info.setdefault(PENDING_KEY, _empty_changes())
+    # Both sides of the relationship may report the same pair, hence the sets
+    for obj in session.new | session.dirty:
+        if isinstance(obj, ChatChannel):
+            history = inspect(obj).attrs.members.history
+            pending['added'].update((user.id, obj.id) for user in history.added)
+            pending['removed'].update((user.id, obj.id) for user in history.deleted)
+        elif isinstance(obj, User):
+            history = inspect(obj).attrs.channels.history
+            pending['added'].update((obj.id, channel.id) for channel in history.added)
+            pending['removed'].update((obj.id, channel.id) for channel in history.deleted)
+    for obj in session.deleted:
+        if isinstance(obj, ChatChannel):
+            pending['deleted_channels'].add(obj.id)
+        elif isinstance(obj, User):
+            pending['deleted_users'].add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_membership_changes(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending or not any(pending.values()):
+        return
+    cache = current_app.extensions.get('membership_cache')
+    if cache is not None:
+        cache.apply(pending['added'] - pending['removed'], pending['removed'] - pending['added'],
+                    pending['deleted_channels'], pending['deleted_users'])
+        cache.invalidate(pending['stale_users'], pending['stale_channels'])
+    pairs = pending['added'] | pending['removed']
+    publish_cache_change('memberships', {
+        'user_ids': sorted({user_id for user_id, _ in pairs} | pending['stale_users']),
+        'channel_ids': sorted({channel_id for _, channel_id in pairs} | pending['stale_channels']),
+        'deleted_channels': sorted(pending['deleted_channels']),
+        'deleted_users': sorted(pending['deleted_users']),
+    })
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_membership_changes(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    cache = current_app.extensions.get('membership_cache') if current_app else None
+    if pending and cache is not None:
+        # An entry loaded after the flush may hold the rolled back pairs
+        pairs = pending['added'] | pending['removed']
+        cache.invalidate({user_id for user_id, _ in pairs}, {channel_id for _, channel_id in pairs})
+
+
+@cache_change_handler('memberships')
+def _drop_changed_memberships(data):
+    """Membership changes committed by another process: reload what they touched"""
+    cache = current_app.extensions.get('membership_cache')
+    if cache is not None:
+        cache.apply(deleted_channels=data['deleted_channels'], deleted_users=data['deleted_users'])
+        cache.invalidate(data['user_ids'], data['channel_ids'])
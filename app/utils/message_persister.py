@@ -0,0 +1,335 @@
+"""
+Write-behind persistence of chat messages
+Messages get their id up front from a block of reserved ids, are emitted to
+the conversation at once and written by a background worker that
+group-commits them in small batches. Each sender is acknowledged with the
+ids that became durable; recipients are told to take back a message that
+could not be stored. CHAT_PERSIST_MODE = 'sync' commits every message
+before it is emitted instead. The queue is drained when the process exits.
+
+Ids come from per-process blocks and are handed out before commit, so they
+follow neither send nor commit order across processes: messages are ordered
+by (created_at, id) wherever order matters (see app/utils/conversations.py).
+Every inserting transaction also numbers its messages from the commit
+sequence, which follows commit order and drives reconnect sync.
+"""
+
+from flask import current_app
+from app import db, socketio
+from app.models import Message
+from app.utils.conversations import record_messages
+from sqlalchemy import event, text
+from datetime import datetime
+import atexit
+import queue
+import threading
+import time
+
+PERSIST_MODES = ('write_behind', 'sync')
+
+
+class MessageIdAllocator:
+    """
+    Hands out message ids from blocks reserved in id_sequences.
+
+    A reservation is one short transaction of its own, so processes sharing
+    the database never hand out the same id. The sequence is also raised past
+    MAX(messages.id), which keeps it ahead of rows inserted without it.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.end_id = 0
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id >= self.end_id:
+                self._reserve()
+            message_id = self.next_id
+            self.next_id += 1
+            return message_id
+
+    def _reserve(self):
+        greatest = 'GREATEST' if db.engine.dialect.name == 'postgresql' else 'MAX'
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO id_sequences (name, next_id) VALUES ('messages', 1) ON CONFLICT (name) DO NOTHING"
+            ))
+            end_id = connection.execute(text(f"""
+                UPDATE id_sequences
+                SET next_id = {greatest}(next_id, (SELECT COALESCE(MAX(id), 0) + 1 FROM messages)) + :block
+                WHERE name = 'messages'
+                RETURNING next_id
+            """), {'block': self.block_size}).scalar()
+        self.next_id, self.end_id = end_id - self.block_size, end_id
+
+
+class MessagePersister:
+    """Queue of prepared messages and the worker that group-commits them"""
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_done = threading.Condition(self.lock)
+        self.pending_ids = set()
+        self.worker = None
+
+    def submit(self, message):
+        """Queue a prepared message for the next batch"""
+        with self.lock:
+            self.pending_ids.add(message.id)
+            if self.worker is None:
+                self.worker = socketio.start_background_task(self._run)
+                atexit.register(self.drain)
+        self.queue.put(message)
+
+    def wait_for(self, message_id, timeout):
+        """
+        Wait until message_id's batch has been written (or given up on).
+
+        Returns:
+            bool: True if the message was still queued and its batch is now done
+        """
+        with self.batch_done:
+            if message_id not in self.pending_ids:
+                return False
+            return self.batch_done.wait_for(lambda: message_id not in self.pending_ids, timeout)
+
+    def flush(self, timeout=None):
+        """
+        Block until every submitted message has been written or given up on.
+
+        Returns:
+            bool: False if messages were still queued when the timeout ran out
+        """
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout)
+
+    def drain(self):
+        """
+        Write what is still queued before the process exits (registered with
+        atexit once the worker starts): those messages have already been
+        emitted to their conversation
+        """
+        if not self.flush(self.app.config['CHAT_PERSIST_SHUTDOWN_TIMEOUT']):
+            self.app.logger.error(
+                f"Exiting with {self.queue.unfinished_tasks} chat message(s) not written"
+            )
+
+    def _next_batch(self):
+        """Wait for a message, then gather more until the batch is full or its delay is up"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.app.config['CHAT_PERSIST_BATCH_DELAY']
+        while len(batch) < self.app.config['CHAT_PERSIST_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.app.app_context():
+                    self._write(batch)
+            except Exception as e:
+                # Keep the worker alive; _write has already retried the batch
+                self.app.logger.error(f"Chat message persister error: {e}")
+            finally:
+                with self.batch_done:
+                    self.pending_ids.difference_update(message.id for message in batch)
+                    self.batch_done.notify_all()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        """
+        Commit one batch, retrying with exponential backoff. A batch that
+        still fails is written one message at a time, so only the messages
+        that cannot be stored (e.g. of a deleted channel) are given up on.
+        """
+        error = self._commit(batch, self.app.config['CHAT_PERSIST_MAX_RETRIES'])
+        if error is None:
+            return
+        if len(batch) > 1:
+            self.app.logger.warning(f"Writing {len(batch)} chat messages one at a time after: {error}")
+            failed = [message for message in batch if self._commit([message], 0) is not None]
+        else:
+            failed = batch
+        if failed:
+            self.app.logger.error(f"Giving up on {len(failed)} chat messages: {error}")
+            _notify_senders('message_failed', failed)
+            _retract(failed)
+
+    def _commit(self, batch, retries):
+        """
+        Write and commit messages, retrying with exponential backoff.
+
+        Returns:
+            Exception or None: the last error, None once committed
+        """
+        for attempt in range(retries + 1):
+            try:
+                write_messages(batch)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if attempt == retries:
+                    return e
+                self.app.logger.warning(f"Chat message batch failed (attempt {attempt + 1}): {e}")
+                socketio.sleep(self.app.config['CHAT_PERSIST_RETRY_BACKOFF'] * 2 ** attempt)
+            else:
+                _notify_senders('message_persisted', batch)
+                return None
+            finally:
+                db.session.remove()
+
+
+def _extension(name, factory):
+    value = current_app.extensions.get(name)
+    if value is None:
+        value = current_app.extensions.setdefault(name, factory())
+    return value
+
+
+def get_id_allocator():
+    """Return the current application's message id allocator"""
+    return _extension('message_id_allocator',
+                      lambda: MessageIdAllocator(current_app.config['MESSAGE_ID_BLOCK_SIZE']))
+
+
+def get_message_persister():
+    """Return the current application's write-behind persister"""
+    return _extension('message_persister', lambda: MessagePersister(current_app._get_current_object()))
+
+
+def wait_until_persisted(message_id, timeout=1.0):
+    """
+    Wait for a message still queued for write-behind, e.g. before moving a
+    read mark onto it.
+
+    Returns:
+        bool: True if the message was queued and its batch has now been written
+    """
+    persister = current_app.extensions.get('message_persister')
+    return persister is not None and persister.wait_for(message_id, timeout)
+
+
+def _persist_mode():
+    mode = current_app.config['CHAT_PERSIST_MODE']
+    if mode not in PERSIST_MODES:
+        raise ValueError(f'Unknown chat persist mode: {mode}')
+    return mode
+
+
+def prepare_message(message):
+    """Give a new message its id, timestamps and column defaults before it is written"""
+    now = datetime.utcnow()
+    if message.id is None:
+        message.id = get_id_allocator().allocate()
+    for column in Message.__table__.columns:
+        if getattr(message, column.key) is None:
+            if column.key in ('created_at', 'updated_at'):
+                setattr(message, column.key, now)
+            elif column.default is not None and column.default.is_scalar:
+                setattr(message, column.key, column.default.arg)
+    return message
+
+
+def reserve_commit_seqs(count):
+    """
+    Take `count` numbers of the message commit sequence in the current
+    transaction and return the first.
+
+    The UPDATE locks the sequence row until the transaction ends, so
+    writers number their messages in the order they commit: once a number
+    is visible, no lower one can still be committed.
+    """
+    db.session.execute(text("""
+        INSERT INTO id_sequences (name, next_id)
+        SELECT 'message_commits', COALESCE(MAX(commit_seq), 0) + 1 FROM messages WHERE true
+        ON CONFLICT (name) DO NOTHING
+    """))
+    end_seq = db.session.execute(text("""
+        UPDATE id_sequences SET next_id = next_id + :count
+        WHERE name = 'message_commits'
+        RETURNING next_id
+    """), {'count': count}).scalar()
+    return end_seq - count
+
+
+@event.listens_for(db.session, 'before_flush')
+def _number_new_messages(session, flush_context, instances):
+    """Give messages added through the ORM their commit sequence numbers"""
+    messages = [obj for obj in session.new if isinstance(obj, Message) and obj.commit_seq is None]
+    if messages:
+        first_seq = reserve_commit_seqs(len(messages))
+        for offset, message in enumerate(messages):
+            message.commit_seq = first_seq + offset
+
+
+def write_messages(messages):
+    """Insert prepared messages and update their conversation summaries in the current transaction"""
+    # Numbered on every attempt: a rolled back batch gave its numbers back
+    first_seq = reserve_commit_seqs(len(messages))
+    for offset, message in enumerate(messages):
+        message.commit_seq = first_seq + offset
+    db.session.execute(
+        Message.__table__.insert(),
+        [{column.key: getattr(message, column.key) for column in Message.__table__.columns}
+         for message in messages]
+    )
+    record_messages(messages)
+
+
+def _notify_senders(event, messages):
+    """Send each sender one event listing its message ids"""
+    ids_by_sender = {}
+    for message in messages:
+        ids_by_sender.setdefault(message.sender_id, []).append(message.id)
+    for sender_id, ids in ids_by_sender.items():
+        socketio.emit(event, {'ids': ids}, room=f'user_{sender_id}')
+
+
+def _retract(messages):
+    """Take back messages that were emitted to their conversation but never stored"""
+    for message in messages:
+        data = {'id': message.id, 'sender_id': message.sender_id,
+                'recipient_id': message.recipient_id, 'channel_id': message.channel_id}
+        if message.channel_id:
+            socketio.emit('message_retracted', data, room=f'channel_{message.channel_id}')
+        elif message.recipient_id:
+            socketio.emit('message_retracted', data, room=f'user_{message.recipient_id}')
+
+
+def persist_message(message):
+    """
+    Persist a new chat message without making the sender wait on the disk.
+
+    The message gets its final id straight away, so it can be emitted
+    before it is written. In write-behind mode it is queued for the next
+    group commit; in sync mode it is committed here. Either way the sender
+    receives 'message_persisted' once it is durable (or 'message_failed',
+    while its recipients get 'message_retracted').
+
+    Args:
+        message: New Message, not added to the session
+
+    Returns:
+        Message: The same message, with id and timestamps set
+    """
+    prepare_message(message)
+    if _persist_mode() == 'sync':
+        write_messages([message])
+        db.session.commit()
+        _notify_senders('message_persisted', [message])
+    else:
+        get_message_persister().submit(message)
+    return message
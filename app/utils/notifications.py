@@ -0,0 +1,191 @@
+"""
+Notification fan-out service
+Writes one template to many recipients with a single INSERT ... SELECT and
+emits the matching Socket.IO event once the transaction commits
+"""
+
+from app import db
+from app.models import Notification, User
+from sqlalchemy import event, literal, exists, and_, bindparam
+from datetime import datetime
+
+
+# Templates are formatted with the payload passed to notify_users()
+NOTIFICATION_TEMPLATES = {
+    'task_assigned': {
+        'title': 'New Task Assigned',
+        'message': 'You have been assigned to: {task_title}',
+        'action_url': '/tasks/{task_id}',
+        # The notify_task_assignment trigger writes the same row on assignment
+        'dedupe': True,
+    },
+    'task_updated': {
+        'title': 'Task Status Updated',
+        'message': 'Task "{task_title}" status changed to {status}',
+        'action_url': '/tasks/{task_id}',
+    },
+    'comment_added': {
+        'title': 'New Comment on Task',
+        'message': '{actor_name} commented on: {task_title}',
+        'action_url': '/tasks/{task_id}',
+    },
+}
+
+PENDING_EMITS_KEY = 'pending_notification_emits'
+
+
+def notify_users(user_ids, template, payload, exclude_user_id=None):
+    """
+    Notify many users at once.
+
+    Args:
+        user_ids: Iterable of recipient user ids
+        template: Key of NOTIFICATION_TEMPLATES
+        payload: Values for the template (task_id links the notification to a task)
+        exclude_user_id: Recipient to skip, usually the acting user
+
+    Returns:
+        int: Number of notification rows inserted
+    """
+    spec = NOTIFICATION_TEMPLATES[template]
+    recipient_ids = _recipients(user_ids, exclude_user_id)
+    if not recipient_ids:
+        return 0
+
+    data = _render(template, payload)
+    title, message, action_url, task_id = data['title'], data['message'], data['action_url'], data['task_id']
+
+    recipients = db.select(
+        User.id,
+        literal(title),
+        literal(message),
+        literal(template),
+        literal(task_id),
+        literal(action_url),
+        literal(False),
+        literal(datetime.utcnow())
+    ).where(User.id.in_(recipient_ids))
+
+    if spec.get('dedupe'):
+        # Skip users who already have the same unread notification
+        recipients = recipients.where(~exists().where(and_(
+            Notification.user_id == User.id,
+            Notification.notification_type == template,
+            Notification.task_id == task_id,
+            Notification.is_read.isnot(True)  # trigger rows leave is_read NULL
+        )))
+
+    result = db.session.execute(
+        db.insert(Notification).from_select(
+            ['user_id', 'title', 'message', 'notification_type', 'task_id',
+             'action_url', 'is_read', 'created_at'],
+            recipients
+        )
+    )
+
+    db.session.info.setdefault(PENDING_EMITS_KEY, []).append((recipient_ids, data))
+
+    return result.rowcount
+
+
+def notify_users_batch(template, entries, exclude_user_id=None):
+    """
+    Send one template about many items (e.g. a bulk task import).
+
+    All rows go out in a single executemany INSERT and the events are emitted
+    together after commit.
+
+    Args:
+        template: Key of NOTIFICATION_TEMPLATES
+        entries: Iterable of (user_ids, payload) pairs
+        exclude_user_id: Recipient to skip, usually the acting user
+
+    Returns:
+        int: Number of notification rows inserted
+    """
+    spec = NOTIFICATION_TEMPLATES[template]
+    now = datetime.utcnow()
+    rows = []
+    pending = []
+    for user_ids, payload in entries:
+        recipient_ids = _recipients(user_ids, exclude_user_id)
+        if not recipient_ids:
+            continue
+        data = _render(template, payload)
+        pending.append((recipient_ids, data))
+        rows.extend({
+            'user_id': uid,
+            'title': data['title'],
+            'message': data['message'],
+            'task_id': data['task_id'],
+            'action_url': data['action_url']
+        } for uid in recipient_ids)
+
+    if not rows:
+        return 0
+
+    recipient = db.select(
+        bindparam('user_id', type_=db.Integer),
+        bindparam('title', type_=db.String),
+        bindparam('message', type_=db.Text),
+        literal(template),
+        bindparam('task_id', type_=db.Integer),
+        bindparam('action_url', type_=db.String),
+        literal(False),
+        literal(now)
+    )
+    if spec.get('dedupe'):
+        recipient = recipient.where(~exists().where(and_(
+            Notification.user_id == bindparam('user_id'),
+            Notification.notification_type == template,
+            Notification.task_id == bindparam('task_id'),
+            Notification.is_read.isnot(True)
+        )))
+
+    # Core table: an ORM insert with a parameter list would be a bulk insert
+    result = db.session.execute(
+        db.insert(Notification.__table__).from_select(
+            ['user_id', 'title', 'message', 'notification_type', 'task_id',
+             'action_url', 'is_read', 'created_at'],
+            recipient
+        ),
+        rows
+    )
+
+    db.session.info.setdefault(PENDING_EMITS_KEY, []).extend(pending)
+
+    return result.rowcount
+
+
+def _recipients(user_ids, exclude_user_id):
+    return sorted({int(uid) for uid in user_ids if uid} - {exclude_user_id})
+
+
+def _render(template, payload):
+    """Format a template into the notification event payload"""
+    spec = NOTIFICATION_TEMPLATES[template]
+    return {
+        'title': spec['title'].format(**payload),
+        'message': spec['message'].format(**payload),
+        'type': template,
+        'task_id': payload.get('task_id'),
+        'action_url': spec['action_url'].format(**payload)
+    }
+
+
+@event.listens_for(db.session, 'after_commit')
+def _emit_pending_notifications(session):
+    """Emit queued notification events once the rows are durable"""
+    pending = session.info.pop(PENDING_EMITS_KEY, None)
+    if not pending:
+        return
+
+    from app import socketio
+    for recipient_ids, data in pending:
+        socketio.emit('new_notification', data, room=[f'user_{uid}' for uid in recipient_ids])
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_pending_notifications(session):
+    """Drop queued events for rows that were rolled back"""
+    session.info.pop(PENDING_EMITS_KEY, None)
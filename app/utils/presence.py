@@ -0,0 +1,152 @@
+"""
+Presence service
+Counts each user's open Socket.IO connections in memory, so several tabs
+make one online user and only the last disconnect takes them offline.
+Changes are coalesced and sent as one 'presence_diff' per organisation room
+every PRESENCE_FLUSH_INTERVAL; last_seen reaches online_status in batches
+every PRESENCE_PERSIST_INTERVAL instead of a commit per connect.
+"""
+
+from flask import current_app
+from app import db, socketio
+from sqlalchemy import text
+from datetime import datetime
+import threading
+import time
+
+# SQLite (3.24+) and PostgreSQL share the ON CONFLICT syntax
+_UPSERT_LAST_SEEN = text("""
+    INSERT INTO online_status (user_id, is_online, last_seen)
+    VALUES (:user_id, :is_online, :last_seen)
+    ON CONFLICT (user_id) DO UPDATE SET
+        is_online = excluded.is_online,
+        last_seen = excluded.last_seen
+""")
+
+
+def organisation_room(organisation_id):
+    return f'org_{organisation_id}'
+
+
+class PresenceService:
+    """Connection counts, pending diffs and unsaved last_seen of one application"""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.organisations = {}
+        # organisation_id -> {user_id: online at the start of the window}
+        self.changes = {}
+        # user_id -> (last_seen, is_online) not yet written
+        self.unsaved = {}
+        self.last_persist = time.monotonic()
+        self.worker = None
+
+    def _changed(self, user_id, was_online):
+        organisation_id = self.organisations.get(user_id)
+        self.changes.setdefault(organisation_id, {}).setdefault(user_id, was_online)
+        self.unsaved[user_id] = (datetime.utcnow(), not was_online)
+
+    def connect(self, user_id, organisation_id):
+        """Count a new connection of user_id; True if it brought them online"""
+        with self.lock:
+            self.organisations[user_id] = organisation_id
+            count = self.connections.get(user_id, 0)
+            self.connections[user_id] = count + 1
+            if count == 0:
+                self._changed(user_id, was_online=False)
+            if self.worker is None:
+                self.worker = socketio.start_background_task(self._run)
+            return count == 0
+
+    def disconnect(self, user_id):
+        """Drop one connection of user_id; True if it was their last"""
+        with self.lock:
+            count = self.connections.get(user_id, 0)
+            if count > 1:
+                self.connections[user_id] = count - 1
+                return False
+            if count == 0:
+                return False
+            del self.connections[user_id]
+            self._changed(user_id, was_online=True)
+            return True
+
+    def is_online(self, user_id):
+        return user_id in self.connections
+
+    def online_user_ids(self, organisation_id):
+        with self.lock:
+            return sorted(user_id for user_id in self.connections
+                          if self.organisations.get(user_id) == organisation_id)
+
+    def take_diffs(self):
+        """
+        Net changes since the last call, per organisation.
+
+        A user who went offline and came back (or the reverse) within the
+        window is left out.
+
+        Returns:
+            dict: organisation_id -> {'online': [user ids], 'offline': [user ids]}
+        """
+        with self.lock:
+            changes, self.changes = self.changes, {}
+            diffs = {}
+            for organisation_id, users in changes.items():
+                online = sorted(u for u, was_online in users.items() if not was_online and u in self.connections)
+                offline = sorted(u for u, was_online in users.items() if was_online and u not in self.connections)
+                if online or offline:
+                    diffs[organisation_id] = {'online': online, 'offline': offline}
+            return diffs
+
+    def persist(self):
+        """Write unsaved last_seen values with one executemany; call inside an app context"""
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, {}
+            self.last_persist = time.monotonic()
+        if not unsaved:
+            return 0
+        try:
+            db.session.execute(_UPSERT_LAST_SEEN, [
+                {'user_id': user_id, 'is_online': is_online, 'last_seen': last_seen}
+                for user_id, (last_seen, is_online) in unsaved.items()
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Newer values recorded meanwhile win over the ones put back
+            with self.lock:
+                for user_id, value in unsaved.items():
+                    self.unsaved.setdefault(user_id, value)
+            raise
+        return len(unsaved)
+
+    def flush(self, persist=False):
+        """Emit pending diffs to the organisation rooms; persist last_seen when due (or asked)"""
+        for organisation_id, diff in self.take_diffs().items():
+            if organisation_id is not None:
+                socketio.emit('presence_diff', diff, room=organisation_room(organisation_id))
+        interval = self.app.config['PRESENCE_PERSIST_INTERVAL']
+        if persist or time.monotonic() - self.last_persist >= interval:
+            self.persist()
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.app.config['PRESENCE_FLUSH_INTERVAL'])
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.app.logger.error(f"Presence flush failed: {e}")
+                finally:
+                    db.session.remove()
+
+
+def get_presence():
+    """Return the current application's presence service, creating it on first use"""
+    service = current_app.extensions.get('presence')
+    if service is None:
+        service = current_app.extensions.setdefault('presence', PresenceService(current_app._get_current_object()))
+    return service
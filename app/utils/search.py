@@ -0,0 +1,156 @@
+"""
+Chat message search
+Full-text search over message content through the messages_fts FTS5 index
+(see create_search_index), ranked with bm25 and scoped to the conversations
+the user belongs to. When the hot messages do not fill the page, results
+continue from archived_messages_fts. Databases without the indexes fall back
+to a LIKE scan of both tables.
+"""
+
+from flask import current_app
+from markupsafe import Markup, escape
+from app import db
+from app.models import ChatChannel, Message, ArchivedMessage, User
+from sqlalchemy import text
+import re
+
+# Marks around matched terms in snippet(); control characters never appear in
+# escaped HTML, so they are swapped for <mark> tags after escaping
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+SNIPPET_TOKENS = 16
+
+_SEARCH_SQL = """
+    SELECT {index}.rowid,
+           snippet({index}, 0, char(2), char(3), '…', :snippet_tokens)
+    FROM {index}
+    WHERE {index} MATCH :match
+      AND ({index}.sender_id = :user_id
+           OR {index}.recipient_id = :user_id
+           OR {index}.channel_id IN (SELECT channel_id FROM channel_members WHERE user_id = :user_id))
+      {filters}
+    ORDER BY bm25({index})
+    LIMIT :limit
+"""
+
+# Hot messages are searched first, the archive only for what is left of the page
+_SEARCH_INDEXES = [('messages_fts', Message), ('archived_messages_fts', ArchivedMessage)]
+
+
+def has_search_index():
+    """True when the database has the messages_fts index (checked once per app)"""
+    available = current_app.extensions.get('message_search_fts')
+    if available is None:
+        available = db.engine.dialect.name == 'sqlite' and db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        )).first() is not None
+        current_app.extensions['message_search_fts'] = available
+    return available
+
+
+def build_match_query(query):
+    """
+    Turn user input into an FTS5 query: every word must match, the last one
+    as a prefix so results follow the user as they type.
+
+    Words are quoted, so FTS5 operators and punctuation in the input are
+    searched for literally instead of raising a syntax error.
+
+    Returns:
+        str: MATCH expression, or None when the input has no words
+    """
+    words = re.findall(r"\w[\w'-]*", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(snippet):
+    return Markup(
+        str(escape(snippet)).replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+    )
+
+
+def search_messages(user_id, query, channel_id=None, partner_id=None, limit=50):
+    """
+    Search the messages user_id can see: their direct messages and those of
+    channels they are a member of. Soft-deleted messages are not indexed.
+
+    Args:
+        user_id: Searching user
+        query: Text as typed by the user
+        channel_id / partner_id: Optionally restrict to one conversation
+        limit: Maximum number of results
+
+    Returns:
+        list: (Message or ArchivedMessage, highlighted snippet) pairs, best
+        match first, hot messages before archived ones
+    """
+    if not has_search_index():
+        return _search_messages_like(user_id, query, channel_id, partner_id, limit)
+
+    match = build_match_query(query)
+    if match is None:
+        return []
+
+    filters = []
+    params = {'match': match, 'user_id': user_id, 'snippet_tokens': SNIPPET_TOKENS}
+    if channel_id:
+        filters.append('AND {index}.channel_id = :channel_id')
+        params['channel_id'] = channel_id
+    elif partner_id:
+        filters.append("""
+            AND {index}.channel_id IS NULL
+            AND (({index}.sender_id = :user_id AND {index}.recipient_id = :partner_id)
+                 OR ({index}.sender_id = :partner_id AND {index}.recipient_id = :user_id))
+        """)
+        params['partner_id'] = partner_id
+
+    results = []
+    for index, model in _SEARCH_INDEXES:
+        if len(results) >= limit:
+            break
+        sql = _SEARCH_SQL.format(index=index, filters=' '.join(filters).format(index=index))
+        rows = db.session.execute(text(sql), dict(params, limit=limit - len(results))).all()
+        messages = {
+            message.id: message for message in model.query.options(
+                db.joinedload(model.sender), db.joinedload(model.channel)
+            ).filter(model.id.in_([row[0] for row in rows]))
+        }
+        results += [(messages[message_id], _highlight(snippet))
+                    for message_id, snippet in rows if message_id in messages]
+    return results
+
+
+def _search_messages_like(user_id, query, channel_id, partner_id, limit):
+    """Substring scan used when the FTS5 index is unavailable"""
+    if not query.strip():
+        return []
+    member_channels = db.session.query(ChatChannel.id).join(ChatChannel.members).filter(User.id == user_id)
+    results = []
+    for _, model in _SEARCH_INDEXES:
+        if len(results) >= limit:
+            break
+        messages = model.query.filter(
+            model.content.ilike(f'%{query.strip()}%'),
+            model.is_deleted.isnot(True),
+            db.or_(
+                model.sender_id == user_id,
+                model.recipient_id == user_id,
+                model.channel_id.in_(member_channels)
+            )
+        )
+        if channel_id:
+            messages = messages.filter(model.channel_id == channel_id)
+        elif partner_id:
+            messages = messages.filter(
+                model.channel_id.is_(None),
+                model.sender_id.in_((user_id, partner_id)),
+                model.recipient_id.in_((user_id, partner_id))
+            )
+        messages = messages.order_by(model.created_at.desc()).limit(limit - len(results)).all()
+        results += [(message, escape(message.content)) for message in messages]
+    return results
@@ -0,0 +1,102 @@
+"""
+Socket.IO message queue
+With several worker processes (or nodes) each one only holds the clients it
+accepted, so an emit has to go through a queue every process listens on.
+SOCKETIO_MESSAGE_QUEUE picks the backend: a redis:// URL, or any Kombu URL
+(amqp://, filesystem:// for processes sharing a folder, memory:// within a
+single process). Left unset, emits stay in the process.
+
+Routes, socket handlers and background jobs all emit through the same
+manager, so nothing else has to change when the queue is turned on.
+
+The same queue keeps the per-process caches (channel memberships, workload
+heaps) in step: after a commit changes them, the committing process
+publishes the change on CACHE_NAMESPACE, a namespace no client connects to,
+and every other process drops the affected entries.
+"""
+
+from flask import current_app
+import os
+import socketio
+
+CACHE_NAMESPACE = '/cache-sync'
+
+_cache_handlers = {}
+
+
+def uses_message_queue():
+    """True if other processes share this one's emits (and so its cache changes)"""
+    return bool(current_app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+
+
+def cache_change_handler(name):
+    """Register the function applying cache changes called name published by other processes"""
+    def register(handler):
+        _cache_handlers[name] = handler
+        return handler
+    return register
+
+
+def publish_cache_change(name, data):
+    """Send a committed cache change to the other processes on the message queue"""
+    if uses_message_queue():
+        current_app.extensions['socketio'].emit(name, data, namespace=CACHE_NAMESPACE)
+
+
+class CacheSyncMixin:
+    """Client manager mixin applying the cache changes other processes publish"""
+
+    app = None
+
+    def _handle_emit(self, message):
+        if message.get('namespace') != CACHE_NAMESPACE:
+            return super()._handle_emit(message)
+        # The publishing process has already applied its own change
+        handler = _cache_handlers.get(message.get('event'))
+        if handler is not None and self.app is not None and message.get('host_id') != self.host_id:
+            with self.app.app_context():
+                handler(message['data'])
+
+
+class RedisManager(CacheSyncMixin, socketio.RedisManager):
+    pass
+
+
+class KombuManager(CacheSyncMixin, socketio.KombuManager):
+    pass
+
+
+def create_client_manager(app):
+    """
+    Build the Socket.IO client manager for SOCKETIO_MESSAGE_QUEUE.
+
+    Returns:
+        PubSubManager or None: None keeps the default in-process manager
+    """
+    config = app.config
+    url = config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return None
+
+    channel = config['SOCKETIO_CHANNEL']
+    if url.startswith(('redis://', 'rediss://')):
+        manager = RedisManager(url, channel=channel)
+        manager.app = app
+        return manager
+
+    connection_options = {}
+    if url.startswith('filesystem://'):
+        # Every process reads and writes the same folders; the control folder
+        # holds the fanout bindings each process's listening queue relies on
+        folder = config['SOCKETIO_QUEUE_FOLDER']
+        options = {
+            'data_folder_in': os.path.join(folder, 'data'),
+            'data_folder_out': os.path.join(folder, 'data'),
+            'control_folder': os.path.join(folder, 'control'),
+        }
+        for path in options.values():
+            os.makedirs(path, exist_ok=True)
+        connection_options['transport_options'] = options
+    manager = KombuManager(url, channel=channel, connection_options=connection_options)
+    manager.app = app
+    return manager
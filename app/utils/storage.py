@@ -0,0 +1,539 @@
+"""
+Content-addressed file storage
+Uploads are streamed to disk in chunks while hashing, stored once per
+SHA-256 under STORAGE_FOLDER/blobs and shared by every attachment row.
+Blobs live outside the static folder and are served by send_attachment()
+
+Large files can also arrive as a resumable upload: start_upload() opens a
+session, write_upload_chunk() appends each chunk at its verified offset and
+finalize_upload() turns the file into a blob like save_upload() does.
+"""
+
+from flask import current_app, request, send_file, abort
+from app import db
+from app.models import FileBlob, UploadSession
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from datetime import datetime, timedelta
+import hashlib
+import os
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+# (table, hash column, column holding the uploading user) for every blob reference
+BLOB_REFERENCES = [
+    ('task_attachments', 'content_hash', 'uploaded_by_id'),
+    ('meeting_attachments', 'content_hash', 'uploaded_by_id'),
+    ('messages', 'attachment_hash', 'sender_id'),
+    ('archived_messages', 'attachment_hash', 'sender_id'),
+]
+
+
+def get_blob_root():
+    """Return the directory blobs are stored under"""
+    return os.path.join(current_app.config['STORAGE_FOLDER'], 'blobs')
+
+
+def blob_relative_path(sha256, extension=''):
+    """Return the path of a blob relative to STORAGE_FOLDER"""
+    return os.path.join('blobs', sha256[:2], sha256[2:4], f'{sha256}{extension}')
+
+
+def save_upload(file):
+    """
+    Stream an uploaded file into blob storage.
+
+    The file is copied in CHUNK_SIZE pieces to a temporary file while the
+    SHA-256 is computed, then moved into place unless a blob with the same
+    content already exists. The blob row is created in the current
+    transaction; attachment triggers maintain its reference count.
+
+    Args:
+        file: Werkzeug FileStorage
+
+    Returns:
+        dict: sha256, size, filename, original_filename, mime_type,
+        storage_path (relative to STORAGE_FOLDER) and path (absolute)
+    """
+    original_filename = secure_filename(file.filename) or 'upload'
+
+    tmp_dir = os.path.join(get_blob_root(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return _store_blob(tmp_path, digest.hexdigest(), size, original_filename, file.mimetype)
+
+
+def _store_blob(tmp_path, sha256, size, original_filename, mime_type):
+    """
+    Move a fully written temporary file into blob storage under its hash.
+
+    The blob row is created in the current transaction, or an existing one
+    is marked as in use so GC keeps it; the file is dropped when a blob with
+    the same content already exists.
+
+    Returns:
+        dict: as save_upload()
+    """
+    extension = os.path.splitext(original_filename)[1].lower()
+    now = datetime.utcnow()
+
+    # Create the blob row, or mark an existing one as in use so GC keeps it
+    db.session.execute(blob_upsert(db.engine.dialect.name, {
+        'sha256': sha256,
+        'size': size,
+        'storage_path': blob_relative_path(sha256, extension),
+        'mime_type': mime_type,
+        'ref_count': 0,
+        'created_at': now,
+        'last_used_at': now,
+    }))
+    storage_path = db.session.execute(
+        db.select(FileBlob.storage_path).where(FileBlob.sha256 == sha256)
+    ).scalar_one()
+
+    final_path = os.path.join(current_app.config['STORAGE_FOLDER'], storage_path)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    return _stored_file(sha256, size, original_filename, mime_type, storage_path)
+
+
+def blob_upsert(dialect_name, values):
+    """INSERT of a file_blobs row that only refreshes last_used_at when the hash exists"""
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    return insert(FileBlob).values(**values).on_conflict_do_update(
+        index_elements=['sha256'],
+        set_={'last_used_at': values['last_used_at']}
+    )
+
+
+def _stored_file(sha256, size, original_filename, mime_type, storage_path):
+    """Description of a stored blob, as returned by save_upload()"""
+    return {
+        'sha256': sha256,
+        'size': size,
+        'filename': os.path.basename(storage_path),
+        'original_filename': original_filename,
+        'mime_type': mime_type,
+        'storage_path': storage_path,
+        'path': os.path.join(current_app.config['STORAGE_FOLDER'], storage_path)
+    }
+
+
+def get_upload_limit(user):
+    """Largest resumable upload user's organisation accepts, in bytes"""
+    return user.organisation.max_upload_size or current_app.config['UPLOAD_MAX_SIZE']
+
+
+def upload_file_path(upload_id):
+    """Absolute path of the partial file of an upload session"""
+    return os.path.join(current_app.config['STORAGE_FOLDER'], 'uploads', upload_id)
+
+
+def start_upload(user, filename, size, mime_type=None):
+    """
+    Open a resumable upload of `size` bytes for user.
+
+    Raises:
+        ValueError: size is negative or over the organisation's limit
+
+    Returns:
+        UploadSession: added to the current transaction, nothing received yet
+    """
+    if size < 0:
+        raise ValueError('size must not be negative')
+    if size > get_upload_limit(user):
+        raise ValueError(f'file is larger than the {get_upload_limit(user)} byte upload limit')
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=user.id,
+        original_filename=secure_filename(filename or '') or 'upload',
+        mime_type=mime_type,
+        size=size,
+        received=0
+    )
+    path = upload_file_path(upload.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    db.session.add(upload)
+    return upload
+
+
+def write_upload_chunk(upload, offset, stream):
+    """
+    Stream one chunk of an upload to disk at `offset`.
+
+    The chunk is written in place rather than appended, so a retry after a
+    dropped connection overwrites whatever part of it reached the disk.
+    The offset only advances, with a conditional UPDATE in the current
+    transaction, once the whole chunk is written; of two requests sending
+    the same chunk one wins. The caller commits.
+
+    Args:
+        upload: UploadSession, not yet finalized
+        offset: Where the chunk starts; must equal upload.received
+        stream: Request body
+
+    Raises:
+        ValueError: offset is not the expected one, or the chunk runs past
+        the declared size
+
+    Returns:
+        int: bytes received so far, the offset of the next chunk
+    """
+    if offset != upload.received:
+        raise ValueError(f'expected offset {upload.received}')
+
+    remaining = upload.size - offset
+    written = 0
+    with open(upload_file_path(upload.id), 'r+b') as out:
+        out.seek(offset)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > remaining:
+                raise ValueError('chunk runs past the declared size')
+            out.write(chunk)
+
+    result = db.session.execute(
+        db.update(UploadSession)
+        .where(UploadSession.id == upload.id, UploadSession.received == offset)
+        .values(received=offset + written, updated_at=datetime.utcnow())
+    )
+    if not result.rowcount:
+        # Another request advanced it first
+        db.session.refresh(upload)
+        raise ValueError(f'expected offset {upload.received}')
+    return offset + written
+
+
+def finalize_upload(upload):
+    """
+    Turn a completely received upload into a blob.
+
+    The file is hashed in one sequential read (hash state cannot be kept
+    between chunk requests that may reach different processes) and moved
+    into blob storage. Calling it again on a finalized upload returns the
+    same blob.
+
+    Raises:
+        ValueError: not all bytes have been received
+
+    Returns:
+        dict: as save_upload()
+    """
+    if upload.content_hash is None:
+        if upload.received != upload.size:
+            raise ValueError(f'received {upload.received} of {upload.size} bytes')
+        path = upload_file_path(upload.id)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        stored = _store_blob(path, digest.hexdigest(), upload.size, upload.original_filename, upload.mime_type)
+        upload.content_hash = stored['sha256']
+        return stored
+
+    storage_path = db.session.execute(
+        db.select(FileBlob.storage_path).where(FileBlob.sha256 == upload.content_hash)
+    ).scalar_one()
+    return _stored_file(upload.content_hash, upload.size, upload.original_filename, upload.mime_type, storage_path)
+
+
+def take_upload(upload_id, user_id):
+    """
+    Claim a finalized upload of user_id for an attachment row.
+
+    The session is deleted in the current transaction, so the caller's
+    commit both adds the attachment and consumes the upload.
+
+    Returns:
+        dict: as save_upload(), or None when there is no such finalized upload
+    """
+    upload = db.session.get(UploadSession, upload_id) if upload_id else None
+    if upload is None or upload.user_id != user_id or upload.content_hash is None:
+        return None
+    stored = finalize_upload(upload)
+    db.session.execute(
+        db.update(FileBlob).where(FileBlob.sha256 == upload.content_hash).values(last_used_at=datetime.utcnow())
+    )
+    db.session.delete(upload)
+    return stored
+
+
+def expire_uploads(max_age):
+    """
+    Drop upload sessions untouched for longer than max_age, with their
+    partial files. Blobs of expired finalized uploads are left to GC.
+
+    Returns:
+        int: sessions removed
+    """
+    cutoff = datetime.utcnow() - max_age
+    expired = db.session.scalars(db.select(UploadSession.id).where(UploadSession.updated_at < cutoff)).all()
+    for upload_id in expired:
+        try:
+            os.remove(upload_file_path(upload_id))
+        except FileNotFoundError:
+            pass
+    if expired:
+        db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(expired)))
+        db.session.commit()
+    return len(expired)
+
+
+def send_attachment(sha256, legacy_path, mime_type, download_name, as_attachment=False, variant=None):
+    """
+    Serve an attachment to an already authorised user.
+
+    Blobs get a strong ETag (their SHA-256), long-lived private caching and
+    HTTP Range support. With SENDFILE_BACKEND set, the body is handed to the
+    front proxy via X-Sendfile or X-Accel-Redirect so the worker is freed
+    immediately. Files uploaded before content addressing are served from
+    their old location under the static folder.
+
+    Args:
+        sha256: Content hash, or None for legacy uploads
+        legacy_path: Stored file_path/attachment_path of a legacy upload
+        mime_type: Content type recorded on the row, if any
+        download_name: Filename presented to the browser
+        as_attachment: Force a download instead of inline display
+        variant: Resized image variant to serve when it has been generated
+    """
+    if sha256:
+        blob = db.session.execute(
+            db.select(FileBlob.storage_path, FileBlob.mime_type).where(FileBlob.sha256 == sha256)
+        ).first()
+        if blob is None:
+            abort(404)
+        if variant:
+            response = _send_variant(blob.storage_path, sha256, variant, as_attachment)
+            if response is not None:
+                return response
+        return _send_blob(blob.storage_path, sha256, mime_type or blob.mime_type, download_name, as_attachment)
+    
+    # Legacy rows hold either a /static/... URL or a filesystem path under app/static
+    full_path = safe_join(current_app.static_folder, (legacy_path or '').split('static/', 1)[-1])
+    if not full_path or not os.path.isfile(full_path):
+        abort(404)
+    
+    response = send_file(
+        full_path,
+        mimetype=mime_type,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True
+    )
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _send_variant(storage_path, sha256, variant, as_attachment):
+    """Send a generated image variant, or None if it does not exist (yet)"""
+    from app.utils.images import IMAGE_VARIANTS, variant_path, accepts_webp
+    
+    if variant not in {name for variants in IMAGE_VARIANTS.values() for name, _, _ in variants}:
+        return None
+    
+    webp = accepts_webp()
+    candidates = [(variant_path(storage_path, variant, webp=True), 'webp')] if webp else []
+    candidates.append((variant_path(storage_path, variant), 'orig'))
+    for candidate, flavour in candidates:
+        if os.path.isfile(os.path.join(current_app.config['STORAGE_FOLDER'], candidate)):
+            response = _send_blob(
+                candidate, f'{sha256}-{variant}-{flavour}', None,
+                os.path.basename(candidate), as_attachment
+            )
+            response.vary.add('Accept')
+            return response
+    return None
+
+
+def _send_blob(storage_path, sha256, mime_type, download_name, as_attachment):
+    """Send a blob directly or through the configured front proxy"""
+    config = current_app.config
+    full_path = os.path.join(config['STORAGE_FOLDER'], storage_path)
+    
+    if config.get('SENDFILE_BACKEND') == 'x-accel-redirect':
+        # nginx serves the bytes (and handles Range) from an internal location
+        response = current_app.response_class(mimetype=mime_type or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = (
+            config['SENDFILE_ACCEL_PREFIX'].rstrip('/') + '/' + storage_path.replace(os.sep, '/')
+        )
+        response.headers.set(
+            'Content-Disposition',
+            'attachment' if as_attachment else 'inline',
+            filename=download_name
+        )
+        response.set_etag(sha256)
+        response = response.make_conditional(request, accept_ranges=False)
+    else:
+        if not os.path.isfile(full_path):
+            abort(404)
+        # USE_X_SENDFILE makes send_file emit X-Sendfile instead of the body
+        response = send_file(
+            full_path,
+            mimetype=mime_type,
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=True,
+            etag=sha256
+        )
+    
+    # Content never changes for a given hash
+    response.cache_control.private = True
+    response.cache_control.max_age = config['ATTACHMENT_CACHE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
+def _references_sql():
+    """UNION ALL of (hash, user_id) over every table that references blobs"""
+    return " UNION ALL ".join(
+        f"SELECT {hash_col} AS sha256, {user_col} AS user_id FROM {table} WHERE {hash_col} IS NOT NULL"
+        for table, hash_col, user_col in BLOB_REFERENCES
+    )
+
+
+def collect_garbage(grace_period=timedelta(hours=1)):
+    """
+    Remove blobs that no attachment references any more.
+
+    Reference counts are first re-derived from the attachment tables so a
+    missed trigger can never cause a referenced blob to be deleted. Blobs
+    used within the grace period, and stray files on disk younger than it,
+    are kept so in-flight uploads are not collected.
+
+    Returns:
+        dict: blobs_removed, bytes_freed
+    """
+    db.session.execute(text(f"""
+        UPDATE file_blobs
+        SET ref_count = (
+            SELECT COUNT(*) FROM ({_references_sql()}) refs
+            WHERE refs.sha256 = file_blobs.sha256
+        )
+    """))
+    db.session.commit()
+
+    cutoff = datetime.utcnow() - grace_period
+    candidates = db.session.execute(
+        db.select(FileBlob.id, FileBlob.storage_path, FileBlob.size).where(
+            FileBlob.ref_count <= 0,
+            FileBlob.last_used_at < cutoff
+        )
+    ).all()
+
+    storage_folder = current_app.config['STORAGE_FOLDER']
+    removed = 0
+    freed = 0
+    for blob_id, storage_path, size in candidates:
+        # Re-check in the DELETE so a blob reused since the scan survives
+        result = db.session.execute(
+            db.delete(FileBlob).where(
+                FileBlob.id == blob_id,
+                FileBlob.ref_count <= 0,
+                FileBlob.last_used_at < cutoff
+            )
+        )
+        db.session.commit()
+        if result.rowcount:
+            try:
+                os.remove(os.path.join(storage_folder, storage_path))
+            except FileNotFoundError:
+                pass
+            removed += 1
+            freed += size
+
+    # Sweep files left behind by failed requests and variants of removed blobs
+    known = {
+        os.path.normpath(path)
+        for path in db.session.scalars(db.select(FileBlob.storage_path))
+    }
+    known_hashes = set(db.session.scalars(db.select(FileBlob.sha256)))
+    cutoff_ts = cutoff.timestamp()
+    blob_root = get_blob_root()
+    for dirpath, _, filenames in os.walk(blob_root):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            relative = os.path.normpath(os.path.relpath(full_path, storage_folder))
+            # Image variants are named <sha256>_<variant>.<ext>
+            is_variant = name[64:65] == '_' and name[:64] in known_hashes and not name.endswith('.tmp')
+            if relative not in known and not is_variant and os.path.getmtime(full_path) < cutoff_ts:
+                freed += os.path.getsize(full_path)
+                os.remove(full_path)
+                removed += 1
+
+    return {'blobs_removed': removed, 'bytes_freed': freed}
+
+
+def get_storage_usage_by_organisation():
+    """
+    Report attachment disk usage per organisation.
+
+    logical_bytes counts every attachment; stored_bytes counts each distinct
+    blob once, so the difference is what deduplication saves.
+    """
+    rows = db.session.execute(text(f"""
+        WITH refs AS (
+            SELECT u.organisation_id, r.sha256
+            FROM ({_references_sql()}) r
+            JOIN users u ON u.id = r.user_id
+        ),
+        logical AS (
+            SELECT refs.organisation_id, COUNT(*) AS files, SUM(b.size) AS bytes
+            FROM refs JOIN file_blobs b ON b.sha256 = refs.sha256
+            GROUP BY refs.organisation_id
+        ),
+        stored AS (
+            SELECT d.organisation_id, COUNT(*) AS blobs, SUM(b.size) AS bytes
+            FROM (SELECT DISTINCT organisation_id, sha256 FROM refs) d
+            JOIN file_blobs b ON b.sha256 = d.sha256
+            GROUP BY d.organisation_id
+        )
+        SELECT o.id, o.name,
+               COALESCE(l.files, 0), COALESCE(l.bytes, 0),
+               COALESCE(s.blobs, 0), COALESCE(s.bytes, 0)
+        FROM organisations o
+        LEFT JOIN logical l ON l.organisation_id = o.id
+        LEFT JOIN stored s ON s.organisation_id = o.id
+        ORDER BY COALESCE(s.bytes, 0) DESC
+    """)).fetchall()
+
+    return [{
+        'organisation_id': row[0],
+        'organisation_name': row[1],
+        'files': row[2],
+        'logical_bytes': row[3],
+        'blobs': row[4],
+        'stored_bytes': row[5]
+    } for row in rows]
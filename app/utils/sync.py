@@ -0,0 +1,190 @@
+"""
+Reconnect sync
+A client that lost its socket sends its cursor, the last message commit
+sequence number and notification id it has seen, and gets back only what
+changed since then: new messages of its conversations, read/delivery marks
+that moved onto messages past its cursor and new notifications. Each part
+is an indexed range query (messages on commit_seq, notifications on
+(user_id, id), marks on the user's conversation rows), so a reconnect storm
+after a deploy does not re-render the chat and dashboard pages.
+
+Message ids are handed out before commit (see app/utils/message_persister.py),
+so a message can be committed after one with a higher id; the cursor follows
+commit_seq, which is taken in commit order, and never skips it.
+"""
+
+from app import db
+from app.models import Message, Notification, Conversation
+from app.models.messaging import channel_members
+
+
+def message_data(message):
+    """Payload of a message, as in the new_message / new_direct_message events"""
+    return {
+        'id': message.id,
+        'content': message.content,
+        'sender': message.sender.name,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'channel_id': message.channel_id,
+        'created_at': message.created_at.isoformat(),
+        'message_type': message.message_type,
+        'attachment_url': message.attachment_path,
+        'thumbnail_url': message.get_thumbnail_url()
+    }
+
+
+def notification_data(notification):
+    """Payload of a notification, as in GET /api/v1/notifications"""
+    return {
+        'id': notification.id,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.notification_type,
+        'is_read': notification.is_read,
+        'created_at': notification.created_at.isoformat(),
+        'action_url': notification.action_url
+    }
+
+
+def _visible_messages(user_id):
+    """Filter on messages user_id sent or received, directly or in one of their channels"""
+    channel_ids = db.select(channel_members.c.channel_id).where(channel_members.c.user_id == user_id)
+    return db.or_(
+        db.and_(Message.channel_id.is_(None),
+                db.or_(Message.recipient_id == user_id, Message.sender_id == user_id)),
+        Message.channel_id.in_(channel_ids)
+    )
+
+
+def _committed_after(column, since_seq):
+    """Filter on rows whose message id column points at a message committed after the cursor"""
+    return column.in_(db.select(Message.id).where(Message.commit_seq > since_seq))
+
+
+def _got_messages(table, since_seq):
+    """
+    Filter on conversation or channel_members rows with messages committed
+    after the cursor; a late commit of an older message changes the unread
+    count but not last_message_id
+    """
+    if table is channel_members:
+        return table.c.channel_id.in_(db.select(Message.channel_id).where(Message.commit_seq > since_seq))
+    return db.exists().where(
+        Message.commit_seq > since_seq, Message.channel_id.is_(None),
+        db.or_(db.and_(Message.sender_id == table.c.user_id, Message.recipient_id == table.c.partner_id),
+               db.and_(Message.sender_id == table.c.partner_id, Message.recipient_id == table.c.user_id))
+    )
+
+
+def _moved_past(table, since_seq):
+    """Rows whose conversation got new messages or whose marks moved past the cursor"""
+    return db.or_(
+        _got_messages(table, since_seq),
+        _committed_after(table.c.last_read_message_id, since_seq),
+        _committed_after(table.c.last_delivered_message_id, since_seq)
+    )
+
+
+def _read_state(user_id, since_seq):
+    """Own marks and unread counts, and the marks others hold on user_id's conversations"""
+    conversations = Conversation.__table__
+    own = []
+    for row in db.session.execute(
+        db.select(conversations.c.partner_id, conversations.c.unread_count,
+                  conversations.c.last_read_message_id, conversations.c.last_delivered_message_id)
+        .where(conversations.c.user_id == user_id, _moved_past(conversations, since_seq))
+    ):
+        own.append({'user_id': row.partner_id, 'channel_id': None, 'unread_count': row.unread_count,
+                    'read_up_to': row.last_read_message_id or 0,
+                    'delivered_up_to': row.last_delivered_message_id or 0})
+    for row in db.session.execute(
+        db.select(channel_members.c.channel_id, channel_members.c.unread_count,
+                  channel_members.c.last_read_message_id, channel_members.c.last_delivered_message_id)
+        .where(channel_members.c.user_id == user_id, _moved_past(channel_members, since_seq))
+    ):
+        own.append({'user_id': None, 'channel_id': row.channel_id, 'unread_count': row.unread_count,
+                    'read_up_to': row.last_read_message_id or 0,
+                    'delivered_up_to': row.last_delivered_message_id or 0})
+
+    # Marks of partners and fellow channel members, for the ticks on user_id's messages
+    others = []
+    for row in db.session.execute(
+        db.select(conversations.c.user_id, conversations.c.last_read_message_id,
+                  conversations.c.last_delivered_message_id)
+        .where(conversations.c.partner_id == user_id, conversations.c.user_id != user_id,
+               db.or_(_committed_after(conversations.c.last_read_message_id, since_seq),
+                      _committed_after(conversations.c.last_delivered_message_id, since_seq)))
+    ):
+        others.append({'user_id': row.user_id, 'channel_id': None,
+                       'read_up_to': row.last_read_message_id or 0,
+                       'delivered_up_to': row.last_delivered_message_id or 0})
+    my_channels = db.select(channel_members.c.channel_id).where(channel_members.c.user_id == user_id)
+    for row in db.session.execute(
+        db.select(channel_members.c.channel_id, channel_members.c.user_id,
+                  channel_members.c.last_read_message_id, channel_members.c.last_delivered_message_id)
+        .where(channel_members.c.channel_id.in_(my_channels), channel_members.c.user_id != user_id,
+               db.or_(_committed_after(channel_members.c.last_read_message_id, since_seq),
+                      _committed_after(channel_members.c.last_delivered_message_id, since_seq)))
+    ):
+        others.append({'user_id': row.user_id, 'channel_id': row.channel_id,
+                       'read_up_to': row.last_read_message_id or 0,
+                       'delivered_up_to': row.last_delivered_message_id or 0})
+    return {'own': own, 'others': others}
+
+
+def sync_since(user_id, message_seq=None, notification_id=None, limit=200):
+    """
+    Everything user_id missed after a cursor, one page at a time.
+
+    Without a cursor nothing is returned but the current one, which is
+    how a client starts: it syncs from there after its next reconnect.
+    Messages and notifications come oldest first, at most `limit` of each;
+    while has_more is set the client asks again with the returned cursor.
+    Read state is the current marks of every conversation with messages or
+    marks on messages past the cursor; a mark that moved onto a message at
+    or below the cursor only reaches the client once it passes it.
+
+    Args:
+        user_id: Syncing user
+        message_seq: Commit sequence number of the last message the client has seen
+        notification_id: Last notification id the client has seen
+        limit: Page size of messages and of notifications
+
+    Returns:
+        dict: messages, notifications, read_state, cursor {message_seq, notification_id}, has_more
+    """
+    if message_seq is None or notification_id is None:
+        return {
+            'messages': [], 'notifications': [], 'read_state': {'own': [], 'others': []},
+            'cursor': {
+                # Messages still queued for write-behind are numbered when
+                # committed, so they land after this cursor
+                'message_seq': message_seq if message_seq is not None else
+                db.session.scalar(db.select(db.func.coalesce(db.func.max(Message.commit_seq), 0))),
+                'notification_id': notification_id if notification_id is not None else
+                db.session.scalar(db.select(db.func.coalesce(db.func.max(Notification.id), 0))
+                                  .where(Notification.user_id == user_id)),
+            },
+            'has_more': False
+        }
+
+    messages = Message.query.options(db.joinedload(Message.sender)).filter(
+        Message.commit_seq > message_seq, _visible_messages(user_id)
+    ).order_by(Message.commit_seq).limit(limit + 1).all()
+    notifications = Notification.query.filter(
+        Notification.user_id == user_id, Notification.id > notification_id
+    ).order_by(Notification.id).limit(limit + 1).all()
+    has_more = len(messages) > limit or len(notifications) > limit
+    messages, notifications = messages[:limit], notifications[:limit]
+
+    return {
+        'messages': [message_data(message) for message in messages],
+        'notifications': [notification_data(notification) for notification in notifications],
+        'read_state': _read_state(user_id, message_seq),
+        'cursor': {
+            'message_seq': messages[-1].commit_seq if messages else message_seq,
+            'notification_id': notifications[-1].id if notifications else notification_id,
+        },
+        'has_more': has_more
+    }
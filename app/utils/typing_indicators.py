@@ -0,0 +1,114 @@
+"""
+Typing indicators
+Who is typing where is kept in a store with a short TTL instead of the
+typing_indicators table, so a burst of keystrokes costs no database writes.
+The store is pluggable (TYPING_STORE names its class); the default keeps the
+state in process memory, which is enough for a single server process.
+"""
+
+from flask import current_app
+from werkzeug.utils import import_string
+import threading
+import time
+
+
+def conversation_key(partner_id=None, channel_id=None, user_id=None):
+    """Store key of a conversation; direct conversations are keyed by the ordered user pair"""
+    if channel_id:
+        return f'channel:{channel_id}'
+    low, high = sorted((user_id, partner_id))
+    return f'direct:{low}:{high}'
+
+
+def parse_conversation_key(key, user_id):
+    """(partner_id, channel_id) of a conversation key, seen from user_id"""
+    kind, *ids = key.split(':')
+    if kind == 'channel':
+        return None, int(ids[0])
+    low, high = map(int, ids)
+    return (high if low == user_id else low), None
+
+
+class TypingStore:
+    """
+    Interface of a typing state store.
+
+    start() and stop() answer whether the change should be broadcast, which
+    is what throttles the fan-out: repeated starts within the throttle window
+    only extend the TTL.
+    """
+
+    def __init__(self, ttl, throttle):
+        self.ttl = ttl
+        self.throttle = throttle
+
+    def start(self, key, user_id):
+        """Mark user_id as typing in key; True when others should be told"""
+        raise NotImplementedError
+
+    def stop(self, key, user_id):
+        """Clear user_id's typing state in key; True if they were typing"""
+        raise NotImplementedError
+
+    def stop_all(self, user_id):
+        """Clear user_id everywhere; return the keys they were typing in"""
+        raise NotImplementedError
+
+    def typing_users(self, key):
+        """User ids currently typing in key"""
+        raise NotImplementedError
+
+
+class MemoryTypingStore(TypingStore):
+    """Per-process store: {key: {user_id: (expires_at, last_broadcast_at)}}"""
+
+    def __init__(self, ttl, throttle):
+        super().__init__(ttl, throttle)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def _live(self, key, now):
+        """Entries of key with the expired ones dropped"""
+        users = self.entries.get(key, {})
+        for user_id in [u for u, (expires_at, _) in users.items() if expires_at <= now]:
+            del users[user_id]
+        if not users:
+            self.entries.pop(key, None)
+        return users
+
+    def start(self, key, user_id):
+        now = time.monotonic()
+        with self.lock:
+            users = self._live(key, now)
+            previous = users.get(user_id)
+            broadcast = previous is None or now - previous[1] >= self.throttle
+            users[user_id] = (now + self.ttl, now if broadcast else previous[1])
+            self.entries[key] = users
+            return broadcast
+
+    def stop(self, key, user_id):
+        with self.lock:
+            users = self._live(key, time.monotonic())
+            return users.pop(user_id, None) is not None
+
+    def stop_all(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            return [key for key in list(self.entries)
+                    if self._live(key, now).pop(user_id, None) is not None]
+
+    def typing_users(self, key):
+        with self.lock:
+            return list(self._live(key, time.monotonic()))
+
+
+def get_typing_store():
+    """Return the current application's typing store, creating it on first use"""
+    store = current_app.extensions.get('typing_store')
+    if store is None:
+        config = current_app.config
+        store_class = import_string(config['TYPING_STORE'])
+        store = current_app.extensions.setdefault(
+            'typing_store', store_class(config['TYPING_TTL'], config['TYPING_THROTTLE'])
+        )
+    return store
@@ -0,0 +1,128 @@
+"""
+Attachment download throughput benchmark
+
+Serves one large task attachment from a real threaded WSGI server and
+downloads it concurrently, reporting aggregate throughput for full
+downloads, ranged (resumed) downloads and X-Accel-Redirect offload.
+
+Usage:
+    python benchmarks/attachment_download.py --size-mb 50 --clients 1 4 16
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORK_DIR = tempfile.mkdtemp(prefix='flowdeck-bench-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['STORAGE_FOLDER'] = os.path.join(WORK_DIR, 'storage')
+
+import requests
+from werkzeug.datastructures import FileStorage
+from werkzeug.serving import make_server
+from app import create_app, db
+from app.database import init_database_features
+from app.models import Organisation, User, Task, TaskAttachment
+from app.utils.storage import save_upload
+
+
+def setup(app, size_mb):
+    """Create a user, a task and one attachment of size_mb megabytes"""
+    with app.app_context():
+        init_database_features(app)
+        org = Organisation(name='Bench Org', email='bench@example.com')
+        db.session.add(org)
+        db.session.flush()
+        user = User(name='Bench User', email='bench-user@example.com', organisation_id=org.id)
+        user.set_password('password')
+        db.session.add(user)
+        db.session.flush()
+        task = Task(title='Bench Task', created_by_id=user.id)
+        db.session.add(task)
+        db.session.flush()
+
+        stored = save_upload(FileStorage(
+            io.BytesIO(os.urandom(size_mb * 1024 * 1024)),
+            filename='large.bin',
+            content_type='application/octet-stream'
+        ))
+        attachment = TaskAttachment(
+            filename=stored['filename'],
+            original_filename=stored['original_filename'],
+            file_path=stored['storage_path'],
+            file_size=stored['size'],
+            mime_type=stored['mime_type'],
+            content_hash=stored['sha256'],
+            task_id=task.id,
+            uploaded_by_id=user.id
+        )
+        db.session.add(attachment)
+        db.session.commit()
+
+        cookie = app.session_interface.get_signing_serializer(app).dumps(
+            {'_user_id': str(user.id), '_fresh': True}
+        )
+        return attachment.id, stored['size'], cookie
+
+
+def run(url, cookie, clients, requests_per_client, headers=None):
+    """Download url concurrently; return (seconds, bytes received)"""
+    def worker(_):
+        received = 0
+        with requests.Session() as session:
+            session.cookies.set('session', cookie)
+            for _ in range(requests_per_client):
+                with session.get(url, headers=headers or {}, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(256 * 1024):
+                        received += len(chunk)
+        return received
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        total = sum(pool.map(worker, range(clients)))
+    return time.perf_counter() - start, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=50)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=3, help='Downloads per client')
+    args = parser.parse_args()
+
+    app = create_app()
+    attachment_id, size, cookie = setup(app, args.size_mb)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/tasks/attachments/{attachment_id}'
+
+    print(f'Attachment: {size / 1024 / 1024:.0f} MiB, {args.requests} downloads per client')
+    print(f'{"mode":<22}{"clients":>8}{"seconds":>10}{"MiB/s":>10}{"req/s":>10}')
+    try:
+        for mode in ('full', 'range (last half)', 'x-accel-redirect'):
+            app.config['SENDFILE_BACKEND'] = 'x-accel-redirect' if mode == 'x-accel-redirect' else ''
+            headers = {'Range': f'bytes={size // 2}-'} if mode.startswith('range') else None
+            for clients in args.clients:
+                seconds, received = run(url, cookie, clients, args.requests, headers)
+                count = clients * args.requests
+                print(f'{mode:<22}{clients:>8}{seconds:>10.2f}'
+                      f'{received / 1024 / 1024 / seconds:>10.1f}{count / seconds:>10.1f}')
+    finally:
+        server.shutdown()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
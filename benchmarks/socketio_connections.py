@@ -0,0 +1,176 @@
+"""
+Socket.IO concurrent connection benchmark
+
+Starts one server process (run.py for 'threading', wsgi.py for 'eventlet' or
+'gevent'), then connects authenticated Socket.IO clients in steps. After each
+step one client asks for the organisation's online users and the round trip
+is timed. The ramp stops at --max-clients, at the first failed connection
+or when the round trip exceeds --max-latency; the last healthy step is the
+maximum number of concurrent clients the process held.
+
+Clients use the websocket transport, which needs websocket-client installed
+on the benchmark side; --transport polling uses long-polling instead.
+
+Usage:
+    python benchmarks/socketio_connections.py --mode eventlet --step 250 --max-clients 5000
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORK_DIR = tempfile.mkdtemp(prefix='flowdeck-bench-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['STORAGE_FOLDER'] = os.path.join(WORK_DIR, 'storage')
+os.environ.setdefault('SECRET_KEY', 'flowdeck-bench-secret')
+
+import requests
+import socketio
+from app import create_app, db
+from app.database import init_database_features
+from app.models import Organisation, User
+
+
+def setup(app, users):
+    """Create one organisation with `users` members; return their session cookies"""
+    with app.app_context():
+        init_database_features(app)
+        org = Organisation(name='Bench Org', email='bench@example.com')
+        db.session.add(org)
+        db.session.flush()
+        # Clients never log in with a password, so no hashing is needed
+        db.session.execute(User.__table__.insert(), [
+            {'name': f'Bench User {i}', 'email': f'bench-{i}@example.com',
+             'password_hash': '!', 'organisation_id': org.id, 'is_active': True}
+            for i in range(users)
+        ])
+        db.session.commit()
+        serializer = app.session_interface.get_signing_serializer(app)
+        return [serializer.dumps({'_user_id': str(user_id), '_fresh': True})
+                for user_id in db.session.scalars(db.select(User.id).order_by(User.id))]
+
+
+def start_server(mode, port):
+    """Start the server in its own process and wait until it answers"""
+    script = 'run.py' if mode == 'threading' else 'wsgi.py'
+    env = dict(os.environ, SOCKETIO_ASYNC_MODE=mode, FLASK_PORT=str(port), FLASK_DEBUG='False')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, script)], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/auth/login', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'{script} did not start within 30 seconds')
+
+
+def server_rss_mb(pid):
+    """Resident memory of the server process (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def connect(url, cookie, transport, timeout):
+    """Connect one client; return it, or None if the server refused or timed out"""
+    client = socketio.Client(reconnection=False)
+    try:
+        client.connect(url, headers={'Cookie': f'session={cookie}'},
+                       transports=[transport], wait_timeout=timeout)
+        return client
+    except Exception:
+        return None
+
+
+def probe(client, timeout):
+    """Seconds for an online users round trip, or None if it did not come back"""
+    answered = threading.Event()
+    client.on('online_users_list', lambda data: answered.set())
+    start = time.perf_counter()
+    client.emit('request_online_users')
+    if not answered.wait(timeout):
+        return None
+    return time.perf_counter() - start
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=['threading', 'eventlet', 'gevent'], default='eventlet')
+    parser.add_argument('--transport', choices=['websocket', 'polling'], default='websocket')
+    parser.add_argument('--step', type=int, default=100, help='Clients added per step')
+    parser.add_argument('--max-clients', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200, help='Distinct users the clients log in as')
+    parser.add_argument('--max-latency', type=float, default=1.0, help='Round trip limit in seconds')
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    app = create_app()
+    cookies = setup(app, args.users)
+    port = free_port()
+    server = start_server(args.mode, port)
+    url = f'http://127.0.0.1:{port}'
+
+    clients = []
+    healthy = 0
+    print(f'Mode: {args.mode}, transport: {args.transport}')
+    print(f'{"clients":>8}{"connect s":>11}{"round trip ms":>15}{"server MiB":>12}')
+    try:
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            while len(clients) < args.max_clients:
+                start = time.perf_counter()
+                step = range(len(clients), min(len(clients) + args.step, args.max_clients))
+                connected = list(pool.map(
+                    lambda i: connect(url, cookies[i % len(cookies)], args.transport, args.connect_timeout), step
+                ))
+                elapsed = time.perf_counter() - start
+                clients += [client for client in connected if client is not None]
+                failed = connected.count(None)
+                latency = probe(clients[0], args.max_latency * 5) if clients else None
+                print(f'{len(clients):>8}{elapsed:>11.2f}'
+                      f'{latency * 1000 if latency is not None else float("nan"):>15.1f}'
+                      f'{server_rss_mb(server.pid):>12.1f}')
+                if failed:
+                    print(f'{failed} connection(s) failed')
+                    break
+                if latency is None or latency > args.max_latency:
+                    print(f'Round trip over {args.max_latency}s')
+                    break
+                healthy = len(clients)
+        print(f'\nMaximum concurrent clients ({args.mode}): {healthy}')
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        server.terminate()
+        server.wait()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Task update write benchmark
+
+Runs the same ORM task updates against the legacy AFTER UPDATE triggers
+(update_task_timestamp, update_analytics_on_task_completion) and against the
+current ORM timestamp strategy, reporting row writes per update (SQLite
+total_changes()) and elapsed time.
+
+SQLite's synchronous mode is turned off unless --fsync is given, so the
+timings reflect row writes rather than the disk's flush latency.
+
+Usage:
+    python benchmarks/task_update_writes.py --tasks 1000 --rounds 3
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORK_DIR = tempfile.mkdtemp(prefix='flowdeck-bench-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['STORAGE_FOLDER'] = os.path.join(WORK_DIR, 'storage')
+
+from sqlalchemy.orm import Session
+from app import create_app, db
+from app.database import init_database_features, check_task_timestamp_strategy
+from app.models import Task
+
+LEGACY_TRIGGERS = [
+    """
+    CREATE TRIGGER update_analytics_on_task_completion
+    AFTER UPDATE OF status ON tasks
+    WHEN NEW.status = 'done' AND OLD.status != 'done'
+    BEGIN
+        UPDATE tasks SET completed_date = CURRENT_TIMESTAMP WHERE id = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER update_task_timestamp
+    AFTER UPDATE ON tasks
+    BEGIN
+        UPDATE tasks SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+    END
+    """,
+]
+
+
+def run(session, task_ids, rounds):
+    """Cycle every task through in_progress/done/todo; return (seconds, updates, row writes)"""
+    # total_changes() is per connection and includes rows written by triggers
+    total_changes = db.text('SELECT total_changes()')
+    changes_before = session.execute(total_changes).scalar()
+    start = time.perf_counter()
+    updates = 0
+    for round_number in range(rounds):
+        for status in ('in_progress', 'done', 'todo'):
+            for task_id in task_ids:
+                task = session.get(Task, task_id)
+                task.status = status
+                task.board_position = round_number
+                session.commit()
+                updates += 1
+    elapsed = time.perf_counter() - start
+    writes = session.execute(total_changes).scalar() - changes_before
+    return elapsed, updates, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--fsync', action='store_true', help='Keep synchronous=FULL')
+    args = parser.parse_args()
+
+    app = create_app()
+    try:
+        with app.app_context():
+            init_database_features(app)
+            db.session.execute(db.insert(Task), [{'title': f'Task {i}'} for i in range(args.tasks)])
+            db.session.commit()
+            task_ids = list(db.session.scalars(db.select(Task.id)))
+
+            print(f'{"strategy":<22}{"updates":>9}{"writes/upd":>12}{"seconds":>10}{"upd/s":>10}')
+            for label, legacy in (('legacy triggers', True), ('orm onupdate', False)):
+                init_database_features(app)
+                if legacy:
+                    for statement in LEGACY_TRIGGERS:
+                        db.session.execute(db.text(statement))
+                    db.session.commit()
+                print(f'  ({label}: double-write triggers {check_task_timestamp_strategy() or "none"})')
+
+                with db.engine.connect() as connection:
+                    if not args.fsync:
+                        connection.exec_driver_sql('PRAGMA synchronous = OFF')
+                        connection.exec_driver_sql('PRAGMA journal_mode = MEMORY')
+                    with Session(bind=connection) as session:
+                        elapsed, updates, writes = run(session, task_ids, args.rounds)
+                print(f'{label:<22}{updates:>9}{writes / updates:>12.2f}{elapsed:>10.2f}{updates / elapsed:>10.0f}')
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
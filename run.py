@@ -5,6 +5,9 @@ FlowDeck Application Entry Point
 from app import create_app, socketio, db
 from app.database import init_database_features
 import os
+import signal
+import sys
+import click
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -64,6 +67,73 @@ def seed():
         seed_database()
 
 
+@app.cli.command()
+@click.option('--fix', is_flag=True, help='Re-derive drifted values from time logs')
+def check_task_hours(fix):
+    """Check task actual hours against their time logs"""
+    from app.database import check_task_hours_consistency
+    with app.app_context():
+        drifted = check_task_hours_consistency(fix=fix)
+        for task_id, stored, derived in drifted:
+            print(f"Task {task_id}: stored {stored:.2f}h, time logs {derived:.2f}h")
+        if not drifted:
+            print("✅ All task hours are consistent")
+        elif fix:
+            print(f"✅ Re-derived hours for {len(drifted)} task(s)")
+
+
+@app.cli.command()
+def migrate_deliverables():
+    """Move JSON task deliverables into the task_deliverables table"""
+    from app.database import migrate_deliverables_to_table
+    with app.app_context():
+        migrated = migrate_deliverables_to_table()
+        print(f"✅ Migrated deliverables for {migrated} task(s)")
+
+
+@app.cli.command()
+def backfill_conversations():
+    """Rebuild chat conversation summaries from existing messages"""
+    from app.database import backfill_conversations as backfill
+    with app.app_context():
+        written = backfill()
+        print(f"✅ Rebuilt {written} conversation(s)")
+
+
+@app.cli.command()
+@click.option('--grace-hours', default=1, show_default=True, help='Keep blobs used more recently than this')
+def storage_gc(grace_hours):
+    """Delete attachment blobs that are no longer referenced and stale resumable uploads"""
+    from datetime import timedelta
+    from app.utils.storage import collect_garbage, expire_uploads
+    with app.app_context():
+        expired = expire_uploads(timedelta(hours=app.config['UPLOAD_EXPIRY_HOURS']))
+        result = collect_garbage(timedelta(hours=grace_hours))
+        print(f"✅ Dropped {expired} stale upload(s), removed {result['blobs_removed']} blob(s), "
+              f"freed {result['bytes_freed']} bytes")
+
+
+@app.cli.command()
+def storage_report():
+    """Show attachment disk usage per organisation"""
+    from app.utils.storage import get_storage_usage_by_organisation
+    with app.app_context():
+        for row in get_storage_usage_by_organisation():
+            print(f"{row['organisation_name']}: {row['files']} file(s), "
+                  f"{row['logical_bytes']} bytes referenced, "
+                  f"{row['blobs']} blob(s), {row['stored_bytes']} bytes stored")
+
+
+@app.cli.command()
+def archive_messages():
+    """Move chat messages past their organisation's horizon into the archive"""
+    from app.utils.archive import archive_messages as archive
+    with app.app_context():
+        result = archive()
+        print(f"✅ Archived {result['archived_by_age']} message(s) by age and "
+              f"{result['archived_by_size']} to fit the hot table, {result['hot_rows']} hot row(s) left")
+
+
 @app.cli.command()
 def create_admin():
     """Create a new admin user"""
@@ -118,7 +188,9 @@ def create_admin():
 
 
 if __name__ == '__main__':
-    # Run with Socket.IO
+    # Development server with Socket.IO; production runs wsgi.py
+    # SIGTERM exits normally, so atexit hooks such as the chat persister's drain run
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     port = int(os.getenv('FLASK_PORT', 5000))
     print(f"\n🚀 Starting FlowDeck on port {port}")
     print(f"📍 FLASK_PORT from .env: {os.getenv('FLASK_PORT')}")
@@ -126,6 +198,7 @@ if __name__ == '__main__':
         app,
         host='0.0.0.0',
         port=port,
-        debug=True,
-        use_reloader=False  # Disable reloader to see logs clearly
+        debug=os.getenv('FLASK_DEBUG', 'True') == 'True',
+        use_reloader=False,  # Disable reloader to see logs clearly
+        allow_unsafe_werkzeug=True
     )
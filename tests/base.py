@@ -0,0 +1,34 @@
+import os
+import unittest
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import create_app, db
+from app.database import init_database_features
+from app.models import Organisation, User
+
+
+class AppTestCase(unittest.TestCase):
+    """Runs each test in an app context over a fresh database with one organisation"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        init_database_features(self.app)
+
+        self.org = Organisation(name='Test Org', email='org@example.com')
+        db.session.add(self.org)
+        db.session.flush()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def create_user(self, name, email):
+        """Add a member of the test organisation, with password 'password'"""
+        user = User(name=name, email=email, organisation_id=self.org.id)
+        user.set_password('password')
+        db.session.add(user)
+        return user
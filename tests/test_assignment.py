@@ -0,0 +1,158 @@
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from socketio import PubSubManager
+
+from app import create_app, db, socketio
+from app.database import init_database_features, assign_task_to_least_loaded_user
+from app.models import Organisation, Department, User, Task
+from app.utils.assignment import WorkloadIndex, assign_tasks, get_workload_index, suggest_assignees
+from app.utils.socket_queue import CACHE_NAMESPACE, CacheSyncMixin
+
+
+class TestAssignment(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        init_database_features(self.app)
+
+        org = Organisation(name='Test Org', email='org@example.com')
+        db.session.add(org)
+        db.session.flush()
+        self.department = Department(name='Engineering', organisation_id=org.id)
+        db.session.add(self.department)
+        db.session.flush()
+        self.users = []
+        for name in ('Ann', 'Bob', 'Cat'):
+            user = User(name=name, email=f'{name.lower()}@example.com',
+                        organisation_id=org.id, department_id=self.department.id)
+            user.set_password('password')
+            self.users.append(user)
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _task(self, title, status='todo', assignees=()):
+        task = Task(title=title, status=status, department_id=self.department.id)
+        task.assignees.extend(assignees)
+        db.session.add(task)
+        return task
+
+    def _loads(self):
+        return dict(get_workload_index().get(self.department.id).loads)
+
+    def test_done_tasks_do_not_count(self):
+        ann, bob, cat = self.users
+        for i in range(3):
+            self._task(f'Closed {i}', status='done', assignees=[ann])
+        self._task('Open', assignees=[bob])
+        self._task('Open too', assignees=[cat])
+        task = self._task('New')
+        db.session.commit()
+
+        self.assertEqual(assign_task_to_least_loaded_user(self.department.id, task.id), ann.id)
+
+    def test_batch_assignment_spreads_load(self):
+        ann, bob, cat = self.users
+        self._task('Existing', assignees=[ann])
+        self._task('Existing too', assignees=[ann])
+        tasks = [self._task(f'Batch {i}') for i in range(7)]
+        db.session.flush()
+
+        assigned = assign_tasks(tasks)
+        db.session.commit()
+
+        self.assertEqual(len(assigned), 7)
+        self.assertEqual(self._loads(), {ann.id: 3, bob.id: 3, cat.id: 3})
+        db.session.expire_all()
+        self.assertEqual(sum(len(db.session.get(Task, t.id).assignees) for t in tasks), 7)
+
+    def test_index_follows_commits_without_rebuilding(self):
+        ann, bob, cat = self.users
+        task = self._task('Open', assignees=[ann])
+        db.session.commit()
+        self.assertEqual(self._loads(), {ann.id: 1, bob.id: 0, cat.id: 0})
+
+        with patch.object(WorkloadIndex, '_load', side_effect=AssertionError('rebuilt')):
+            task.assignees.append(bob)
+            db.session.commit()
+            self.assertEqual(self._loads(), {ann.id: 1, bob.id: 1, cat.id: 0})
+
+            task.status = 'done'
+            db.session.commit()
+            self.assertEqual(self._loads(), {ann.id: 0, bob.id: 0, cat.id: 0})
+
+            task.status = 'todo'
+            task.assignees.remove(ann)
+            db.session.commit()
+            self.assertEqual(self._loads(), {ann.id: 0, bob.id: 1, cat.id: 0})
+
+        task.assignees.append(cat)
+        db.session.rollback()
+        self.assertEqual(self._loads(), {ann.id: 0, bob.id: 1, cat.id: 0})
+
+    def test_deleted_tasks_release_their_load(self):
+        ann, bob, cat = self.users
+        task = self._task('Open', assignees=[ann, bob])
+        closed = self._task('Closed', status='done', assignees=[cat])
+        db.session.commit()
+        self.assertEqual(self._loads(), {ann.id: 1, bob.id: 1, cat.id: 0})
+
+        with patch.object(WorkloadIndex, '_load', side_effect=AssertionError('rebuilt')):
+            db.session.delete(task)
+            db.session.delete(closed)
+            db.session.commit()
+            self.assertEqual(self._loads(), {ann.id: 0, bob.id: 0, cat.id: 0})
+
+    def test_other_processes_rebuild_changed_departments(self):
+        ann, bob, cat = self.users
+        task = self._task('Open', assignees=[ann])
+        db.session.commit()
+        self.assertEqual(self._loads(), {ann.id: 1, bob.id: 0, cat.id: 0})
+
+        self.app.config['SOCKETIO_MESSAGE_QUEUE'] = 'redis://localhost:6379/0'
+        with patch.object(socketio, 'emit') as emit:
+            task.assignees.append(bob)
+            db.session.commit()
+        (name, data), kwargs = emit.call_args
+        self.assertEqual((name, kwargs), ('workload', {'namespace': CACHE_NAMESPACE}))
+        self.assertEqual(data, {'department_ids': [], 'user_ids': [bob.id]})
+
+        other = type('Manager', (CacheSyncMixin, PubSubManager), {})()
+        other.app = self.app
+        other._handle_emit({'method': 'emit', 'event': name, 'data': data,
+                            'namespace': CACHE_NAMESPACE, 'host_id': 'publisher'})
+        self.assertNotIn(self.department.id, get_workload_index().departments)
+        self.assertEqual(self._loads(), {ann.id: 1, bob.id: 1, cat.id: 0})
+
+    def test_round_robin_and_suggestions(self):
+        ann, bob, cat = self.users
+        self._task('Busy', assignees=[ann])
+        self._task('Busy too', assignees=[bob])
+        db.session.commit()
+
+        self.assertEqual([u.id for u in suggest_assignees(self.department.id, count=2)], [cat.id, ann.id])
+        tasks = [self._task(f'Task {i}') for i in range(4)]
+        db.session.flush()
+        assigned = assign_tasks(tasks, strategy='round_robin')
+        self.assertEqual(list(assigned.values()), [ann.id, bob.id, cat.id, ann.id])
+
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(ann.id)
+        response = client.get(f'/api/v1/departments/{self.department.id}/suggested-assignees?count=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['users']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from unittest.mock import patch
+
+from base import AppTestCase
+from app import db, socketio
+from app.models import Organisation, Department, User, Role, Task, TaskHistory, Tag, Notification
+
+
+class TestBulkTasks(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.manager = self.create_user('Manager', 'manager@example.com')
+        self.manager.roles.append(Role(name='Manager'))
+        self.member = self.create_user('Member', 'member@example.com')
+        self.tag = Tag(name='backend')
+        db.session.add(self.tag)
+        db.session.commit()
+
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.manager.id)
+
+    def test_bulk_create_reports_per_item_results(self):
+        payload = {'tasks': [
+            {'title': 'Import 1', 'priority': 'high', 'assignee_ids': [self.member.id], 'tag_ids': [self.tag.id]},
+            {'title': '', 'status': 'bogus'},
+            {'title': 'Import 2', 'due_date': '2030-01-31', 'assignee_ids': [self.member.id]},
+        ]}
+        with patch.object(socketio, 'emit') as emit:
+            response = self.client.post('/api/v1/tasks/bulk', json=payload)
+
+        self.assertEqual(response.status_code, 207)
+        body = response.get_json()
+        self.assertEqual((body['succeeded'], body['failed']), (2, 1))
+        self.assertEqual(len(body['results'][1]['errors']), 2)
+
+        tasks = Task.query.order_by(Task.id).all()
+        self.assertEqual([t.title for t in tasks], ['Import 1', 'Import 2'])
+        self.assertEqual([u.id for u in tasks[0].assignees], [self.member.id])
+        self.assertEqual([t.name for t in tasks[0].tags], ['backend'])
+        self.assertEqual(TaskHistory.query.filter_by(action='created').count(), 2)
+        # One row per assignment (written by the trigger), one live event per task
+        self.assertEqual(Notification.query.filter_by(user_id=self.member.id).count(), 2)
+        self.assertEqual(emit.call_count, 2)
+
+    def test_atomic_batch_is_rejected_as_a_whole(self):
+        response = self.client.post('/api/v1/tasks/bulk', json={
+            'atomic': True,
+            'tasks': [{'title': 'Valid'}, {'title': 'Bad', 'assignee_ids': [9999]}]
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Task.query.count(), 0)
+
+    def test_bulk_update_status_reassign_and_tag(self):
+        created = self.client.post('/api/v1/tasks/bulk', json={'tasks': [
+            {'title': 'A'}, {'title': 'B', 'assignee_ids': [self.manager.id]}
+        ]}).get_json()
+        first, second = (result['id'] for result in created['results'])
+
+        response = self.client.patch('/api/v1/tasks/bulk', json={'tasks': [
+            {'id': first, 'status': 'done', 'tag_ids': [self.tag.id]},
+            {'id': second, 'assignee_ids': [self.member.id]},
+            {'id': 424242, 'status': 'done'},
+        ]})
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.get_json()['results'][2]['errors'], ['task not found'])
+
+        db.session.expire_all()
+        task_a, task_b = db.session.get(Task, first), db.session.get(Task, second)
+        self.assertEqual(task_a.status, 'done')
+        self.assertIsNotNone(task_a.completed_date)
+        self.assertEqual([t.id for t in task_a.tags], [self.tag.id])
+        self.assertEqual([u.id for u in task_b.assignees], [self.member.id])
+        self.assertEqual(
+            sorted(h.action for h in TaskHistory.query.filter(TaskHistory.action != 'created')),
+            ['assigned', 'updated']
+        )
+        # One compact diff row per task
+        changes = TaskHistory.query.filter_by(task_id=first, action='updated').one().get_changes()
+        self.assertEqual(changes, {'status': ['todo', 'done'], 'tags': {'+': [self.tag.id]}})
+
+    def test_bulk_update_stays_inside_the_organisation(self):
+        other = Organisation(name='Other Org', email='other@example.com')
+        db.session.add(other)
+        db.session.flush()
+        outsider = User(name='Outsider', email='outsider@example.com', organisation_id=other.id)
+        outsider.set_password('password')
+        department = Department(name='Elsewhere', organisation_id=other.id)
+        db.session.add_all([outsider, department])
+        db.session.flush()
+        theirs = [Task(title='Theirs', created_by_id=outsider.id),
+                  Task(title='Their department', department_id=department.id, created_by_id=self.manager.id)]
+        ours = Task(title='Ours', created_by_id=self.member.id)
+        db.session.add_all(theirs + [ours])
+        db.session.commit()
+
+        response = self.client.patch('/api/v1/tasks/bulk', json={'tasks': [
+            {'id': theirs[0].id, 'status': 'done'},
+            {'id': theirs[1].id, 'title': 'Renamed'},
+            {'id': ours.id, 'status': 'done'},
+        ]})
+
+        results = response.get_json()['results']
+        self.assertEqual([r.get('errors') for r in results], [['task not found'], ['task not found'], None])
+        db.session.expire_all()
+        self.assertEqual([db.session.get(Task, t.id).status for t in theirs], ['todo', 'todo'])
+        self.assertEqual(db.session.get(Task, theirs[1].id).title, 'Their department')
+        self.assertEqual(db.session.get(Task, ours.id).status, 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
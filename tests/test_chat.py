@@ -0,0 +1,784 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import call, patch
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from flask import g
+from app import create_app, db, socketio
+from app.database import init_database_features, backfill_conversations
+from app.models import (
+    Organisation, User, ChatChannel, Conversation, Message, ArchivedMessage, TypingIndicator, OnlineStatus, Notification
+)
+from app.models.messaging import channel_members
+from app.utils.conversations import advance_read, get_marks, get_unread_direct_total, get_unread_total, id_ranges
+from app.utils.search import search_messages
+from app.utils.archive import archive_messages
+from app.utils import message_persister
+from app.utils.storage import start_upload, write_upload_chunk, finalize_upload
+from app.utils.typing_indicators import MemoryTypingStore
+from app.utils.presence import get_presence
+from app.utils.memberships import get_membership_cache, channel_ids_of, is_channel_member, channel_member_count
+from app.utils.socket_queue import CACHE_NAMESPACE, CacheSyncMixin
+from socketio import PubSubManager
+
+
+class TestChat(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        # Strict mode keeps sends synchronous; the write-behind queue has its own test
+        self.app.config['CHAT_PERSIST_MODE'] = 'sync'
+        # Presence diffs are flushed by hand where a test needs them
+        self.app.config['PRESENCE_FLUSH_INTERVAL'] = 3600
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        init_database_features(self.app)
+
+        org = Organisation(name='Test Org', email='org@example.com')
+        db.session.add(org)
+        db.session.flush()
+        self.users = []
+        for name in ('Ann', 'Bob', 'Cat'):
+            user = User(name=name, email=f'{name.lower()}@example.com', organisation_id=org.id)
+            user.set_password('password')
+            self.users.append(user)
+        self.channel = ChatChannel(name='general', organisation_id=org.id)
+        self.channel.members.extend(self.users)
+        db.session.add_all(self.users + [self.channel])
+        db.session.commit()
+        self.clients = {}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def client_for(self, user):
+        if user.id not in self.clients:
+            client = self.app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(user.id)
+            self.clients[user.id] = client
+        # Requests share the pushed app context, where flask-login caches the user
+        g.pop('_login_user', None)
+        return self.clients[user.id]
+
+    def send(self, sender, **payload):
+        with patch.object(socketio, 'emit'):
+            response = self.client_for(sender).post('/chat/send', json=payload)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['message']['id']
+
+    def _conversation(self, user, partner):
+        db.session.expire_all()
+        return Conversation.query.filter_by(user_id=user.id, partner_id=partner.id).one()
+
+    def _membership(self, user):
+        return db.session.execute(
+            db.select(channel_members.c.last_message_id, channel_members.c.unread_count)
+            .where(channel_members.c.channel_id == self.channel.id, channel_members.c.user_id == user.id)
+        ).one()
+
+    def test_send_updates_conversation_summaries(self):
+        ann, bob, cat = self.users
+        self.send(ann, content='hi', recipient_id=bob.id)
+        last_id = self.send(ann, content='again', recipient_id=bob.id)
+
+        mine, theirs = self._conversation(ann, bob), self._conversation(bob, ann)
+        self.assertEqual((mine.last_message_id, mine.unread_count), (last_id, 0))
+        self.assertEqual((theirs.last_message_id, theirs.unread_count), (last_id, 2))
+
+        channel_message = self.send(bob, content='team', channel_id=self.channel.id)
+        self.assertEqual(tuple(self._membership(bob)), (channel_message, 0))
+        self.assertEqual(tuple(self._membership(cat)), (channel_message, 1))
+
+    def test_index_lists_latest_conversations_and_clears_unread(self):
+        ann, bob, cat = self.users
+        self.send(bob, content='from bob', recipient_id=ann.id)
+        self.send(cat, content='from cat', recipient_id=ann.id)
+
+        page = self.client_for(ann).get('/chat/').get_data(as_text=True)
+        self.assertLess(page.index('from cat'), page.index('from bob'))
+
+        self.client_for(ann).get(f'/chat/direct/{bob.id}')
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+        self.assertEqual(self._conversation(ann, cat).unread_count, 1)
+
+    def test_history_pages_back_from_newest(self):
+        ann, bob, cat = self.users
+        stamp = datetime(2030, 1, 1, 12, 0)
+        # Two messages share a timestamp, so the id breaks the tie
+        messages = [Message(content=f'm{i}', sender_id=(ann, bob)[i % 2].id,
+                            recipient_id=(bob, ann)[i % 2].id, created_at=stamp + timedelta(minutes=min(i, 5)))
+                    for i in range(7)]
+        db.session.add_all(messages + [Message(content='other', sender_id=cat.id, recipient_id=ann.id)])
+        db.session.commit()
+        self.app.config['CHAT_PAGE_SIZE'] = 3
+
+        page = self.client_for(ann).get(f'/chat/direct/{bob.id}').get_data(as_text=True)
+        # Matched as rendered content: the page's random CSRF token may contain 'm3'
+        self.assertIn('>m6<', page)
+        self.assertNotIn('>m3<', page)
+
+        seen, cursor = [], None
+        while True:
+            params = {'user_id': bob.id, **({'before': cursor} if cursor else {})}
+            body = self.client_for(ann).get('/chat/history', query_string=params).get_json()
+            seen = [m['content'] for m in body['messages']] + seen
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, [f'm{i}' for i in range(7)])
+
+        bad = self.client_for(ann).get('/chat/history', query_string={'user_id': bob.id, 'before': 'nope'})
+        self.assertEqual(bad.status_code, 400)
+        outsider = self.client_for(cat).get('/chat/history', query_string={'channel_id': 999})
+        self.assertEqual(outsider.status_code, 403)
+
+    def test_history_queries_use_keyset_indexes(self):
+        for sql, index in (
+            ('SELECT id FROM messages WHERE channel_id = 1 AND (created_at, id) < (?, 5) '
+             'ORDER BY created_at DESC, id DESC LIMIT 51', 'idx_messages_channel_created'),
+            ('SELECT id FROM messages WHERE sender_id = 1 AND recipient_id = 2 '
+             'ORDER BY created_at DESC, id DESC LIMIT 51', 'idx_messages_pair_created'),
+        ):
+            rows = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', ('2030-01-01',) * sql.count('?'))
+            plan = ' '.join(row[-1] for row in rows)
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_archive_moves_old_messages_and_reads_continue_into_it(self):
+        ann, bob, cat = self.users
+        ids = [self.send(ann, content=f'old note {i}', recipient_id=bob.id) for i in range(5)]
+        self.send(cat, content='old channel note', channel_id=self.channel.id)
+        latest = self.send(bob, content='fresh reply', recipient_id=ann.id)
+        # Everything but the reply is a year old; the channel note is still its channel's latest
+        db.session.execute(Message.__table__.update().where(Message.id != latest)
+                           .values(created_at=datetime.utcnow() - timedelta(days=365)))
+        Organisation.query.one().message_archive_days = 30
+        db.session.commit()
+
+        result = archive_messages()
+        self.assertEqual(result, {'archived_by_age': 5, 'archived_by_size': 0, 'hot_rows': 2})
+        self.assertEqual(sorted(m.id for m in ArchivedMessage.query), ids)
+
+        # History pages straight through into the archive
+        self.app.config['CHAT_PAGE_SIZE'] = 2
+        seen, cursor = [], None
+        while True:
+            params = {'user_id': bob.id, **({'before': cursor} if cursor else {})}
+            body = self.client_for(ann).get('/chat/history', query_string=params).get_json()
+            seen = [m['content'] for m in body['messages']] + seen
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, [f'old note {i}' for i in range(5)] + ['fresh reply'])
+        self.assertEqual([m.id for m, _ in search_messages(bob.id, 'note 3')], [ids[3]])
+
+        # New ids stay past the archived ones; the envelope trims the oldest hot rows
+        newer = [self.send(ann, content=f'new {i}', recipient_id=cat.id) for i in range(3)]
+        self.assertGreater(newer[0], max(ids))
+        self.app.config['MESSAGE_HOT_MAX_ROWS'] = 3
+        result = archive_messages()
+        self.assertEqual(result, {'archived_by_age': 0, 'archived_by_size': 2, 'hot_rows': 3})
+        self.assertEqual(sorted(m.id for m in Message.query), sorted([latest, newer[2]] + [
+            m.id for m in Message.query.filter_by(content='old channel note')
+        ]))
+
+    def test_read_marks_drive_unread_counts_and_ticks(self):
+        ann, bob, cat = self.users
+        ids = [self.send(bob, content=f'm{i}', recipient_id=ann.id) for i in range(4)]
+        self.assertEqual(self._conversation(ann, bob).unread_count, 4)
+
+        self.assertTrue(advance_read(ann.id, ids[1], partner_id=bob.id))
+        self.assertFalse(advance_read(ann.id, ids[0], partner_id=bob.id))  # never backwards
+        self.assertFalse(advance_read(ann.id, ids[-1] + 100, partner_id=bob.id))  # nor past the last message
+        db.session.commit()
+        conversation = self._conversation(ann, bob)
+        self.assertEqual((conversation.unread_count, conversation.last_read_message_id), (2, ids[1]))
+        self.assertEqual([mark_id for _, mark_id in get_marks(ann.id, partner_id=bob.id)], [ids[1], ids[1]])
+
+        # Bob's view shows double ticks up to Ann's read mark only
+        page = self.client_for(bob).get(f'/chat/direct/{ann.id}').get_data(as_text=True)
+        self.assertEqual(page.count('title="Read"'), 2)
+
+        # Opening the conversation reads everything with one UPDATE and one ack
+        with patch.object(socketio, 'emit') as emit:
+            self.client_for(ann).get(f'/chat/direct/{bob.id}')
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+        self.assertEqual(get_unread_direct_total(ann.id), 0)
+        self.assertEqual(emit.call_args_list, [
+            call('unread_delta', {'user_id': bob.id, 'channel_id': None, 'delta': -2, 'unread_count': 0},
+                 room=f'user_{ann.id}'),
+            call('read_up_to', {'user_id': ann.id, 'message_id': ids[-1],
+                                'created_at': db.session.get(Message, ids[-1]).created_at.isoformat()},
+                 room=f'user_{bob.id}'),
+        ])
+
+    def test_socket_read_up_to_acknowledges_once(self):
+        ann, bob, cat = self.users
+        ids = [self.send(bob, content=f'm{i}', recipient_id=ann.id) for i in range(3)]
+        channel_message = self.send(bob, content='team', channel_id=self.channel.id)
+
+        ann_socket = socketio.test_client(self.app, flask_test_client=self.client_for(ann))
+        bob_socket = socketio.test_client(self.app, flask_test_client=self.client_for(bob))
+        bob_socket.get_received()
+
+        def emit_as_ann(event, data):
+            g.pop('_login_user', None)
+            ann_socket.emit(event, data)
+
+        emit_as_ann('delivered_up_to', {'user_id': bob.id, 'message_id': ids[-1]})
+        emit_as_ann('read_up_to', {'user_id': bob.id, 'message_id': ids[-1]})
+        emit_as_ann('mark_message_read', {'message_id': ids[0]})  # old event, already covered
+        emit_as_ann('read_up_to', {'channel_id': self.channel.id, 'message_id': channel_message})
+
+        received = [(event['name'], event['args'][0]['message_id']) for event in bob_socket.get_received()]
+        self.assertEqual(received, [('delivered_up_to', ids[-1]), ('read_up_to', ids[-1]),
+                                    ('read_up_to', channel_message)])
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+        self.assertEqual(self._membership(ann).unread_count, 0)
+        ann_socket.disconnect()
+        bob_socket.disconnect()
+
+    def test_batched_acks_update_once_and_answer_each_sender_once(self):
+        ann, bob, cat = self.users
+        from_bob = [self.send(bob, content=f'b{i}', recipient_id=ann.id) for i in range(3)]
+        in_channel = [self.send(sender, content='team', channel_id=self.channel.id) for sender in (bob, cat, bob)]
+        own = self.send(ann, content='mine', recipient_id=bob.id)
+
+        sockets = {user.id: socketio.test_client(self.app, flask_test_client=self.client_for(user))
+                   for user in self.users}
+        for client in sockets.values():
+            client.get_received()
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            g.pop('_login_user', None)
+            sockets[ann.id].emit('messages_read', {
+                'ids': [from_bob[0], own],
+                'ranges': [[from_bob[1], from_bob[2]], [in_channel[0], in_channel[2]]]
+            })
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        # One UPDATE per conversation touched (direct with Bob, the channel)
+        self.assertEqual(statements.count('UPDATE'), 2)
+
+        def acks(user):
+            return [e['args'][0] for e in sockets[user.id].get_received() if e['name'] == 'messages_ack']
+        bob_ranges = id_ranges(from_bob + [in_channel[0], in_channel[2]])
+        self.assertEqual(acks(bob), [{'user_id': ann.id, 'status': 'read', 'ranges': bob_ranges}])
+        self.assertEqual(acks(cat), [{'user_id': ann.id, 'status': 'read', 'ranges': [[in_channel[1], in_channel[1]]]}])
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+        self.assertEqual(self._membership(ann).unread_count, 0)
+
+        # Already acknowledged, malformed and per-message shim events
+        g.pop('_login_user', None)
+        sockets[ann.id].emit('messages_delivered', {'ids': from_bob})
+        sockets[ann.id].emit('messages_read', {'ranges': [[5, 1]]})
+        sockets[ann.id].emit('messages_read', {'ids': ['x']})
+        self.assertEqual(acks(bob), [])
+        newer = self.send(bob, content='later', recipient_id=ann.id)
+        g.pop('_login_user', None)
+        sockets[ann.id].emit('message_delivered', {'message_id': newer})
+        self.assertEqual(acks(bob), [{'user_id': ann.id, 'status': 'delivered', 'ranges': [[newer, newer]]}])
+        self.assertEqual([mark_id for _, mark_id in get_marks(ann.id, partner_id=bob.id)], [from_bob[-1], newer])
+        for client in sockets.values():
+            g.pop('_login_user', None)
+            client.disconnect()
+
+    def test_sync_returns_only_what_changed_since_the_cursor(self):
+        ann, bob, cat = self.users
+        private = ChatChannel(name='private', organisation_id=bob.organisation_id, members=[bob, cat])
+        db.session.add(private)
+        db.session.add(Notification(user_id=ann.id, title='old', message='seen'))
+        db.session.commit()
+        self.send(bob, content='before', recipient_id=ann.id)
+
+        start = self.client_for(ann).get('/api/v1/sync').get_json()
+        self.assertEqual((start['messages'], start['notifications'], start['has_more']), ([], [], False))
+        cursor = start['cursor']
+
+        expected = [
+            self.send(bob, content='one', recipient_id=ann.id),
+            self.send(cat, content='team', channel_id=self.channel.id),
+            self.send(ann, content='own', recipient_id=cat.id),
+        ]
+        self.send(cat, content='hidden', channel_id=private.id)
+        self.send(bob, content='to cat', recipient_id=cat.id)
+        db.session.add_all([Notification(user_id=ann.id, title=f'n{i}', message='new') for i in range(3)]
+                           + [Notification(user_id=bob.id, title='other', message='not for ann')])
+        db.session.commit()
+        advance_read(cat.id, expected[-1], partner_id=ann.id)
+        db.session.commit()
+
+        first = self.client_for(ann).get('/api/v1/sync', query_string=dict(cursor, limit=2)).get_json()
+        self.assertEqual([m['id'] for m in first['messages']], expected[:2])
+        self.assertEqual([n['title'] for n in first['notifications']], ['n0', 'n1'])
+        self.assertTrue(first['has_more'])
+        own = {(r['user_id'], r['channel_id']): r['unread_count'] for r in first['read_state']['own']}
+        self.assertEqual(own, {(bob.id, None): 2, (cat.id, None): 0, (None, self.channel.id): 1})
+        self.assertEqual(first['read_state']['others'],
+                         [{'user_id': cat.id, 'channel_id': None, 'read_up_to': expected[-1],
+                           'delivered_up_to': expected[-1]}])
+
+        # The next page, over the socket
+        socket = socketio.test_client(self.app, flask_test_client=self.client_for(ann))
+        socket.get_received()
+        g.pop('_login_user', None)
+        socket.emit('sync', dict(first['cursor'], limit=2))
+        second = [e['args'][0] for e in socket.get_received() if e['name'] == 'sync_result'][0]
+        self.assertEqual([m['content'] for m in second['messages']], ['own'])
+        self.assertEqual([n['title'] for n in second['notifications']], ['n2'])
+        self.assertFalse(second['has_more'])
+        g.pop('_login_user', None)
+        socket.disconnect()
+
+    def test_sync_cursor_follows_commit_order_not_ids(self):
+        ann, bob, cat = self.users
+        # A lower id handed out before the cursor, committed after it
+        late = message_persister.prepare_message(Message(content='late', sender_id=bob.id, recipient_id=ann.id))
+        early = self.send(bob, content='early', recipient_id=ann.id)
+        self.assertGreater(early, late.id)
+
+        cursor = self.client_for(ann).get('/api/v1/sync').get_json()['cursor']
+        with patch.object(socketio, 'emit'):
+            message_persister.write_messages([late])
+            db.session.commit()
+
+        result = self.client_for(ann).get('/api/v1/sync', query_string=cursor).get_json()
+        self.assertEqual([m['id'] for m in result['messages']], [late.id])
+        self.assertEqual([(r['user_id'], r['unread_count']) for r in result['read_state']['own']], [(bob.id, 2)])
+        again = self.client_for(ann).get('/api/v1/sync', query_string=result['cursor']).get_json()
+        self.assertEqual(again['messages'], [])
+
+    def test_unread_counters_cover_channels_and_push_deltas(self):
+        ann, bob, cat = self.users
+        with patch.object(socketio, 'emit') as emit:
+            message_persister.write_messages([
+                message_persister.prepare_message(Message(content=content, sender_id=sender.id, **target))
+                for content, sender, target in (
+                    ('a', bob, {'recipient_id': ann.id}),
+                    ('b', bob, {'recipient_id': ann.id}),
+                    ('c', bob, {'channel_id': self.channel.id}),
+                    ('d', cat, {'channel_id': self.channel.id}),
+                )
+            ])
+            self.assertFalse(emit.called)  # nothing before the commit
+            db.session.commit()
+        # One delta per conversation and sender for the whole batch
+        self.assertCountEqual([c.args + (c.kwargs['room'],) for c in emit.call_args_list], [
+            ('unread_delta', {'user_id': bob.id, 'channel_id': None, 'sender_id': bob.id, 'delta': 2}, f'user_{ann.id}'),
+            ('unread_delta', {'user_id': None, 'channel_id': self.channel.id, 'sender_id': bob.id, 'delta': 1},
+             f'channel_{self.channel.id}'),
+            ('unread_delta', {'user_id': None, 'channel_id': self.channel.id, 'sender_id': cat.id, 'delta': 1},
+             f'channel_{self.channel.id}'),
+        ])
+
+        self.assertEqual(get_unread_total(ann.id), 4)
+        body = self.client_for(ann).get('/api/v1/messages/unread-count').get_json()
+        self.assertEqual(body['unread_count'], 4)
+        self.assertCountEqual(body['conversations'], [
+            {'user_id': bob.id, 'channel_id': None, 'unread_count': 2},
+            {'user_id': None, 'channel_id': self.channel.id, 'unread_count': 2},
+        ])
+        self.assertEqual(self.client_for(bob).get('/api/v1/messages/unread-count').get_json()['unread_count'], 1)
+
+        # Reading pushes the change to the reader's own sessions; no COUNT over messages
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', record)
+        last = db.session.scalar(db.select(db.func.max(Message.id)).where(Message.channel_id == self.channel.id))
+        with patch.object(socketio, 'emit') as emit:
+            self.assertTrue(advance_read(ann.id, last, channel_id=self.channel.id))
+            db.session.commit()
+        db.event.remove(db.engine, 'before_cursor_execute', record)
+        emit.assert_called_once_with('unread_delta', {'user_id': None, 'channel_id': self.channel.id, 'delta': -2,
+                                                      'unread_count': 0}, room=f'user_{ann.id}')
+        self.assertEqual(get_unread_total(ann.id), 2)
+        self.assertFalse([sql for sql in statements if 'count(' in sql.lower() and 'FROM messages' in sql
+                          and 'UPDATE' not in sql])
+
+    def test_search_is_ranked_scoped_and_incremental(self):
+        ann, bob, cat = self.users
+        private = ChatChannel(name='private', organisation_id=cat.organisation_id, members=[bob, cat])
+        db.session.add(private)
+        db.session.commit()
+        self.send(ann, content='Release notes for <b>tonight</b>', recipient_id=bob.id)
+        self.send(bob, content='release release release', recipient_id=ann.id)
+        self.send(cat, content='release plan', recipient_id=bob.id)
+        self.send(cat, content='release party', channel_id=self.channel.id)
+        self.send(cat, content='release secret', channel_id=private.id)
+
+        results = search_messages(ann.id, 'relea')
+        self.assertEqual([m.content for m, _ in results][0], 'release release release')
+        self.assertEqual(sorted(m.content for m, _ in results),
+                         ['Release notes for <b>tonight</b>', 'release party', 'release release release'])
+        snippets = {m.content: str(snippet) for m, snippet in results}
+        self.assertEqual(snippets['Release notes for <b>tonight</b>'],
+                         '<mark>Release</mark> notes for &lt;b&gt;tonight&lt;/b&gt;')
+        self.assertEqual([m.content for m, _ in search_messages(ann.id, 'release', channel_id=self.channel.id)],
+                         ['release party'])
+        self.assertEqual(search_messages(ann.id, '"  -*'), [])
+
+        # Edits and soft deletes reach the index through the triggers
+        party = Message.query.filter_by(content='release party').one()
+        party.content = 'launch party'
+        Message.query.filter_by(content='release release release').one().is_deleted = True
+        db.session.commit()
+        self.assertEqual([m.content for m, _ in search_messages(ann.id, 'release')],
+                         ['Release notes for <b>tonight</b>'])
+        self.assertEqual(len(search_messages(ann.id, 'launch')), 1)
+
+        page = self.client_for(ann).get('/chat/search', query_string={'q': 'launch'}).get_data(as_text=True)
+        self.assertIn('<mark>launch</mark> party', page)
+
+    def test_write_behind_group_commits_and_acknowledges(self):
+        ann, bob, cat = self.users
+        self.app.config.update(CHAT_PERSIST_MODE='write_behind', CHAT_PERSIST_BATCH_DELAY=0.3,
+                               CHAT_PERSIST_RETRY_BACKOFF=0, CHAT_PERSIST_MAX_RETRIES=1)
+        persister = message_persister.get_message_persister()
+        with patch.object(socketio, 'emit') as emit:
+            ids = [self.send(ann, content=f'm{i}', recipient_id=bob.id) for i in range(5)]
+            persister.flush()
+        self.assertEqual(ids, sorted(set(ids)))
+        # One commit for the batch, one ack for the sender
+        acks = [c for c in emit.call_args_list if c.args[0] == 'message_persisted']
+        self.assertEqual(acks, [call('message_persisted', {'ids': ids}, room=f'user_{ann.id}')])
+        self.assertEqual([m.id for m in Message.query.order_by(Message.id)], ids)
+        self.assertEqual(self._conversation(bob, ann).unread_count, 5)
+
+        # A read ack that outruns its batch waits for the commit instead of being dropped
+        self.app.config['CHAT_PERSIST_BATCH_DELAY'] = 0.1
+        with patch.object(socketio, 'emit'):
+            queued = self.send(ann, content='queued', recipient_id=bob.id)
+            bob_socket = socketio.test_client(self.app, flask_test_client=self.client_for(bob))
+            g.pop('_login_user', None)
+            bob_socket.emit('read_up_to', {'user_id': ann.id, 'message_id': queued})
+            bob_socket.disconnect()
+        self.assertEqual(self._conversation(bob, ann).last_read_message_id, queued)
+
+        # A failed batch is retried, and reported to the sender once retries run out
+        write, attempts = message_persister.write_messages, []
+
+        def flaky_write(messages):
+            attempts.append(messages)
+            if len(attempts) == 1:
+                raise OSError('database is locked')
+            write(messages)
+
+        with patch.object(socketio, 'emit') as emit, \
+                patch.object(message_persister, 'write_messages', side_effect=flaky_write):
+            retried = self.send(ann, content='retried', recipient_id=bob.id)
+            persister.flush()
+        self.assertEqual(len(attempts), 2)
+        emit.assert_any_call('message_persisted', {'ids': [retried]}, room=f'user_{ann.id}')
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, retried).content, 'retried')
+
+        with patch.object(socketio, 'emit') as emit, \
+                patch.object(message_persister, 'write_messages', side_effect=OSError('busy')):
+            lost = self.send(ann, content='lost', recipient_id=bob.id)
+            persister.flush()
+        emit.assert_any_call('message_failed', {'ids': [lost]}, room=f'user_{ann.id}')
+        emit.assert_any_call('message_retracted', {'id': lost, 'sender_id': ann.id, 'recipient_id': bob.id,
+                                                   'channel_id': None}, room=f'user_{bob.id}')
+        self.assertIsNone(db.session.get(Message, lost))
+
+    def test_one_bad_message_does_not_sink_its_batch(self):
+        ann, bob, cat = self.users
+        self.app.config.update(CHAT_PERSIST_MODE='write_behind', CHAT_PERSIST_BATCH_DELAY=0.3,
+                               CHAT_PERSIST_RETRY_BACKOFF=0, CHAT_PERSIST_MAX_RETRIES=1)
+        persister = message_persister.get_message_persister()
+
+        def send(sender, content, **target):
+            return message_persister.persist_message(Message(content=content, sender_id=sender.id, **target)).id
+
+        with patch.object(socketio, 'emit') as emit:
+            good = [send(ann, 'one', recipient_id=bob.id), send(bob, 'two', recipient_id=ann.id)]
+            bad = send(cat, None, channel_id=self.channel.id)  # content is NOT NULL
+            good.append(send(ann, 'three', channel_id=self.channel.id))
+            persister.flush()
+
+        db.session.expire_all()
+        self.assertEqual(sorted(m.id for m in Message.query), sorted(good))
+        persisted = [i for c in emit.call_args_list if c.args[0] == 'message_persisted' for i in c.args[1]['ids']]
+        self.assertEqual(sorted(persisted), sorted(good))
+        emit.assert_any_call('message_failed', {'ids': [bad]}, room=f'user_{cat.id}')
+        emit.assert_any_call('message_retracted', {'id': bad, 'sender_id': cat.id, 'recipient_id': None,
+                                                   'channel_id': self.channel.id}, room=f'channel_{self.channel.id}')
+
+    def test_marks_follow_send_time_not_id_order(self):
+        ann, bob, cat = self.users
+        stamp = datetime(2030, 1, 1, 12, 0)
+
+        def commit(message_id, minutes):
+            message = message_persister.prepare_message(Message(
+                id=message_id, content=f'#{message_id}', sender_id=bob.id, recipient_id=ann.id,
+                created_at=stamp + timedelta(minutes=minutes)
+            ))
+            with patch.object(socketio, 'emit'):
+                message_persister.write_messages([message])
+                db.session.commit()
+
+        # Another process handed out 101 after 150 was committed
+        commit(150, 0)
+        commit(101, 1)
+        self.assertEqual(self._conversation(ann, bob).last_message_id, 101)
+        # ... and a late commit of an older message leaves the last message alone
+        commit(200, -1)
+        self.assertEqual(self._conversation(ann, bob).last_message_id, 101)
+
+        # Reading up to 150 leaves the later 101 unread
+        self.assertTrue(advance_read(ann.id, 150, partner_id=bob.id))
+        db.session.commit()
+        conversation = self._conversation(ann, bob)
+        self.assertEqual((conversation.unread_count, conversation.last_read_message_id), (1, 150))
+        self.assertFalse(advance_read(ann.id, 200, partner_id=bob.id))  # sent before the mark
+        self.assertTrue(advance_read(ann.id, 101, partner_id=bob.id))
+        db.session.commit()
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+
+    def test_write_behind_queue_is_drained_at_exit(self):
+        ann, bob, cat = self.users
+        self.app.config.update(CHAT_PERSIST_MODE='write_behind', CHAT_PERSIST_BATCH_DELAY=0.5)
+        persister = message_persister.get_message_persister()
+        with patch.object(socketio, 'emit'), patch.object(message_persister.atexit, 'register') as register:
+            queued = self.send(ann, content='queued at exit', recipient_id=bob.id)
+            register.assert_called_once_with(persister.drain)
+            persister.drain()
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, queued).content, 'queued at exit')
+
+    def test_typing_store_throttles_and_expires(self):
+        store = MemoryTypingStore(ttl=5, throttle=2)
+        with patch('app.utils.typing_indicators.time.monotonic') as clock:
+            clock.return_value = 100
+            self.assertTrue(store.start('direct:1:2', 1))
+            clock.return_value = 101
+            self.assertFalse(store.start('direct:1:2', 1))  # throttled, TTL extended to 106
+            clock.return_value = 105
+            self.assertEqual(store.typing_users('direct:1:2'), [1])
+            self.assertTrue(store.start('direct:1:2', 1))
+            clock.return_value = 111
+            self.assertEqual(store.typing_users('direct:1:2'), [])
+            self.assertFalse(store.stop('direct:1:2', 1))
+
+    def test_typing_events_reach_only_the_conversation(self):
+        ann, bob, cat = self.users
+        sockets = {}
+        for user in self.users:
+            sockets[user.id] = socketio.test_client(self.app, flask_test_client=self.client_for(user))
+            sockets[user.id].get_received()
+
+        def typing_events(user):
+            return [(e['args'][0]['user_id'], e['args'][0]['channel_id'], e['args'][0]['is_typing'])
+                    for e in sockets[user.id].get_received() if e['name'] == 'user_typing']
+
+        for event, data in (('typing_start', {'user_id': bob.id}), ('typing_start', {'user_id': bob.id}),
+                            ('typing_stop', {'user_id': bob.id}), ('typing_stop', {'user_id': bob.id}),
+                            ('typing', {'recipient_id': bob.id, 'is_typing': True}),
+                            ('typing_start', {'channel_id': self.channel.id})):
+            g.pop('_login_user', None)
+            sockets[ann.id].emit(event, data)
+
+        self.assertEqual(typing_events(bob), [(ann.id, None, True), (ann.id, None, False), (ann.id, None, True),
+                                              (ann.id, self.channel.id, True)])
+        self.assertEqual(typing_events(cat), [(ann.id, self.channel.id, True)])
+        self.assertEqual(typing_events(ann), [])
+
+        # Disconnecting abandons both conversations
+        g.pop('_login_user', None)
+        sockets[ann.id].disconnect()
+        self.assertCountEqual(typing_events(bob), [(ann.id, None, False), (ann.id, self.channel.id, False)])
+        self.assertEqual(TypingIndicator.query.count(), 0)
+        for user in (bob, cat):
+            sockets[user.id].disconnect()
+
+    def test_presence_counts_tabs_and_sends_coalesced_org_diffs(self):
+        ann, bob, cat = self.users
+        other_org = Organisation(name='Other Org', email='other@example.com')
+        db.session.add(other_org)
+        db.session.flush()
+        dee = User(name='Dee', email='dee@example.com', organisation_id=other_org.id)
+        dee.set_password('password')
+        db.session.add(dee)
+        db.session.commit()
+        presence = get_presence()
+
+        def connect(user):
+            return socketio.test_client(self.app, flask_test_client=self.client_for(user))
+
+        def disconnect(client):
+            g.pop('_login_user', None)
+            client.disconnect()
+
+        def diffs(client):
+            return [e['args'][0] for e in client.get_received() if e['name'] == 'presence_diff']
+
+        bob_socket, dee_socket = connect(bob), connect(dee)
+        presence.flush()
+        self.assertEqual(diffs(bob_socket), [{'online': [bob.id], 'offline': []}])
+
+        first_tab, second_tab = connect(ann), connect(ann)
+        disconnect(first_tab)
+        presence.flush()
+        self.assertEqual(diffs(bob_socket), [{'online': [ann.id], 'offline': []}])
+        self.assertEqual(presence.online_user_ids(ann.organisation_id), [ann.id, bob.id])
+
+        # A reconnect within one window is no change at all
+        disconnect(second_tab)
+        third_tab = connect(ann)
+        presence.flush()
+        self.assertEqual(diffs(bob_socket), [])
+        self.assertEqual(OnlineStatus.query.count(), 0)  # nothing written per connect
+
+        disconnect(third_tab)
+        presence.flush(persist=True)
+        self.assertEqual(diffs(bob_socket), [{'online': [], 'offline': [ann.id]}])
+        self.assertEqual(diffs(dee_socket), [{'online': [dee.id], 'offline': []}])
+        db.session.expire_all()
+        statuses = {s.user_id: s for s in OnlineStatus.query}
+        self.assertEqual(set(statuses), {ann.id, bob.id, dee.id})
+        self.assertFalse(statuses[ann.id].is_online)
+        self.assertTrue(statuses[bob.id].is_online)
+        self.assertIsNotNone(statuses[ann.id].last_seen)
+        disconnect(bob_socket)
+        disconnect(dee_socket)
+
+    def test_membership_cache_follows_commits(self):
+        ann, bob, cat = self.users
+        cache = get_membership_cache()
+        self.assertEqual(channel_ids_of(ann.id), {self.channel.id})
+        self.assertEqual(channel_member_count(self.channel.id), 3)
+
+        entry = cache.user_channels[ann.id]
+        private = ChatChannel(name='private', organisation_id=ann.organisation_id, members=[ann, bob])
+        db.session.add(private)
+        self.channel.members.remove(ann)
+        db.session.commit()
+        self.assertEqual(channel_ids_of(ann.id), {private.id})
+        self.assertIs(cache.user_channels[ann.id], entry)  # updated in place, not reloaded
+        self.assertEqual(channel_member_count(self.channel.id), 2)
+        self.assertEqual(channel_member_count(private.id), 2)
+
+        private.members.append(cat)
+        db.session.flush()
+        self.assertTrue(is_channel_member(cat.id, private.id))  # read inside the transaction
+        db.session.rollback()
+        self.assertFalse(is_channel_member(cat.id, private.id))
+
+        # Socket joins are checked against the cache
+        sockets = {user.id: socketio.test_client(self.app, flask_test_client=self.client_for(user))
+                   for user in (ann, cat)}
+        for user in (ann, cat):
+            g.pop('_login_user', None)
+            sockets[user.id].get_received()
+            sockets[user.id].emit('join_channel', {'channel_id': private.id})
+        joined = [e['args'][0] for e in sockets[ann.id].get_received() if e['name'] == 'joined_channel']
+        self.assertEqual(joined, [{'channel_id': private.id, 'user_name': 'Ann', 'member_count': 2}])
+        self.assertEqual([e for e in sockets[cat.id].get_received() if e['name'] == 'joined_channel'], [])
+        for client in sockets.values():
+            g.pop('_login_user', None)
+            client.disconnect()
+
+    def test_membership_changes_reach_other_processes(self):
+        ann, bob, cat = self.users
+        cache = get_membership_cache()
+        self.assertEqual(channel_ids_of(cat.id), {self.channel.id})
+        self.app.config['SOCKETIO_MESSAGE_QUEUE'] = 'redis://localhost:6379/0'
+        with patch.object(socketio, 'emit') as emit:
+            private = ChatChannel(name='private', organisation_id=cat.organisation_id, members=[cat])
+            db.session.add(private)
+            db.session.commit()
+        (name, data), kwargs = emit.call_args
+        self.assertEqual((name, kwargs), ('memberships', {'namespace': CACHE_NAMESPACE}))
+        self.assertEqual((data['user_ids'], data['channel_ids']), ([cat.id], [private.id]))
+
+        # Another process still holding the old entry drops it
+        other = type('Manager', (CacheSyncMixin, PubSubManager), {})()
+        other.app = self.app
+        cache.user_channels[cat.id] = {self.channel.id}
+        message = {'method': 'emit', 'event': name, 'data': data, 'namespace': CACHE_NAMESPACE}
+        other._handle_emit(dict(message, host_id=other.host_id))  # its own change
+        self.assertFalse(is_channel_member(cat.id, private.id))
+        other._handle_emit(dict(message, host_id='publisher'))
+        self.assertTrue(is_channel_member(cat.id, private.id))
+
+    def test_backfill_rebuilds_from_messages(self):
+        ann, bob, cat = self.users
+        db.session.add_all([
+            Message(content='one', sender_id=ann.id, recipient_id=bob.id),
+            Message(content='two', sender_id=bob.id, recipient_id=ann.id, is_read=True),
+            Message(content='three', sender_id=ann.id, recipient_id=bob.id),
+            Message(content='team', sender_id=cat.id, channel_id=self.channel.id),
+        ])
+        db.session.commit()
+
+        self.assertEqual(backfill_conversations(), 2)
+        self.assertEqual(self._conversation(bob, ann).unread_count, 2)
+        self.assertEqual(self._conversation(ann, bob).unread_count, 0)
+        self.assertIsNotNone(self._membership(ann).last_message_id)
+
+
+
+class TestChatOnDisk(unittest.TestCase):
+    """Sends against a file-backed database, where every connection shares SQLite's write lock"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='flowdeck-chat-')
+        with patch.dict(os.environ, {'DATABASE_URL': 'sqlite:///' + os.path.join(self.work_dir, 'chat.db')}):
+            self.app = create_app()
+        self.app.config.update(WTF_CSRF_ENABLED=False, CHAT_PERSIST_MODE='sync',
+                               STORAGE_FOLDER=os.path.join(self.work_dir, 'storage'))
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        init_database_features(self.app)
+
+        org = Organisation(name='Test Org', email='org@example.com')
+        db.session.add(org)
+        db.session.flush()
+        self.ann = User(name='Ann', email='ann@example.com', organisation_id=org.id)
+        self.bob = User(name='Bob', email='bob@example.com', organisation_id=org.id)
+        for user in (self.ann, self.bob):
+            user.set_password('password')
+        db.session.add_all([self.ann, self.bob])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.ctx.pop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_attachment_send_reserves_ids_without_deadlock(self):
+        data = b'%PDF-1.4 report'
+        upload = start_upload(self.ann, 'report.pdf', len(data), 'application/pdf')
+        db.session.commit()
+        write_upload_chunk(upload, 0, io.BytesIO(data))
+        finalize_upload(upload)
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(self.ann.id)
+        # The first send of the process reserves a fresh id block
+        with patch.object(socketio, 'emit'):
+            response = client.post('/chat/send', json={'upload_id': upload.id, 'recipient_id': self.bob.id})
+        self.assertEqual(response.status_code, 200)
+        message = db.session.get(Message, response.get_json()['message']['id'])
+        self.assertEqual(message.attachment_hash, hashlib.sha256(data).hexdigest())
+
+if __name__ == '__main__':
+    unittest.main()
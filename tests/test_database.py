@@ -0,0 +1,166 @@
+import os
+import unittest
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import create_app, db
+from app.database import (
+    init_database_features, check_task_hours_consistency, migrate_deliverables_to_table,
+    check_task_timestamp_strategy
+)
+from app.models import Organisation, User, Task, TaskDeliverable, TaskHistory, TimeLog, Tag
+
+
+class TestDatabaseFeatures(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        init_database_features(self.app)
+
+        org = Organisation(name='Test Org', email='org@example.com')
+        db.session.add(org)
+        db.session.flush()
+        self.user = User(name='Test User', email='test@example.com', organisation_id=org.id)
+        self.user.set_password('password')
+        db.session.add(self.user)
+        self.task = Task(title='Test Task')
+        db.session.add(self.task)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _actual_hours(self):
+        db.session.expire_all()
+        return db.session.get(Task, self.task.id).get_time_spent()
+
+    def test_time_log_triggers_maintain_actual_hours(self):
+        log = TimeLog(task_id=self.task.id, user_id=self.user.id, duration=2.5)
+        db.session.add(log)
+        db.session.add(TimeLog(task_id=self.task.id, user_id=self.user.id, duration=1.0))
+        db.session.commit()
+        self.assertAlmostEqual(self._actual_hours(), 3.5)
+
+        log.duration = 4.0
+        db.session.commit()
+        self.assertAlmostEqual(self._actual_hours(), 5.0)
+
+        db.session.delete(log)
+        db.session.commit()
+        self.assertAlmostEqual(self._actual_hours(), 1.0)
+
+    def test_check_task_hours_consistency(self):
+        db.session.add(TimeLog(task_id=self.task.id, user_id=self.user.id, duration=2.0))
+        db.session.commit()
+        self.assertEqual(check_task_hours_consistency(), [])
+
+        db.session.execute(db.text('UPDATE tasks SET actual_hours = 7 WHERE id = :id'), {'id': self.task.id})
+        db.session.commit()
+        self.assertEqual(check_task_hours_consistency(fix=True), [(self.task.id, 7.0, 2.0)])
+        self.assertAlmostEqual(self._actual_hours(), 2.0)
+
+    def test_set_deliverables_stores_rows_and_counts(self):
+        task = Task(title='Checklist Task')
+        task.set_deliverables([
+            {'id': 1, 'text': 'Draft', 'completed': True},
+            {'id': 2, 'text': 'Review', 'completed': False},
+            {'id': 3, 'text': '  '},
+        ])
+        db.session.add(task)
+        db.session.commit()
+
+        self.assertEqual((task.completed_count, task.total_count), (1, 2))
+        self.assertEqual(task.get_completion_percentage(), 50)
+        self.assertEqual([item['text'] for item in task.get_deliverables()], ['Draft', 'Review'])
+
+        task.set_deliverables([{'text': 'Ship', 'completed': False}])
+        db.session.commit()
+        self.assertEqual(TaskDeliverable.query.filter_by(task_id=task.id).count(), 1)
+        self.assertEqual(task.get_completion_percentage(), 0)
+
+    def test_migrate_deliverables_to_table(self):
+        db.session.execute(
+            db.text('UPDATE tasks SET deliverables = :raw WHERE id = :id'),
+            {'raw': '[{"id": 7, "text": "A", "completed": true}, {"id": 8, "text": "B"}]', 'id': self.task.id}
+        )
+        db.session.commit()
+
+        self.assertEqual(migrate_deliverables_to_table(), 1)
+        self.assertEqual(migrate_deliverables_to_table(), 0)
+
+        db.session.expire_all()
+        task = db.session.get(Task, self.task.id)
+        self.assertIsNone(task.deliverables)
+        self.assertEqual((task.completed_count, task.total_count), (1, 2))
+        self.assertEqual([item['completed'] for item in task.get_deliverables()], [True, False])
+
+    def _total_changes(self):
+        return db.session.execute(db.text('SELECT total_changes()')).scalar()
+
+    def test_task_update_is_a_single_row_write(self):
+        self.assertEqual(check_task_timestamp_strategy(), [])
+        before_update = self.task.updated_at
+
+        changes = self._total_changes()
+        self.task.status = 'done'
+        db.session.commit()
+
+        # The task UPDATE plus its task_history row, no trigger re-writes
+        self.assertEqual(self._total_changes() - changes, 2)
+        self.assertIsNotNone(self.task.completed_date)
+        self.assertGreaterEqual(self.task.updated_at, before_update)
+
+    def test_history_is_one_compact_diff_per_task_per_commit(self):
+        self.assertEqual(TaskHistory.query.filter_by(task_id=self.task.id, action='created').count(), 1)
+        tag = Tag(name='ops')
+        other = Task(title='Other')
+        db.session.add_all([tag, other])
+        db.session.commit()
+
+        db.session.info['history_user_id'] = self.user.id
+        self.task.title = 'Renamed'
+        self.task.status = 'in_progress'
+        self.task.assignees.append(self.user)
+        self.task.tags.append(tag)
+        other.status = 'done'
+        other.board_position = 3
+        db.session.commit()
+
+        rows = TaskHistory.query.filter(TaskHistory.action != 'created').order_by(TaskHistory.task_id).all()
+        self.assertEqual([(row.task_id, row.action) for row in rows],
+                         [(self.task.id, 'updated'), (other.id, 'status_changed')])
+        self.assertEqual(rows[0].get_changes(), {
+            'title': ['Test Task', 'Renamed'],
+            'status': ['todo', 'in_progress'],
+            'assignees': {'+': [self.user.id]},
+            'tags': {'+': [tag.id]},
+        })
+        self.assertEqual(rows[0].user_id, self.user.id)
+        self.assertEqual((rows[1].old_value, rows[1].new_value), ('todo', 'done'))
+        self.assertEqual(rows[0].created_at, rows[1].created_at)
+
+        # Untracked or unchanged attributes write nothing
+        self.task.description = 'Only the description'
+        self.task.status = 'in_progress'
+        db.session.commit()
+        self.assertEqual(TaskHistory.query.count(), 4)
+
+    def test_check_task_timestamp_strategy_flags_legacy_trigger(self):
+        db.session.execute(db.text("""
+            CREATE TRIGGER update_task_timestamp AFTER UPDATE ON tasks
+            BEGIN
+                UPDATE tasks SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+            END
+        """))
+        db.session.commit()
+        self.assertEqual(check_task_timestamp_strategy(), ['update_task_timestamp'])
+
+        init_database_features(self.app)
+        self.assertEqual(check_task_timestamp_strategy(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from PIL import Image
+from app import create_app
+from app.utils.images import schedule_variants, variant_path, image_url
+
+
+class TestImageVariants(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.static_folder = tempfile.mkdtemp()
+        self.app.static_folder = self.static_folder
+        os.makedirs(os.path.join(self.static_folder, 'uploads', 'logos'))
+        self.path = os.path.join(self.static_folder, 'uploads', 'logos', 'logo.jpg')
+        Image.new('RGB', (1200, 600), 'red').save(self.path, format='JPEG')
+
+    def tearDown(self):
+        shutil.rmtree(self.static_folder)
+
+    def test_variants_are_generated_in_background(self):
+        with self.app.app_context():
+            written = schedule_variants(self.path, 'logo').result(timeout=30)
+
+        self.assertEqual(len(written), 4)
+        with Image.open(variant_path(self.path, 'sm')) as small:
+            self.assertEqual((small.format, small.size), ('JPEG', (64, 32)))
+        with Image.open(variant_path(self.path, 'md', webp=True)) as medium:
+            self.assertEqual((medium.format, medium.size), ('WEBP', (200, 100)))
+
+    def test_image_url_picks_size_and_format(self):
+        url = '/static/uploads/logos/logo.jpg'
+        with self.app.test_request_context(headers={'Accept': 'text/html,image/webp,*/*;q=0.8'}):
+            # Original is served until the variants exist
+            self.assertEqual(image_url(url, 'logo', 64), url)
+            schedule_variants(self.path, 'logo').result(timeout=30)
+            self.assertEqual(image_url(url, 'logo', 64), '/static/uploads/logos/logo_sm.webp')
+            self.assertEqual(image_url(url, 'logo', 150), '/static/uploads/logos/logo_md.webp')
+
+        with self.app.test_request_context(headers={'Accept': 'text/html,*/*'}):
+            self.assertEqual(image_url(url, 'logo', 1000), '/static/uploads/logos/logo_md.jpg')
+
+
+if __name__ == '__main__':
+    unittest.main()
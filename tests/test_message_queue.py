@@ -0,0 +1,163 @@
+import importlib.util
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+import socketio as socketio_client
+from itsdangerous import URLSafeTimedSerializer
+
+from app import create_app, db, socketio
+from app.database import init_database_features
+from app.models import Organisation, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@unittest.skipUnless(importlib.util.find_spec('kombu'), 'kombu is not installed')
+class TestMessageQueue(unittest.TestCase):
+    """Two server processes sharing a Kombu filesystem queue"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='flowdeck-mq-')
+        self.env = {
+            'DATABASE_URL': 'sqlite:///' + os.path.join(self.work_dir, 'test.db'),
+            'STORAGE_FOLDER': os.path.join(self.work_dir, 'storage'),
+            'SECRET_KEY': 'message-queue-test',
+            'SOCKETIO_MESSAGE_QUEUE': 'filesystem://',
+            'SOCKETIO_QUEUE_FOLDER': os.path.join(self.work_dir, 'queue'),
+            'CHAT_PERSIST_MODE': 'sync',
+        }
+        with patch.dict(os.environ, self.env):
+            self.app = create_app()
+        with self.app.app_context():
+            init_database_features(self.app)
+            org = Organisation(name='Test Org', email='org@example.com')
+            db.session.add(org)
+            db.session.flush()
+            self.ann = User(name='Ann', email='ann@example.com', organisation_id=org.id, password_hash='!')
+            self.bob = User(name='Bob', email='bob@example.com', organisation_id=org.id, password_hash='!')
+            db.session.add_all([self.ann, self.bob])
+            db.session.commit()
+            self.ann_id, self.bob_id = self.ann.id, self.bob.id
+
+        self.servers = [self.start_server() for _ in range(2)]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        for server, _ in self.servers:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        # Leave the shared Socket.IO server without the queue for other tests
+        create_app()
+
+    def start_server(self):
+        port = free_port()
+        env = dict(os.environ, **self.env, FLASK_PORT=str(port), FLASK_DEBUG='False')
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'run.py')], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f'{url}/auth/login', timeout=1)
+                return server, url
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    server.kill()
+                    raise
+                time.sleep(0.2)
+
+    def session_cookie(self, user_id, csrf=None):
+        data = {'_user_id': str(user_id), '_fresh': True}
+        if csrf:
+            data['csrf_token'] = csrf
+        return self.app.session_interface.get_signing_serializer(self.app).dumps(data)
+
+    def connect(self, user_id, url):
+        """Connect a client as user_id; return it and the events it receives"""
+        client = socketio_client.Client(reconnection=False)
+        received = []
+        arrived = threading.Condition()
+
+        def record(event, *args):
+            with arrived:
+                received.append((event, args[0] if args else None))
+                arrived.notify_all()
+
+        client.on('*', record)
+        client.connect(url, headers={'Cookie': f'session={self.session_cookie(user_id)}'},
+                       transports=['polling'])
+        self.clients.append(client)
+
+        def wait_for(event, timeout=10):
+            with arrived:
+                arrived.wait_for(lambda: any(name == event for name, _ in received), timeout)
+            return [data for name, data in received if name == event]
+        return client, wait_for
+
+    def test_emits_reach_clients_of_other_processes(self):
+        (_, ann_url), (_, bob_url) = self.servers
+        _, ann_events = self.connect(self.ann_id, ann_url)
+        _, bob_events = self.connect(self.bob_id, bob_url)
+
+        # HTTP route on Ann's process -> Bob's socket on the other process
+        raw_token = 'a' * 40
+        token = URLSafeTimedSerializer(self.env['SECRET_KEY'], salt='wtf-csrf-token').dumps(raw_token)
+        response = requests.post(
+            f'{ann_url}/chat/send', json={'content': 'across processes', 'recipient_id': self.bob_id},
+            cookies={'session': self.session_cookie(self.ann_id, csrf=raw_token)},
+            headers={'X-CSRFToken': token}
+        )
+        self.assertEqual(response.status_code, 200)
+        messages = bob_events('new_direct_message')
+        self.assertEqual([m['content'] for m in messages], ['across processes'])
+        # The sender's ack comes back through the queue as well
+        self.assertEqual(ann_events('message_persisted')[0]['ids'], [messages[0]['id']])
+
+        # A background job in a third process (this one) emits the same way
+        with self.app.app_context():
+            socketio.emit('new_notification', {'title': 'From a job'}, room=f'user_{self.ann_id}')
+        self.assertEqual(ann_events('new_notification'), [{'title': 'From a job'}])
+        self.assertEqual(bob_events('new_notification', timeout=0.5), [])
+
+
+    def test_membership_changes_reach_other_processes(self):
+        (_, bob_url), (_, ann_url) = self.servers
+        client, ann_events = self.connect(self.ann_id, ann_url)  # Ann's channels are now cached there
+
+        # Bob adds Ann to a new channel through the other process
+        raw_token = 'b' * 40
+        token = URLSafeTimedSerializer(self.env['SECRET_KEY'], salt='wtf-csrf-token').dumps(raw_token)
+        response = requests.post(
+            f'{bob_url}/chat/channels/create', data={'name': 'late', 'members': [str(self.ann_id)]},
+            cookies={'session': self.session_cookie(self.bob_id, csrf=raw_token)},
+            headers={'X-CSRFToken': token}, allow_redirects=False
+        )
+        self.assertEqual(response.status_code, 302)
+        channel_id = int(response.headers['Location'].rstrip('/').rsplit('/', 1)[1])
+
+        # Ann's process dropped its cached entry, so the join is allowed
+        deadline = time.monotonic() + 10
+        while not ann_events('joined_channel', timeout=0.5) and time.monotonic() < deadline:
+            client.emit('join_channel', {'channel_id': channel_id})
+        self.assertEqual(ann_events('joined_channel')[0]['channel_id'], channel_id)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import patch
+
+from base import AppTestCase
+from app import db, socketio
+from app.models import Task, Notification
+from app.utils.notifications import notify_users
+
+
+class TestNotifications(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user(f'User {i}', f'user{i}@example.com') for i in range(3)]
+        self.task = Task(title='Test Task')
+        db.session.add(self.task)
+        db.session.commit()
+
+    def test_fan_out_emits_once_after_commit(self):
+        ids = [u.id for u in self.users]
+        with patch.object(socketio, 'emit') as emit:
+            inserted = notify_users(
+                ids, 'comment_added',
+                {'task_id': self.task.id, 'task_title': 'Test Task', 'actor_name': 'User 0'},
+                exclude_user_id=ids[0]
+            )
+            self.assertEqual(inserted, 2)
+            emit.assert_not_called()
+            db.session.commit()
+
+        emit.assert_called_once()
+        self.assertEqual(emit.call_args.kwargs['room'], [f'user_{ids[1]}', f'user_{ids[2]}'])
+        self.assertEqual(Notification.query.filter_by(notification_type='comment_added').count(), 2)
+
+    def test_task_assigned_skips_trigger_rows(self):
+        self.task.assignees.append(self.users[0])
+        db.session.commit()
+        self.assertEqual(Notification.query.filter_by(notification_type='task_assigned').count(), 1)
+
+        with patch.object(socketio, 'emit'):
+            inserted = notify_users(
+                [self.users[0].id, self.users[1].id], 'task_assigned',
+                {'task_id': self.task.id, 'task_title': 'Test Task'}
+            )
+            db.session.commit()
+
+        self.assertEqual(inserted, 1)
+        self.assertEqual(Notification.query.filter_by(notification_type='task_assigned').count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
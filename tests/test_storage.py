@@ -0,0 +1,196 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+from sqlalchemy.dialects import postgresql
+from werkzeug.datastructures import FileStorage
+from base import AppTestCase
+from app import db
+from app.database import blob_ref_triggers
+from app.models import User, Task, TaskAttachment, FileBlob, UploadSession
+from app.utils.storage import (
+    BLOB_REFERENCES, blob_upsert, save_upload, collect_garbage, get_storage_usage_by_organisation,
+    start_upload, write_upload_chunk
+)
+
+
+class TestStorage(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_folder = tempfile.mkdtemp()
+        self.app.config['STORAGE_FOLDER'] = self.storage_folder
+        self.user = self.create_user('Test User', 'test@example.com')
+        db.session.flush()
+        self.task = Task(title='Test Task', created_by_id=self.user.id)
+        db.session.add(self.task)
+        db.session.commit()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.storage_folder)
+
+    def _attach(self, data, name='report.pdf'):
+        stored = save_upload(FileStorage(io.BytesIO(data), filename=name, content_type='application/pdf'))
+        attachment = TaskAttachment(
+            filename=stored['filename'],
+            original_filename=stored['original_filename'],
+            file_path=stored['storage_path'],
+            mime_type=stored['mime_type'],
+            file_size=stored['size'],
+            content_hash=stored['sha256'],
+            task_id=self.task.id,
+            uploaded_by_id=self.user.id
+        )
+        db.session.add(attachment)
+        db.session.commit()
+        return stored, attachment
+
+    def test_identical_uploads_share_one_blob(self):
+        data = b'%PDF' + os.urandom(200 * 1024)
+        first, _ = self._attach(data)
+        second, _ = self._attach(data, name='copy.pdf')
+
+        self.assertEqual(first['sha256'], second['sha256'])
+        self.assertEqual(first['size'], len(data))
+        blob = FileBlob.query.filter_by(sha256=first['sha256']).one()
+        self.assertEqual(blob.ref_count, 2)
+
+        usage = get_storage_usage_by_organisation()[0]
+        self.assertEqual((usage['files'], usage['logical_bytes']), (2, 2 * len(data)))
+        self.assertEqual((usage['blobs'], usage['stored_bytes']), (1, len(data)))
+
+    def test_postgresql_gets_its_own_upsert_and_triggers(self):
+        sql = str(blob_upsert('postgresql', {'sha256': 'ab', 'size': 1, 'storage_path': 'blobs/ab',
+                                             'mime_type': None, 'ref_count': 0, 'created_at': None,
+                                             'last_used_at': None}).compile(dialect=postgresql.dialect()))
+        self.assertIn('ON CONFLICT (sha256) DO UPDATE SET last_used_at', sql)
+
+        statements = blob_ref_triggers('postgresql')
+        for table, hash_column, _ in BLOB_REFERENCES:
+            self.assertTrue(any(f'AFTER INSERT OR DELETE ON {table}' in sql for sql in statements))
+            self.assertTrue(any(f'WHERE sha256 = OLD.{hash_column}' in sql and f'blob_ref_{table}()' in sql
+                                for sql in statements))
+        self.assertFalse(any('IF NOT EXISTS' in sql for sql in statements))
+
+    def test_collect_garbage_removes_unreferenced_blobs(self):
+        stored, attachment = self._attach(b'temporary')
+        self.assertEqual(collect_garbage(timedelta(0))['blobs_removed'], 0)
+
+        db.session.delete(attachment)
+        db.session.commit()
+        result = collect_garbage(timedelta(0))
+
+        self.assertEqual(result, {'blobs_removed': 1, 'bytes_freed': len(b'temporary')})
+        self.assertFalse(os.path.exists(stored['path']))
+        self.assertEqual(FileBlob.query.count(), 0)
+
+    def _client(self, user):
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user.id)
+        return client
+
+    def test_download_supports_etag_and_range(self):
+        data = os.urandom(100 * 1024)
+        stored, attachment = self._attach(data)
+        client = self._client(self.user)
+        url = f'/tasks/attachments/{attachment.id}'
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, data)
+        self.assertEqual(response.headers['ETag'], f'"{stored["sha256"]}"')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('private', response.headers['Cache-Control'])
+
+        response = client.get(url, headers={'If-None-Match': f'"{stored["sha256"]}"'})
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get(url, headers={'Range': 'bytes=1000-1999'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, data[1000:2000])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 1000-1999/{len(data)}')
+
+    def test_download_requires_task_access(self):
+        _, attachment = self._attach(b'secret')
+        outsider = User(name='Outsider', email='out@example.com', organisation_id=self.user.organisation_id)
+        outsider.set_password('password')
+        db.session.add(outsider)
+        db.session.commit()
+
+        response = self._client(outsider).get(f'/tasks/attachments/{attachment.id}')
+        self.assertEqual(response.status_code, 403)
+
+    def test_resumable_upload_verifies_offsets_and_attaches(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self._client(self.user)
+        data = os.urandom(10000)
+
+        self.user.organisation.max_upload_size = 5000
+        db.session.commit()
+        response = client.post('/api/v1/uploads', json={'filename': 'big.bin', 'size': len(data)})
+        self.assertEqual(response.status_code, 413)
+        self.user.organisation.max_upload_size = None
+        db.session.commit()
+
+        response = client.post('/api/v1/uploads', json={'filename': 'big.bin', 'size': len(data),
+                                                        'mime_type': 'application/octet-stream'})
+        self.assertEqual(response.status_code, 201)
+        url = f"/api/v1/uploads/{response.get_json()['upload_id']}"
+
+        def put(offset, chunk):
+            return client.put(url, data=chunk, headers={'Upload-Offset': str(offset)})
+
+        self.assertEqual(put(0, data[:4000]).get_json()['offset'], 4000)
+        # A retried chunk at a stale offset is refused with the offset to resume from
+        retry = put(0, data[:4000])
+        self.assertEqual((retry.status_code, retry.get_json()['offset']), (409, 4000))
+        self.assertEqual(client.get(url).get_json()['offset'], 4000)
+        self.assertEqual(client.post(f'{url}/finalize').status_code, 409)
+        self.assertEqual(put(4000, data[4000:] + b'extra').status_code, 409)
+
+        self.assertEqual(put(4000, data[4000:]).get_json()['offset'], len(data))
+        finalized = client.post(f'{url}/finalize').get_json()
+        self.assertEqual(finalized['sha256'], hashlib.sha256(data).hexdigest())
+
+        upload_id = finalized['upload_id']
+        client.post(f'/tasks/{self.task.id}/upload', data={'upload_id': upload_id})
+        client.post(f'/tasks/{self.task.id}/upload', data={'upload_id': upload_id})
+        attachment = TaskAttachment.query.one()
+        self.assertEqual((attachment.content_hash, attachment.file_size), (finalized['sha256'], len(data)))
+        self.assertEqual(db.session.get(FileBlob, 1).ref_count, 1)
+        self.assertIsNone(db.session.get(UploadSession, upload_id))
+        self.assertEqual(client.get(f'/tasks/attachments/{attachment.id}').data, data)
+
+    def test_upload_chunks_commit_with_the_caller(self):
+        upload = start_upload(self.user, 'notes.txt', 10, 'text/plain')
+        db.session.commit()
+
+        self.assertEqual(write_upload_chunk(upload, 0, io.BytesIO(b'x' * 4)), 4)
+        db.session.rollback()
+        self.assertEqual(upload.received, 0)
+        self.assertEqual(write_upload_chunk(upload, 0, io.BytesIO(b'x' * 4)), 4)
+        db.session.commit()
+        self.assertEqual(upload.received, 4)
+        with self.assertRaises(ValueError):
+            write_upload_chunk(upload, 0, io.BytesIO(b'x' * 4))
+
+    def test_download_offloads_to_accel_redirect(self):
+        stored, attachment = self._attach(b'offloaded')
+        self.app.config['SENDFILE_BACKEND'] = 'x-accel-redirect'
+
+        response = self._client(self.user).get(f'/tasks/attachments/{attachment.id}?download=1')
+        self.assertEqual(response.data, b'')
+        self.assertEqual(
+            response.headers['X-Accel-Redirect'],
+            '/protected-storage/' + stored['storage_path'].replace(os.sep, '/')
+        )
+        self.assertTrue(response.headers['Content-Disposition'].startswith('attachment'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports wsgi.py the way gunicorn does and reports what it patched
+SMOKE = """
+import sys
+import wsgi
+print(wsgi.app.config['SOCKETIO_ASYNC_MODE'], sorted(m for m in sys.modules if m.startswith('psycogreen.')))
+"""
+
+
+def import_wsgi(async_mode):
+    env = dict(os.environ, SOCKETIO_ASYNC_MODE=async_mode, DATABASE_URL='sqlite://')
+    return subprocess.run([sys.executable, '-c', SMOKE], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=120)
+
+
+class TestWsgi(unittest.TestCase):
+    """Smoke checks of the production entry point, each in a fresh interpreter"""
+
+    def test_threading_mode_is_refused(self):
+        result = import_wsgi('threading')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("wsgi.py serves eventlet or gevent, not 'threading'", result.stderr)
+
+    @unittest.skipUnless(importlib.util.find_spec('eventlet'), 'eventlet is not installed')
+    def test_eventlet_mode(self):
+        result = import_wsgi('eventlet')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        patched = ['psycogreen.eventlet'] if importlib.util.find_spec('psycogreen') else []
+        self.assertEqual(result.stdout.splitlines()[-1], f'eventlet {patched}')
+
+    @unittest.skipUnless(importlib.util.find_spec('gevent'), 'gevent is not installed')
+    def test_gevent_mode(self):
+        result = import_wsgi('gevent')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        patched = ['psycogreen.gevent'] if importlib.util.find_spec('psycogreen') else []
+        self.assertEqual(result.stdout.splitlines()[-1], f'gevent {patched}')
+
+
+if __name__ == '__main__':
+    unittest.main()
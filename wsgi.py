@@ -0,0 +1,59 @@
+"""
+FlowDeck Production Entry Point
+
+Serves Flask and Socket.IO from one process on green threads, so each
+websocket costs a greenlet instead of an OS thread.
+
+Run behind gunicorn with a single cooperative worker per process (Socket.IO
+sessions are held in the process that accepted them):
+
+    gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:5000 wsgi:app
+
+or directly, with the server of SOCKETIO_ASYNC_MODE ('eventlet' by default,
+or 'gevent'):
+
+    python wsgi.py
+"""
+
+import importlib
+import os
+import signal
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Monkey patching has to happen before anything imports socket, threading
+# or the database drivers (gunicorn's eventlet/gevent workers have already
+# done it, doing it again is harmless)
+ASYNC_MODE = os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'eventlet')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    raise RuntimeError(f"wsgi.py serves eventlet or gevent, not {ASYNC_MODE!r}; use run.py for development")
+
+try:
+    # psycopg2 blocks in C unless told to yield to the hub while waiting; only
+    # the module of this mode is imported, the other hub may not be installed
+    psycogreen = importlib.import_module(f'psycogreen.{ASYNC_MODE}')
+except ImportError:
+    pass
+else:
+    psycogreen.patch_psycopg()
+
+from app import create_app, socketio
+
+app = create_app('production')
+
+
+if __name__ == '__main__':
+    # SIGTERM exits normally, so atexit hooks such as the chat persister's drain
+    # run (gunicorn workers already exit this way)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    port = int(os.getenv('FLASK_PORT', 5000))
+    print(f"\n🚀 Starting FlowDeck ({ASYNC_MODE}) on port {port}")
+    socketio.run(app, host='0.0.0.0', port=port)